@@ -1,11 +1,47 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, g, render_template, request, jsonify, session, redirect, url_for
+from flask.json.provider import DefaultJSONProvider
 import os
 import secrets
-from tinkoff_service import TinkoffInvestService, RebalanceCalculator
+import threading
+import time
+import traceback
+import uuid
+from tinkoff_service import TinkoffInvestService, RebalanceCalculator, get_token, reprice_positions
 from auth import UserDatabase, generate_session_id
+from instrument_cache import InstrumentCache
+from async_service import AsyncTinkoffInvestService, run_async
+from client_pool import sandbox_async_client_pool
+from portfolio_cache import PortfolioCache, REBALANCE_SNAPSHOT_MAX_AGE
+from portfolio_history import PortfolioHistory
+from operations_store import OperationsStore, OPERATIONS_SYNC_MAX_AGE
+from drift_monitor import DriftMonitor, TargetStore, DRIFT_DEFAULT_THRESHOLD
+from rebalance_engine import RebalanceEngine
+from cost_model import (
+    COST_MODEL_TTL, DEFAULT_COMMISSION_RATE, REBALANCE_COST_AVERSION, REBALANCE_TAX_RATE, CostModel, commission_rate
+)
+from models import Portfolio, Position, to_json_compatible
+from order_executor import ORDER_DEFAULT_TYPE, ORDER_TYPES, OrderExecution, order_executor, plan_orders
+from price_stream import (
+    PRICE_STREAM_RECONNECT_DELAY, portfolio_price_events, price_feed, price_stream_connections
+)
+from price_hub import price_hub_client
+from serialization import json_response
+from prefetch import PrefetchScheduler, snapshot_max_age
+from metrics import APP_ERRORS, HTTP_REQUEST_SECONDS, METRICS_TOKEN, profiler, registry
 
 app = Flask(__name__)
 
+
+class ModelJSONProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask с поддержкой моделей (Position, Portfolio, Operation)"""
+    
+    @staticmethod
+    def default(obj):
+        return to_json_compatible(obj)
+
+
+app.json = ModelJSONProvider(app)
+
 # Секретный ключ для сессий
 def get_or_create_secret_key():
     """Получает SECRET_KEY из переменной окружения или создает новый"""
@@ -33,21 +69,265 @@ app.secret_key = get_or_create_secret_key()
 # Инициализация базы данных
 db = UserDatabase()
 
+# Общий кэш справочной информации об инструментах
+instrument_cache = InstrumentCache()
+
+# Кэш снимков портфелей пользователей
+portfolio_cache = PortfolioCache()
+
+# Ключ снимка списка счетов в кэше снимков
+ACCOUNTS_SNAPSHOT = '__accounts__'
+
+# История снимков портфелей счетов
+portfolio_history = PortfolioHistory()
+
+# Локальная история операций счетов
+operations_store = OperationsStore()
+
+# Отслеживание отклонения портфелей от сохраненных целевых долей
+target_store = TargetStore()
+drift_monitor = DriftMonitor(target_store, stream_hub=price_feed)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # В каждом воркере gunicorn сохранение метрик запускается при первом запросе
+    registry.start_flusher()
+
+
+@app.after_request
+def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started, request.endpoint or 'unknown', request.method, str(response.status_code)
+        )
+    return response
+
+
+def error_response(e):
+    """Ответ 500 на исключение обработчика (с учетом в метриках)"""
+    APP_ERRORS.inc(request.endpoint or 'unknown', type(e).__name__)
+    traceback.print_exc()
+    return jsonify({'error': str(e)}), 500
+
+
+def get_service(token):
+    """Создает сервис Tinkoff Invest API с общим кэшем инструментов"""
+    return TinkoffInvestService(token, instrument_cache)
+
+
+def get_async_service(token, sandbox=False):
+    """
+    Создает асинхронный сервис Tinkoff Invest API с общим кэшем инструментов и историями портфелей и операций
+    
+    Сервис песочницы (sandbox) работает через ее адрес и виртуальные счета не сохраняет в историях.
+    """
+    if sandbox:
+        return AsyncTinkoffInvestService(token, instrument_cache, client_pool=sandbox_async_client_pool)
+    return AsyncTinkoffInvestService(token, instrument_cache, history=portfolio_history, operations=operations_store)
+
+
+def warm_instrument_cache():
+    """Прогревает кэш инструментов в фоне, если задан токен приложения"""
+    if os.environ.get('INSTRUMENT_CACHE_WARMUP', '1') != '1' or instrument_cache.is_warm():
+        return
+    
+    try:
+        token = get_token()
+    except ValueError:
+        return
+    
+    def warm():
+        try:
+            count = get_service(token).warm_instrument_cache()
+            print(f"✅ Кэш инструментов прогрет: {count} инструментов")
+        except Exception as e:
+            print(f"Ошибка при прогреве кэша инструментов: {e}")
+    
+    threading.Thread(target=warm, daemon=True).start()
+
+
+warm_instrument_cache()
+
 
 def get_user_token():
     """Получает токен текущего пользователя из базы данных"""
     if 'user_id' not in session:
         return None
-    return db.get_token(session['user_id'])
+    token = db.get_token(session['user_id'])
+    if token:
+        db.mark_active(session['user_id'])
+        prefetch_scheduler.start()
+    return token
+
+
+def snapshot_response(snapshot):
+    """Ответ со снимком портфеля, поддерживающий ETag и Last-Modified (304)"""
+    response = json_response(snapshot.data, etag=snapshot.etag, bodies=snapshot.bodies)
+    response.last_modified = snapshot.last_modified
+    # Браузер хранит ответ, но каждый раз сверяет его с сервером
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def accounts_loader(service):
+    """Функция загрузки списка счетов"""
+    return lambda: {'accounts': run_async(service.get_accounts())}
+
+
+def user_account_ids(token):
+    """Идентификаторы счетов текущего пользователя"""
+    snapshot = get_portfolio_snapshot(ACCOUNTS_SNAPSHOT, accounts_loader(get_async_service(token)))
+    return {acc['id'] for acc in snapshot.data['accounts']}
+
+
+def portfolio_loader(service, account_id):
+    """Функция загрузки портфеля счета (для 'all' - сводного портфеля)"""
+    if account_id == 'all':
+        return lambda: run_async(service.get_all_portfolios())
+    return lambda: run_async(service.get_portfolio(account_id))
+
+
+def get_portfolio_snapshot(account_id, load, refresh=False, max_age=None):
+    """
+    Снимок портфеля из кэша или свежий результат load()
+    
+    Args:
+        refresh: Принудительно обновить снимок
+        max_age: Допустимый возраст снимка (по умолчанию - время свежести кэша)
+    """
+    user_id = session['user_id']
+    snapshot = None
+    if not refresh:
+        snapshot = portfolio_cache.get(user_id, account_id, max_age if max_age is not None else snapshot_max_age())
+    if snapshot is None:
+        snapshot = store_snapshot(user_id, account_id, load())
+    return snapshot
+
+
+def store_snapshot(user_id, account_id, data):
+    """Сохраняет свежий снимок портфеля (или списка счетов) в кэше"""
+    snapshot = portfolio_cache.put(user_id, account_id, data)
+    if account_id == ACCOUNTS_SNAPSHOT:
+        return snapshot
+    
+    positions = snapshot_portfolio(snapshot).positions
+    if price_hub_client:
+        # Хаб начинает отслеживать цены заранее, до первого расчета
+        price_hub_client.watch([pos.figi for pos in positions])
+    drift_monitor.on_snapshot(user_id, account_id, positions)
+    return snapshot
+
+
+async def prefetch_load(token):
+    """Загрузка счетов и портфелей пользователя для планировщика предзагрузки"""
+    return await get_async_service(token).get_all_portfolios()
+
+
+def prefetch_store(user_id, data):
+    """Раскладывает результат предзагрузки по снимкам: список счетов, счета и сводный портфель"""
+    accounts = data['accounts']
+    store_snapshot(user_id, ACCOUNTS_SNAPSHOT, {
+        'accounts': [{key: value for key, value in acc.items() if key != 'portfolio'} for acc in accounts]
+    })
+    for acc in accounts:
+        if isinstance(acc['portfolio'], Portfolio):
+            store_snapshot(user_id, acc['id'], acc['portfolio'])
+    if len(accounts) > 1:
+        store_snapshot(user_id, 'all', data)
+
+
+# Планировщик предзагрузки портфелей активных пользователей
+prefetch_scheduler = PrefetchScheduler(db, prefetch_load, prefetch_store)
+prefetch_scheduler.start()
+
+
+def snapshot_portfolio(snapshot):
+    """Портфель снимка (для 'all' - сводный портфель)"""
+    if isinstance(snapshot.data, dict):
+        return snapshot.data['aggregated']
+    return snapshot.data
+
+
+def hub_prices(positions):
+    """Последние цены позиций из хаба цен (None, если хаб не настроен или цен нет)"""
+    if not price_hub_client:
+        return None
+    return price_hub_client.get_prices([pos.figi for pos in positions if pos.type != 'bond']) or None
+
+
+def snapshot_engine(snapshot):
+    """
+    Позиции снимка и векторный движок ребалансировки по ним
+    
+    Если настроен хаб цен, позиции переоцениваются по его последним ценам
+    без запроса к API. Иначе движок создается по снимку один раз.
+    """
+    positions = snapshot_portfolio(snapshot).positions
+    prices = hub_prices(positions)
+    if prices:
+        positions = reprice_positions(positions, prices)
+        return positions, RebalanceEngine(positions)
+    
+    if snapshot.engine is None:
+        snapshot.engine = RebalanceEngine(positions)
+    return positions, snapshot.engine
+
+
+def open_lots(token, account_id):
+    """FIFO-лоты счета (для 'all' - всех счетов) по локальной истории операций"""
+    account_ids = sorted(user_account_ids(token)) if account_id == 'all' else [account_id]
+    merged = {}
+    for acc_id in account_ids:
+        try:
+            sync_operations(token, acc_id)
+        except Exception as e:
+            # Без истории операций бумаги считаются купленными по текущей цене
+            print(f"Ошибка при синхронизации операций счета: {e}")
+            continue
+        for figi, lots in operations_store.open_lots(acc_id).items():
+            merged.setdefault(figi, []).extend(lots)
+    
+    return {
+        figi: [(lot['quantity'], lot['cost']) for lot in sorted(lots, key=lambda lot: lot['date'])]
+        for figi, lots in merged.items()
+    }
+
+
+def snapshot_costs(snapshot, engine, token, account_id, commission=None, tax_rate=REBALANCE_TAX_RATE):
+    """
+    Модель издержек по позициям движка снимка
+    
+    Тариф, спреды стаканов и FIFO-лоты загружаются при первом расчете
+    с издержками и переиспользуются COST_MODEL_TTL секунд. Массивы модели
+    строятся заново, только если изменились движок или параметры.
+    """
+    now = time.time()
+    inputs = snapshot.costs
+    if inputs is None or now - inputs['loaded_at'] > COST_MODEL_TTL:
+        inputs = run_async(get_async_service(token).get_cost_inputs(engine.figis))
+        inputs.update(lots=open_lots(token, account_id), loaded_at=now, models={})
+        snapshot.costs = inputs
+    
+    if commission is None:
+        commission = commission_rate(inputs['tariff'])
+    key = (commission, tax_rate)
+    cached = inputs['models'].get(key)
+    if cached is not None and cached[0] is engine:
+        return cached[1]
+    
+    costs = CostModel(engine, commission, inputs['half_spreads'], inputs['lots'], tax_rate)
+    inputs['models'][key] = (engine, costs)
+    return costs
 
 
 @app.route('/')
 def index():
     """Главная страница"""
-    # Проверяем, есть ли у пользователя токен
-    if 'user_id' not in session or not db.user_exists(session['user_id']):
-        return redirect(url_for('login'))
-    
+    # Проверяем, есть ли у пользователя токен (один запрос к базе)
     token = get_user_token()
     if not token:
         return redirect(url_for('login'))
@@ -74,16 +354,21 @@ def api_login():
         
         # Проверяем валидность токена, пытаясь получить счета
         try:
-            service = TinkoffInvestService(token)
-            accounts = service.get_accounts()
+            service = get_async_service(token)
+            accounts = run_async(service.get_accounts())
             
             # Токен валидный, сохраняем пользователя
             if 'user_id' not in session:
                 session['user_id'] = generate_session_id()
             
             db.create_or_update_user(session['user_id'], token, username)
+            portfolio_cache.invalidate_user(session['user_id'])
             session['username'] = username
             
+            # Главная страница откроется уже с загруженными счетами и портфелями
+            store_snapshot(session['user_id'], ACCOUNTS_SNAPSHOT, {'accounts': accounts})
+            prefetch_scheduler.request(session['user_id'])
+            
             return jsonify({
                 'success': True,
                 'username': username,
@@ -93,7 +378,14 @@ def api_login():
             return jsonify({'error': f'Неверный токен: {str(e)}'}), 400
     
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+
+def close_price_streams(user_id):
+    """Закрывает потоки цен, открытые токеном пользователя"""
+    token = db.get_token(user_id)
+    if token:
+        price_feed.close_token(token)
 
 
 @app.route('/api/auth/logout', methods=['POST'])
@@ -103,11 +395,14 @@ def api_logout():
         if 'user_id' in session:
             # Опционально: можно удалить пользователя из БД или просто очистить сессию
             # db.delete_user(session['user_id'])
+            close_price_streams(session['user_id'])
+            portfolio_cache.invalidate_user(session['user_id'])
+            drift_monitor.invalidate_user(session['user_id'])
             session.clear()
         
         return jsonify({'success': True})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
 
 @app.route('/api/auth/delete', methods=['POST'])
@@ -115,12 +410,16 @@ def api_delete_account():
     """API для удаления токена пользователя"""
     try:
         if 'user_id' in session:
+            close_price_streams(session['user_id'])
             db.delete_user(session['user_id'])
+            target_store.delete_user(session['user_id'])
+            portfolio_cache.invalidate_user(session['user_id'])
+            drift_monitor.invalidate_user(session['user_id'])
             session.clear()
         
         return jsonify({'success': True})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
 
 @app.route('/settings')
@@ -140,11 +439,29 @@ def get_accounts():
         if not token:
             return jsonify({'error': 'Не авторизован'}), 401
         
-        service = TinkoffInvestService(token)
-        accounts = service.get_accounts()
-        return jsonify({'accounts': accounts})
+        snapshot = get_portfolio_snapshot(
+            ACCOUNTS_SNAPSHOT, accounts_loader(get_async_service(token)), refresh=request.args.get('refresh') == '1'
+        )
+        return snapshot_response(snapshot)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+
+@app.route('/api/portfolio/all', methods=['GET'])
+def get_all_portfolios():
+    """API для получения сводного портфеля по всем счетам"""
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        
+        service = get_async_service(token)
+        snapshot = get_portfolio_snapshot(
+            'all', portfolio_loader(service, 'all'), refresh=request.args.get('refresh') == '1'
+        )
+        return snapshot_response(snapshot)
+    except Exception as e:
+        return error_response(e)
 
 
 @app.route('/api/portfolio/<account_id>', methods=['GET'])
@@ -155,11 +472,301 @@ def get_portfolio(account_id):
         if not token:
             return jsonify({'error': 'Не авторизован'}), 401
         
-        service = TinkoffInvestService(token)
-        portfolio = service.get_portfolio(account_id)
-        return jsonify(portfolio)
+        service = get_async_service(token)
+        snapshot = get_portfolio_snapshot(
+            account_id, portfolio_loader(service, account_id), refresh=request.args.get('refresh') == '1'
+        )
+        return snapshot_response(snapshot)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+
+@app.route('/api/portfolio/<account_id>/stream', methods=['GET'])
+def stream_portfolio(account_id):
+    """
+    Поток изменений цен портфеля (Server-Sent Events)
+    
+    Цены приходят из общей подписки на рыночные данные (price_feed: хаб цен
+    или потоки токена в воркере), поэтому страница не перезапрашивает
+    портфель целиком. Открытый поток занимает поток gunicorn, поэтому их
+    число ограничено PRICE_STREAM_MAX_CONNECTIONS на воркер (по умолчанию
+    три четверти GUNICORN_THREADS), а сверх лимита отдается 503.
+    """
+    release = None
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        
+        release = price_stream_connections.acquire()
+        if release is None:
+            response = jsonify({'error': 'Слишком много открытых потоков цен, попробуйте позже'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(PRICE_STREAM_RECONNECT_DELAY)
+            return response
+        
+        snapshot = get_portfolio_snapshot(
+            account_id, portfolio_loader(get_async_service(token), account_id),
+            max_age=REBALANCE_SNAPSHOT_MAX_AGE
+        )
+        portfolio = snapshot_portfolio(snapshot)
+        
+        response = Response(
+            portfolio_price_events(portfolio, token),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        # Место освобождается при закрытии ответа, даже если поток не начал отдаваться
+        response.call_on_close(release)
+        return response
+    except Exception as e:
+        if release is not None:
+            release()
+        return error_response(e)
+
+
+@app.route('/api/portfolio/<account_id>/history', methods=['GET'])
+def get_portfolio_history(account_id):
+    """API истории стоимости портфеля счета (параметры since и until - Unix-время)"""
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        if account_id not in user_account_ids(token):
+            return jsonify({'error': 'Счет не найден'}), 404
+        
+        since = request.args.get('since', type=float)
+        until = request.args.get('until', type=float)
+        return json_response({'account_id': account_id, 'points': portfolio_history.values(account_id, since, until)})
+    except Exception as e:
+        return error_response(e)
+
+
+@app.route('/api/portfolio/<account_id>/history/drift', methods=['POST'])
+def get_portfolio_drift_history(account_id):
+    """API отклонения портфеля счета от целевых долей во времени"""
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        if account_id not in user_account_ids(token):
+            return jsonify({'error': 'Счет не найден'}), 404
+        
+        data = request.json
+        target_weights = {figi: float(weight) for figi, weight in data.get('target_weights', {}).items()}
+        points = portfolio_history.drift(account_id, target_weights, data.get('since'), data.get('until'))
+        return json_response({'account_id': account_id, 'points': points})
+    except Exception as e:
+        return error_response(e)
+
+
+def drift_state(account_id, token, since=None):
+    """Текущее отклонение счета от целевых долей и пересечения порога (None без целевых долей)"""
+    snapshot = get_portfolio_snapshot(account_id, portfolio_loader(get_async_service(token), account_id))
+    positions = snapshot_portfolio(snapshot).positions
+    prices = hub_prices(positions)
+    if prices:
+        positions = reprice_positions(positions, prices)
+    
+    tracker = drift_monitor.tracker(session['user_id'], account_id, positions, token)
+    if tracker is None:
+        return None
+    return {
+        'account_id': account_id,
+        'target_weights': tracker.target_weights,
+        'threshold': tracker.threshold,
+        'total_value': tracker.total,
+        'breaches': tracker.breaches(),
+        'events': drift_monitor.events(session['user_id'], account_id, since),
+        'positions': tracker.positions()
+    }
+
+
+@app.route('/api/targets/<account_id>', methods=['GET', 'PUT', 'DELETE'])
+def account_targets(account_id):
+    """API целевых долей счета для отслеживания отклонения"""
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        if account_id != 'all' and account_id not in user_account_ids(token):
+            return jsonify({'error': 'Счет не найден'}), 404
+        
+        user_id = session['user_id']
+        if request.method == 'GET':
+            return jsonify(target_store.get(user_id, account_id) or {})
+        
+        if request.method == 'DELETE':
+            drift_monitor.delete_targets(user_id, account_id)
+            return jsonify({'success': True})
+        
+        data = request.json
+        target_weights = {figi: float(weight) for figi, weight in data.get('target_weights', {}).items()}
+        threshold = float(data.get('threshold', DRIFT_DEFAULT_THRESHOLD))
+        total_weight = sum(target_weights.values())
+        if abs(total_weight - 100) > 0.01:
+            return jsonify({'error': f'Сумма долей должна быть 100%, а не {total_weight}%'}), 400
+        if threshold <= 0 or any(weight < 0 for weight in target_weights.values()):
+            return jsonify({'error': 'Доли и порог должны быть положительными'}), 400
+        
+        snapshot = get_portfolio_snapshot(
+            account_id, portfolio_loader(get_async_service(token), account_id), max_age=REBALANCE_SNAPSHOT_MAX_AGE
+        )
+        drift_monitor.set_targets(user_id, account_id, target_weights, threshold,
+                                  snapshot_portfolio(snapshot).positions, token)
+        return json_response(drift_state(account_id, token))
+    except Exception as e:
+        return error_response(e)
+
+
+@app.route('/api/drift/<account_id>', methods=['GET'])
+def get_drift(account_id):
+    """
+    API отклонения счета от сохраненных целевых долей
+    
+    Возвращает позиции за порогом (breaches) и последние пересечения
+    порога (events, параметр since - только после этого Unix-времени).
+    """
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        if account_id != 'all' and account_id not in user_account_ids(token):
+            return jsonify({'error': 'Счет не найден'}), 404
+        
+        state = drift_state(account_id, token, request.args.get('since', type=float))
+        if state is None:
+            return jsonify({'error': 'Целевые доли для счета не заданы'}), 404
+        return json_response(state)
+    except Exception as e:
+        return error_response(e)
+
+
+def sync_operations(token, account_id, refresh=False):
+    """
+    Догружает новые операции счета, если история не синхронизировалась
+    дольше OPERATIONS_SYNC_MAX_AGE секунд (или refresh)
+    
+    Если API недоступно, а история уже загружалась, ответ строится
+    по локальной истории.
+    """
+    synced_at = operations_store.synced_at(account_id)
+    if not refresh and synced_at is not None and time.time() - synced_at < OPERATIONS_SYNC_MAX_AGE:
+        return
+    try:
+        run_async(get_async_service(token).sync_operations(account_id))
+    except Exception as e:
+        if synced_at is None:
+            raise
+        print(f"Ошибка при синхронизации операций счета: {e}")
+
+
+@app.route('/api/operations/<account_id>', methods=['GET'])
+def get_operations(account_id):
+    """
+    API истории операций счета из локальной базы
+    
+    Параметры: since и until (Unix-время), figi, type (типы OPERATION_TYPE_...
+    через запятую), limit, refresh=1 - сначала догрузить новые операции.
+    """
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        if account_id not in user_account_ids(token):
+            return jsonify({'error': 'Счет не найден'}), 404
+        
+        sync_operations(token, account_id, request.args.get('refresh') == '1')
+        types = [t for t in request.args.get('type', '').split(',') if t]
+        operations = operations_store.operations(
+            account_id,
+            request.args.get('since', type=float),
+            request.args.get('until', type=float),
+            request.args.get('figi'),
+            types,
+            request.args.get('limit', 1000, type=int)
+        )
+        return json_response({
+            'account_id': account_id,
+            'synced_at': operations_store.synced_at(account_id),
+            'operations': operations
+        })
+    except Exception as e:
+        return error_response(e)
+
+
+@app.route('/api/pnl/<account_id>', methods=['GET'])
+def get_pnl(account_id):
+    """
+    API доходности счета по локальной истории операций: себестоимость
+    открытых позиций, реализованный результат по FIFO, дивиденды, купоны,
+    комиссии и налоги (параметры since, until и refresh - как у истории)
+    """
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        if account_id not in user_account_ids(token):
+            return jsonify({'error': 'Счет не найден'}), 404
+        
+        sync_operations(token, account_id, request.args.get('refresh') == '1')
+        pnl = operations_store.pnl(account_id, request.args.get('since', type=float), request.args.get('until', type=float))
+        return json_response(dict(pnl, account_id=account_id, synced_at=operations_store.synced_at(account_id)))
+    except Exception as e:
+        return error_response(e)
+
+
+def rebalance_inputs(token, data, sandbox=False):
+    """
+    Позиции, движок и модель издержек для расчета ребалансировки по телу запроса
+    
+    Позиции берутся из снимка портфеля счета, который пользователь видит
+    на странице (в песочнице - из свежего портфеля виртуального счета),
+    или, для совместимости, из запроса.
+    
+    Returns:
+        Tuple: (positions, engine, lots, budget, costs, cost_aversion)
+    """
+    snapshot = None
+    if 'account_id' in data:
+        account_id = data['account_id']
+        if sandbox:
+            portfolio = portfolio_loader(get_async_service(token, sandbox=True), account_id)()
+            positions = (portfolio['aggregated'] if isinstance(portfolio, dict) else portfolio).positions
+            engine = RebalanceEngine(positions)
+        else:
+            snapshot = get_portfolio_snapshot(
+                account_id, portfolio_loader(get_async_service(token), account_id),
+                max_age=REBALANCE_SNAPSHOT_MAX_AGE
+            )
+            positions, engine = snapshot_engine(snapshot)
+    else:
+        # Совместимость: позиции, переданные клиентом
+        positions = [Position.from_dict(pos) for pos in data.get('positions', [])]
+        engine = None
+    
+    # Режим целых лотов и доступные средства для него
+    lots = bool(data.get('lots', False))
+    budget = data.get('budget')
+    budget = float(budget) if budget not in (None, '') else None
+    
+    # Учет комиссии, спреда и налога (только в целых лотах)
+    costs = None
+    cost_aversion = float(data.get('cost_aversion', REBALANCE_COST_AVERSION))
+    if data.get('costs'):
+        lots = True
+        tax_rate = float(data.get('tax_rate', REBALANCE_TAX_RATE))
+        commission = data.get('commission')
+        commission = float(commission) if commission not in (None, '') else None
+        if snapshot is not None:
+            costs = snapshot_costs(snapshot, engine, token, account_id, commission, tax_rate)
+        else:
+            # Для переданных позиций и песочницы известна только комиссия
+            engine = engine or RebalanceEngine(positions)
+            costs = CostModel(engine, commission if commission is not None else DEFAULT_COMMISSION_RATE,
+                              tax_rate=tax_rate)
+    
+    return positions, engine, lots, budget, costs, cost_aversion
 
 
 @app.route('/api/rebalance', methods=['POST'])
@@ -171,14 +778,136 @@ def calculate_rebalance():
             return jsonify({'error': 'Не авторизован'}), 401
         
         data = request.json
-        positions = data.get('positions', [])
+        mode = data.get('mode', 'buy_only')
+        positions, engine, lots, budget, costs, cost_aversion = rebalance_inputs(token, data)
+        
+        # Несколько наборов целевых долей считаются за один вызов
+        if 'scenarios' in data:
+            results = RebalanceCalculator.calculate_rebalance_batch(
+                positions, data['scenarios'], mode, lots, budget, engine, costs, cost_aversion
+            )
+            return json_response({'results': results})
+        
         target_weights = data.get('target_weights', {})
+        result = RebalanceCalculator.calculate_rebalance(
+            positions, target_weights, mode, lots, budget, engine, costs, cost_aversion
+        )
+        return json_response(result)
+    except Exception as e:
+        return error_response(e)
+
+
+@app.route('/api/orders/execute', methods=['POST'])
+def execute_rebalance():
+    """
+    API исполнения ребалансировки заявками
+    
+    Расчет в целых лотах (параметры как у /api/rebalance) превращается
+    в заявки, которые выставляются в фоне; ответ 202 содержит состояние
+    исполнения, дальше оно доступно по /api/orders/executions/<id>.
+    Повтор запроса с тем же execution_id возвращает уже запущенное
+    исполнение, а dry_run - только план заявок.
+    """
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        
+        data = request.json
+        if not data.get('account_id'):
+            return jsonify({'error': 'Не указан счет'}), 400
+        order_type = data.get('order_type', ORDER_DEFAULT_TYPE)
+        if order_type not in ORDER_TYPES:
+            return jsonify({'error': f'Неизвестный тип заявок: {order_type}'}), 400
+        execution_id = str(data.get('execution_id') or uuid.uuid4())
+        if len(execution_id) > 64:
+            return jsonify({'error': 'Слишком длинный execution_id'}), 400
+        
+        user_id = session['user_id']
+        execution = order_executor.get(user_id, execution_id)
+        if execution is not None:
+            return json_response(execution.to_dict())
+        
+        account_id = data['account_id']
         mode = data.get('mode', 'buy_only')
+        sandbox = bool(data.get('sandbox', False))
+        positions, engine, _, budget, costs, cost_aversion = rebalance_inputs(token, data, sandbox)
+        result = RebalanceCalculator.calculate_rebalance(
+            positions, data.get('target_weights', {}), mode, True, budget, engine, costs, cost_aversion
+        )
+        if 'error' in result:
+            return jsonify(result), 400
+        
+        orders = plan_orders(execution_id, result['operations'], account_id)
+        execution = OrderExecution(execution_id, user_id, account_id, mode, order_type, orders, sandbox)
+        if data.get('dry_run'):
+            return json_response(dict(execution.to_dict(), status='planned', rebalance=result))
         
-        result = RebalanceCalculator.calculate_rebalance(positions, target_weights, mode)
-        return jsonify(result)
+        execution, _ = order_executor.start(get_async_service(token, sandbox), execution)
+        return json_response(execution.to_dict(), status=202)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+
+@app.route('/api/orders/executions/<execution_id>', methods=['GET', 'DELETE'])
+def order_execution(execution_id):
+    """API состояния исполнения заявок; DELETE отменяет его невыполненные заявки"""
+    try:
+        token = get_user_token()
+        if not token:
+            return jsonify({'error': 'Не авторизован'}), 401
+        
+        execution = order_executor.get(session['user_id'], execution_id)
+        if execution is None:
+            return jsonify({'error': 'Исполнение не найдено'}), 404
+        
+        if request.method == 'DELETE':
+            order_executor.cancel(get_async_service(token, execution.sandbox), execution)
+        return json_response(execution.to_dict())
+    except Exception as e:
+        return error_response(e)
+
+
+def metrics_authorized():
+    """Доступ к метрикам: без METRICS_TOKEN открыт, иначе нужен заголовок Authorization: Bearer"""
+    if not METRICS_TOKEN:
+        return True
+    return secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики приложения в текстовом формате Prometheus"""
+    if not metrics_authorized():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def metrics_profile():
+    """
+    Профиль процесса в формате collapsed stacks
+    
+    POST {"enabled": true|false, "reset": true} включает или выключает
+    профилировщик и сбрасывает накопленные стеки. Без METRICS_TOKEN
+    эндпоинт отключен: профиль раскрывает код и нагружает воркер.
+    """
+    if not METRICS_TOKEN:
+        return jsonify({'error': 'Профилировщик отключен: не задан METRICS_TOKEN'}), 404
+    if not metrics_authorized():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if data.get('reset'):
+            profiler.reset()
+        if data.get('enabled') is True:
+            profiler.start()
+        elif data.get('enabled') is False:
+            profiler.stop()
+        return jsonify({'enabled': profiler.running})
+    
+    return Response(profiler.collapsed(), mimetype='text/plain')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,368 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, TimeoutError
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from grpc import StatusCode
+from tinkoff.invest import GetOperationsByCursorRequest, InstrumentIdType, OperationState, RequestError
+from client_pool import async_client_pool as default_async_client_pool
+from rate_limit import api_limiter as default_api_limiter
+from metrics import SERVICE_SECONDS, count_cache, observe_upstream
+from models import Portfolio
+from cost_model import half_spread
+from operations_store import OPERATIONS_PAGE_SIZE
+from tinkoff_service import (
+    INSTRUMENT_LOOKUP_WORKERS, aggregate_portfolios, build_accounts, build_operations, build_portfolio, instrument_info
+)
+
+
+# Максимальное время ожидания асинхронного запроса из обработчика Flask
+ASYNC_CALL_TIMEOUT = int(os.environ.get('ASYNC_CALL_TIMEOUT', 60))
+
+
+class BackgroundLoop:
+    """
+    Фоновый цикл событий процесса
+
+    Все асинхронные запросы к API воркера выполняются в одном цикле,
+    поэтому потоки Flask только ждут результат, а сетевой ввод-вывод
+    десятков пользователей мультиплексируется в одном потоке.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Цикл событий, запускается лениво (и заново после fork)"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+                self._pid = os.getpid()
+            return self._loop
+
+    def submit(self, coro) -> Future:
+        """Запускает корутину в фоновом цикле"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: int = ASYNC_CALL_TIMEOUT):
+        """Запускает корутину в фоновом цикле и ждет результат"""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+
+# Фоновый цикл процесса
+background_loop = BackgroundLoop()
+
+
+def run_async(coro, timeout: int = ASYNC_CALL_TIMEOUT):
+    """Выполняет корутину в фоновом цикле процесса и возвращает результат"""
+    return background_loop.run(coro, timeout)
+
+
+async def fetch_instruments_async(client, figis: List[str], limiter=None, token: str = None) -> Dict[str, Dict]:
+    """
+    Асинхронное получение информации об инструментах по списку FIGI
+
+    Args:
+        limiter: ApiLimiter, через который идут запросы (вместе с token)
+
+    Returns:
+        Dict figi -> {'name', 'ticker', 'type', 'lot'} для найденных инструментов
+    """
+    figis = list(dict.fromkeys(figi for figi in figis if figi))
+    if not figis:
+        return {}
+
+    semaphore = asyncio.Semaphore(INSTRUMENT_LOOKUP_WORKERS)
+
+    def request(figi: str):
+        return observe_upstream('get_instrument_by', client.instruments.get_instrument_by(
+            id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI, id=figi
+        ))
+
+    async def fetch(figi: str):
+        async with semaphore:
+            try:
+                if limiter:
+                    response = await limiter.call(token, 'instruments', lambda: request(figi))
+                else:
+                    response = await request(figi)
+                instrument = response.instrument
+            except Exception:
+                return figi, None
+        return figi, instrument_info(instrument)
+
+    results = await asyncio.gather(*(fetch(figi) for figi in figis))
+    return {figi: info for figi, info in results if info is not None}
+
+
+class AsyncTinkoffInvestService:
+    """Асинхронный сервис для работы с Tinkoff Invest API"""
+
+    def __init__(self, token: str, instrument_cache=None, client_pool=None, limiter=None, history=None,
+                 operations=None):
+        self.token = token
+        self.instrument_cache = instrument_cache
+        self.history = history
+        self.operations = operations
+        self.client_pool = client_pool or default_async_client_pool
+        self.limiter = limiter or default_api_limiter
+
+    async def _resolve_instruments(self, client, figis: List[str]) -> Dict[str, Dict]:
+        """Информация об инструментах: сначала из кэша, недостающее - из API"""
+        instruments = {}
+        if self.instrument_cache:
+            instruments = await asyncio.to_thread(self.instrument_cache.get_many, figis)
+
+        missing = [figi for figi in figis if figi and figi not in instruments]
+        count_cache('instruments', len(instruments), len(missing))
+        if missing:
+            fetched = await fetch_instruments_async(client, missing, self.limiter, self.token)
+            if self.instrument_cache:
+                await asyncio.to_thread(self.instrument_cache.put_many, fetched)
+            instruments.update(fetched)
+
+        return instruments
+
+    @SERVICE_SECONDS.time('get_accounts')
+    async def get_accounts(self) -> List[Dict]:
+        """Получить список счетов (одновременные запросы одного токена объединяются)"""
+        return await self.limiter.single_flight((self.token, 'get_accounts'), self._load_accounts)
+
+    async def _load_accounts(self) -> List[Dict]:
+        async with self.client_pool.client(self.token) as client:
+            return build_accounts(await self.limiter.call(
+                self.token, 'users', lambda: observe_upstream('get_accounts', client.users.get_accounts())
+            ))
+
+    @SERVICE_SECONDS.time('get_portfolio')
+    async def get_portfolio(self, account_id: str) -> Portfolio:
+        """Получить портфель по счету (одновременные запросы одного счета объединяются)"""
+        return await self.limiter.single_flight(
+            (self.token, 'get_portfolio', account_id), lambda: self._load_portfolio(account_id)
+        )
+
+    async def _load_portfolio(self, account_id: str) -> Portfolio:
+        async with self.client_pool.client(self.token) as client:
+            portfolio = await self.limiter.call(
+                self.token, 'operations',
+                lambda: observe_upstream('get_portfolio', client.operations.get_portfolio(account_id=account_id))
+            )
+
+            # Информацию обо всех инструментах получаем одним пакетом
+            instruments = await self._resolve_instruments(client, [position.figi for position in portfolio.positions])
+
+            result = build_portfolio(portfolio, instruments)
+
+        if self.history:
+            # История пополняется при каждой загрузке; неизменившийся портфель не записывается
+            await asyncio.to_thread(self.history.record, account_id, result)
+        return result
+
+    async def get_portfolios(self, account_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Получить портфели нескольких счетов параллельно
+
+        Returns:
+            Dict account_id -> портфель (или {'error': ...}, если счет не загрузился)
+        """
+        results = await asyncio.gather(
+            *(self.get_portfolio(account_id) for account_id in account_ids),
+            return_exceptions=True
+        )
+        return {
+            account_id: {'error': str(result)} if isinstance(result, Exception) else result
+            for account_id, result in zip(account_ids, results)
+        }
+
+    @SERVICE_SECONDS.time('get_all_portfolios')
+    async def get_all_portfolios(self) -> Dict:
+        """
+        Получить портфели всех счетов и сводный портфель
+
+        Портфели счетов загружаются параллельно, поэтому время ответа
+        определяется самым медленным счетом, а не суммой всех счетов.
+
+        Returns:
+            Dict с ключами 'accounts' (счета с портфелями) и 'aggregated' (сводный портфель)
+        """
+        accounts = await self.get_accounts()
+        portfolios = await self.get_portfolios([acc['id'] for acc in accounts])
+
+        return {
+            'accounts': [dict(acc, portfolio=portfolios[acc['id']]) for acc in accounts],
+            'aggregated': aggregate_portfolios(accounts, portfolios)
+        }
+
+    @SERVICE_SECONDS.time('sync_operations')
+    async def sync_operations(self, account_id: str) -> int:
+        """
+        Догружает новые операции счета в локальную историю (OperationsStore)
+
+        Одновременные синхронизации одного счета объединяются.
+
+        Returns:
+            Число новых операций
+        """
+        return await self.limiter.single_flight(
+            (self.token, 'sync_operations', account_id), lambda: self._sync_operations(account_id)
+        )
+
+    def _request_operations(self, client, account_id: str, window: Dict):
+        return observe_upstream('get_operations_by_cursor', client.operations.get_operations_by_cursor(
+            GetOperationsByCursorRequest(
+                account_id=account_id,
+                from_=window['from'],
+                to=window['to'],
+                cursor=window['cursor'],
+                limit=OPERATIONS_PAGE_SIZE,
+                state=OperationState.OPERATION_STATE_EXECUTED
+            )
+        ))
+
+    async def _sync_operations(self, account_id: str) -> int:
+        window = await asyncio.to_thread(self.operations.sync_window, account_id)
+        added = 0
+        async with self.client_pool.client(self.token) as client:
+            while True:
+                try:
+                    response = await self.limiter.call(
+                        self.token, 'operations', lambda: self._request_operations(client, account_id, window)
+                    )
+                except RequestError as e:
+                    if not window['cursor'] or e.code not in (StatusCode.INVALID_ARGUMENT, StatusCode.NOT_FOUND):
+                        raise
+                    # Курсор прерванной загрузки больше не принимается: окно загружается заново
+                    await asyncio.to_thread(self.operations.reset_cursor, account_id)
+                    window = await asyncio.to_thread(self.operations.sync_window, account_id)
+                    continue
+
+                # Страница и курсор следующей страницы сохраняются вместе
+                next_cursor = response.next_cursor if response.has_next else ''
+                added += await asyncio.to_thread(
+                    self.operations.save_page, account_id, build_operations(response.items), window, next_cursor
+                )
+                if not next_cursor:
+                    return added
+                window = dict(window, cursor=next_cursor)
+
+    async def _order_books(self, client, figis: List[str]) -> Dict[str, object]:
+        """Стаканы глубины 1 по инструментам, параллельно (без тех, что получить не удалось)"""
+        semaphore = asyncio.Semaphore(INSTRUMENT_LOOKUP_WORKERS)
+
+        async def fetch(figi: str):
+            async with semaphore:
+                try:
+                    return figi, await self.limiter.call(
+                        self.token, 'market_data',
+                        lambda: observe_upstream('get_order_book', client.market_data.get_order_book(figi=figi, depth=1))
+                    )
+                except Exception:
+                    return figi, None
+
+        order_books = await asyncio.gather(*map(fetch, figis))
+        return {figi: order_book for figi, order_book in order_books if order_book is not None}
+
+    @SERVICE_SECONDS.time('get_cost_inputs')
+    async def get_cost_inputs(self, figis: List[str]) -> Dict:
+        """
+        Параметры издержек для расчета ребалансировки
+
+        Тариф пользователя и лучшие заявки стаканов инструментов
+        запрашиваются параллельно.
+
+        Returns:
+            Dict: 'tariff' (None, если не получен) и 'half_spreads'
+            (figi -> половина относительного спреда для инструментов со стаканом)
+        """
+        async with self.client_pool.client(self.token) as client:
+            async def tariff():
+                try:
+                    info = await self.limiter.call(
+                        self.token, 'users', lambda: observe_upstream('get_info', client.users.get_info())
+                    )
+                    return info.tariff
+                except Exception as e:
+                    print(f"Ошибка при получении тарифа: {e}")
+                    return None
+
+            user_tariff, order_books = await asyncio.gather(tariff(), self._order_books(client, figis))
+
+        spreads = {figi: half_spread(order_book) for figi, order_book in order_books.items()}
+        return {
+            'tariff': user_tariff,
+            'half_spreads': {figi: value for figi, value in spreads.items() if value is not None}
+        }
+
+    @SERVICE_SECONDS.time('get_best_prices')
+    async def get_best_prices(self, figis: List[str]) -> Dict[str, Tuple[Optional[object], Optional[object]]]:
+        """
+        Лучшие цены стаканов инструментов
+
+        Returns:
+            Dict: figi -> (лучшая цена покупки, лучшая цена продажи) в виде
+            Quotation; None, если заявок на этой стороне стакана нет
+        """
+        async with self.client_pool.client(self.token) as client:
+            order_books = await self._order_books(client, figis)
+        return {
+            figi: (order_book.bids[0].price if order_book.bids else None,
+                   order_book.asks[0].price if order_book.asks else None)
+            for figi, order_book in order_books.items()
+        }
+
+    @SERVICE_SECONDS.time('post_order')
+    async def post_order(self, account_id: str, figi: str, lots: int, direction, order_type, order_id: str,
+                         price=None):
+        """
+        Выставить заявку
+
+        Args:
+            direction: OrderDirection
+            order_type: OrderType
+            order_id: Ключ идемпотентности: повторный запрос с ним не создает новую заявку,
+                поэтому запрос безопасно повторять после ошибки сети или лимита
+            price: Цена лимитной заявки (Quotation), для рыночной - None
+        """
+        async with self.client_pool.client(self.token) as client:
+            return await self.limiter.call(
+                self.token, 'orders',
+                lambda: observe_upstream('post_order', client.orders.post_order(
+                    figi=figi, quantity=lots, price=price, direction=direction, account_id=account_id,
+                    order_type=order_type, order_id=order_id
+                ))
+            )
+
+    async def get_order_state(self, account_id: str, order_id: str):
+        """Состояние заявки по ее биржевому идентификатору"""
+        async with self.client_pool.client(self.token) as client:
+            return await self.limiter.call(
+                self.token, 'orders',
+                lambda: observe_upstream('get_order_state', client.orders.get_order_state(
+                    account_id=account_id, order_id=order_id
+                ))
+            )
+
+    async def cancel_order(self, account_id: str, order_id: str):
+        """Отменить заявку по ее биржевому идентификатору"""
+        async with self.client_pool.client(self.token) as client:
+            return await self.limiter.call(
+                self.token, 'orders',
+                lambda: observe_upstream('cancel_order', client.orders.cancel_order(
+                    account_id=account_id, order_id=order_id
+                ))
+            )
+
+    async def order_states(self, account_ids: List[str]) -> AsyncIterator:
+        """Поток изменений заявок счетов (OrdersStreamService.OrderStateStream), включая пинги"""
+        async with self.client_pool.client(self.token) as client:
+            async for response in client.orders_stream.order_state_stream(accounts=account_ids):
+                yield response
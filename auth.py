@@ -1,9 +1,23 @@
 import os
-import sqlite3
 import hashlib
+import threading
+import time
+from collections import OrderedDict
 from cryptography.fernet import Fernet
-from typing import Optional
+from typing import List, Optional
 import secrets
+from metrics import DECRYPT_SECONDS, SQLITE_SECONDS, count_cache
+from sqlite_pool import DATABASE_PATH, SQLitePool
+
+
+# Сколько секунд расшифрованный токен хранится в памяти процесса
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 60))
+
+# Максимальное количество токенов в памяти процесса
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get('TOKEN_CACHE_MAX_SIZE', 1000))
+
+# Не чаще чем раз в столько секунд время активности пользователя записывается в базу
+USER_ACTIVITY_UPDATE_INTERVAL = int(os.environ.get('USER_ACTIVITY_UPDATE_INTERVAL', 60))
 
 
 class TokenEncryption:
@@ -32,121 +46,250 @@ class TokenEncryption:
         """Шифрует токен"""
         return self.cipher.encrypt(token.encode()).decode()
     
+    @DECRYPT_SECONDS.time()
     def decrypt(self, encrypted_token: str) -> str:
         """Дешифрует токен"""
         return self.cipher.decrypt(encrypted_token.encode()).decode()
 
 
+class TokenCache:
+    """
+    Кэш расшифрованных токенов в памяти процесса (session_id -> токен)
+
+    Позволяет не ходить в базу и не расшифровывать токен на каждый запрос.
+    Токены хранятся в bytearray и затираются нулями при удалении из кэша.
+    Записи живут не дольше TTL, поэтому изменения, сделанные другим
+    воркером, становятся видны не позже чем через TTL секунд.
+    """
+    
+    def __init__(self, ttl: int = TOKEN_CACHE_TTL, max_size: int = TOKEN_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Порядок вставки совпадает с порядком истечения срока жизни
+        self._tokens = OrderedDict()  # session_id -> (bytearray, expires_at)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _wipe(buffer: bytearray):
+        """Затирает содержимое буфера нулями"""
+        buffer[:] = bytes(len(buffer))
+    
+    def _evict(self, session_id: str):
+        buffer, _ = self._tokens.pop(session_id)
+        self._wipe(buffer)
+    
+    def _evict_expired(self, now: float):
+        while self._tokens:
+            session_id, (_, expires_at) = next(iter(self._tokens.items()))
+            if expires_at > now:
+                break
+            self._evict(session_id)
+    
+    def get(self, session_id: str) -> Optional[str]:
+        """Возвращает токен из кэша или None"""
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            entry = self._tokens.get(session_id)
+            return bytes(entry[0]).decode() if entry else None
+    
+    def put(self, session_id: str, token: str):
+        """Сохраняет токен в кэше"""
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        
+        now = time.monotonic()
+        with self._lock:
+            if session_id in self._tokens:
+                self._evict(session_id)
+            self._tokens[session_id] = (bytearray(token.encode()), now + self.ttl)
+            
+            self._evict_expired(now)
+            while len(self._tokens) > self.max_size:
+                self._evict(next(iter(self._tokens)))
+    
+    def invalidate(self, session_id: str):
+        """Удаляет токен пользователя из кэша"""
+        with self._lock:
+            if session_id in self._tokens:
+                self._evict(session_id)
+
+
 class UserDatabase:
     """Класс для работы с базой данных пользователей"""
     
     def __init__(self, db_path: str = None):
         if db_path is None:
-            db_path = os.path.join(os.path.dirname(__file__), 'users.db')
+            db_path = DATABASE_PATH
         
         self.db_path = db_path
+        self.pool = SQLitePool(db_path)
         self.encryption = TokenEncryption()
+        self.token_cache = TokenCache()
+        # Когда процесс последний раз записал активность пользователя (session_id -> monotonic)
+        self._activity = {}
+        self._activity_lock = threading.Lock()
         self._init_db()
     
     def _init_db(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT UNIQUE NOT NULL,
-                username TEXT,
-                encrypted_token TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        conn = self.pool.connection()
         
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT UNIQUE NOT NULL,
+                    username TEXT,
+                    encrypted_token TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Миграция: время последнего запроса добавлено позже остальных полей
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+            if 'last_seen' not in columns:
+                conn.execute('ALTER TABLE users ADD COLUMN last_seen TIMESTAMP')
+                conn.execute('UPDATE users SET last_seen = last_login')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)')
     
+    @SQLITE_SECONDS.time('users.upsert')
     def create_or_update_user(self, session_id: str, token: str, username: str = None) -> bool:
         """Создает нового пользователя или обновляет существующего"""
         try:
+            self.token_cache.invalidate(session_id)
             encrypted_token = self.encryption.encrypt(token)
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Проверяем, существует ли пользователь
-            cursor.execute('SELECT id FROM users WHERE session_id = ?', (session_id,))
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Обновляем существующего пользователя
-                cursor.execute('''
-                    UPDATE users 
-                    SET encrypted_token = ?, username = ?, last_login = CURRENT_TIMESTAMP
-                    WHERE session_id = ?
-                ''', (encrypted_token, username, session_id))
-            else:
-                # Создаем нового пользователя
-                cursor.execute('''
-                    INSERT INTO users (session_id, encrypted_token, username)
-                    VALUES (?, ?, ?)
+            conn = self.pool.connection()
+            with conn:
+                # Вставка или обновление одним запросом (UPSERT)
+                conn.execute('''
+                    INSERT INTO users (session_id, encrypted_token, username, last_seen)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        encrypted_token = excluded.encrypted_token,
+                        username = excluded.username,
+                        last_login = CURRENT_TIMESTAMP,
+                        last_seen = CURRENT_TIMESTAMP
                 ''', (session_id, encrypted_token, username))
+            # Параллельный get_token мог успеть закэшировать старый токен до коммита
+            self.token_cache.invalidate(session_id)
             
-            conn.commit()
-            conn.close()
             return True
         except Exception as e:
             print(f"Ошибка при создании/обновлении пользователя: {e}")
             return False
     
     def get_token(self, session_id: str) -> Optional[str]:
-        """Получает расшифрованный токен пользователя"""
+        """
+        Получает расшифрованный токен пользователя
+        
+        Один запрос одновременно проверяет существование пользователя:
+        для несуществующего пользователя возвращается None.
+        Расшифрованный токен кэшируется в памяти процесса.
+        """
+        token = self.token_cache.get(session_id)
+        count_cache('token', token is not None, token is None)
+        if token is not None:
+            return token
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT encrypted_token FROM users WHERE session_id = ?
-            ''', (session_id,))
-            
-            result = cursor.fetchone()
-            conn.close()
+            result = self._load_encrypted_token(session_id)
             
             if result:
                 encrypted_token = result[0]
-                return self.encryption.decrypt(encrypted_token)
+                token = self.encryption.decrypt(encrypted_token)
+                self.token_cache.put(session_id, token)
+                return token
             
             return None
         except Exception as e:
             print(f"Ошибка при получении токена: {e}")
             return None
     
+    @SQLITE_SECONDS.time('users.get_token')
+    def _load_encrypted_token(self, session_id: str) -> Optional[tuple]:
+        conn = self.pool.connection()
+        return conn.execute('''
+            SELECT encrypted_token FROM users WHERE session_id = ?
+        ''', (session_id,)).fetchone()
+    
+    @SQLITE_SECONDS.time('users.delete')
     def delete_user(self, session_id: str) -> bool:
         """Удаляет пользователя"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            self.token_cache.invalidate(session_id)
+            with self._activity_lock:
+                self._activity.pop(session_id, None)
             
-            cursor.execute('DELETE FROM users WHERE session_id = ?', (session_id,))
+            conn = self.pool.connection()
+            with conn:
+                conn.execute('DELETE FROM users WHERE session_id = ?', (session_id,))
+            # Параллельный get_token мог успеть закэшировать токен до коммита
+            self.token_cache.invalidate(session_id)
             
-            conn.commit()
-            conn.close()
             return True
         except Exception as e:
             print(f"Ошибка при удалении пользователя: {e}")
             return False
     
+    def mark_active(self, session_id: str):
+        """
+        Отмечает активность пользователя
+        
+        Запись в базу делается не чаще раза в USER_ACTIVITY_UPDATE_INTERVAL
+        секунд на пользователя, поэтому частые запросы не нагружают базу.
+        """
+        now = time.monotonic()
+        with self._activity_lock:
+            updated = self._activity.get(session_id)
+            if updated is not None and now - updated < USER_ACTIVITY_UPDATE_INTERVAL:
+                return
+            self._activity[session_id] = now
+            if len(self._activity) > TOKEN_CACHE_MAX_SIZE:
+                self._activity = {
+                    key: value for key, value in self._activity.items()
+                    if now - value < USER_ACTIVITY_UPDATE_INTERVAL
+                }
+        
+        try:
+            self._touch(session_id)
+        except Exception as e:
+            print(f"Ошибка при обновлении активности пользователя: {e}")
+    
+    @SQLITE_SECONDS.time('users.mark_active')
+    def _touch(self, session_id: str):
+        conn = self.pool.connection()
+        with conn:
+            conn.execute('UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE session_id = ?', (session_id,))
+    
+    @SQLITE_SECONDS.time('users.active_users')
+    def active_users(self, window: int, limit: int = None) -> List[str]:
+        """
+        Пользователи, которые входили или делали запросы за последние window секунд
+        
+        Returns:
+            Список session_id, начиная с самых недавно активных
+        """
+        try:
+            conn = self.pool.connection()
+            rows = conn.execute('''
+                SELECT session_id FROM users
+                WHERE last_seen >= datetime('now', ?)
+                ORDER BY last_seen DESC
+                LIMIT ?
+            ''', (f'-{window} seconds', -1 if limit is None else limit)).fetchall()
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"Ошибка при получении активных пользователей: {e}")
+            return []
+    
+    @SQLITE_SECONDS.time('users.exists')
     def user_exists(self, session_id: str) -> bool:
         """Проверяет существование пользователя"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT id FROM users WHERE session_id = ?', (session_id,))
-            result = cursor.fetchone()
-            
-            conn.close()
+            conn = self.pool.connection()
+            result = conn.execute('SELECT 1 FROM users WHERE session_id = ?', (session_id,)).fetchone()
             return result is not None
         except Exception as e:
             print(f"Ошибка при проверке пользователя: {e}")
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарки горячих участков приложения
+
+Запуск:
+    python benchmarks.py            # все бенчмарки
+    python benchmarks.py quotation  # только выбранные
+
+Данные синтетические, обращений к API нет.
+"""
+import json
+import random
+import sys
+import timeit
+import tracemalloc
+from decimal import Decimal
+from types import SimpleNamespace
+import numpy as np
+from cost_model import CostModel
+from models import Position, to_json_compatible
+from rebalance_engine import RebalanceEngine
+from serialization import COMPRESSORS, SERIALIZERS, dumps
+from tinkoff_service import NANO, build_portfolio, nano_mul, nano_to_float, quotation_to_nano
+
+
+def make_quotation(value: float, currency: str = None) -> SimpleNamespace:
+    """Quotation (или MoneyValue, если указана валюта) из числа"""
+    nano = round(value * NANO)
+    units = int(nano / NANO)
+    quotation = SimpleNamespace(units=units, nano=nano - units * NANO)
+    if currency:
+        quotation.currency = currency
+    return quotation
+
+
+def make_portfolio(size: int) -> SimpleNamespace:
+    """Ответ get_portfolio со случайными позициями"""
+    rng = random.Random(size)
+    positions = [
+        SimpleNamespace(
+            figi=f'FIGI{i:06d}',
+            quantity=make_quotation(rng.randint(1, 5000)),
+            current_price=make_quotation(rng.uniform(0.01, 20000), 'rub')
+        )
+        for i in range(size)
+    ]
+    return SimpleNamespace(positions=positions, total_amount_portfolio=make_quotation(1_000_000.5, 'rub'))
+
+
+def decimal_value(quantity, price) -> float:
+    """Прежний путь: три Decimal на число и перевод во float"""
+    q = Decimal(quantity.units) + Decimal(quantity.nano) / Decimal(1_000_000_000)
+    p = Decimal(price.units) + Decimal(price.nano) / Decimal(1_000_000_000)
+    return float(q * p)
+
+
+def fixed_point_value(quantity, price) -> float:
+    """Путь с фиксированной точкой"""
+    return nano_to_float(nano_mul(quotation_to_nano(quantity), quotation_to_nano(price)))
+
+
+def report(name: str, baseline: float, candidate: float, unit: str):
+    print(f"  {name:<28} было {baseline:10.2f} {unit}, стало {candidate:10.2f} {unit}, "
+          f"ускорение x{baseline / candidate:.1f}")
+
+
+def bench_quotation():
+    """Перевод Quotation в число: Decimal против фиксированной точки"""
+    portfolio = make_portfolio(1000)
+    pairs = [(pos.quantity, pos.current_price) for pos in portfolio.positions]
+
+    # Оба пути дают одно и то же значение с точностью до нано
+    for quantity, price in pairs:
+        assert abs(decimal_value(quantity, price) - fixed_point_value(quantity, price)) < 1e-6
+
+    number = 20
+    baseline = timeit.timeit(lambda: [decimal_value(q, p) for q, p in pairs], number=number)
+    candidate = timeit.timeit(lambda: [fixed_point_value(q, p) for q, p in pairs], number=number)
+    per_call = 1e9 / (number * len(pairs))
+    report('стоимость позиции', baseline * per_call, candidate * per_call, 'нс')
+
+    prices = [price for _, price in pairs]
+    baseline = timeit.timeit(
+        lambda: [float(Decimal(p.units) + Decimal(p.nano) / Decimal(1_000_000_000)) for p in prices], number=number
+    )
+    candidate = timeit.timeit(lambda: [nano_to_float(quotation_to_nano(p)) for p in prices], number=number)
+    report('цена из Quotation', baseline * per_call, candidate * per_call, 'нс')
+
+
+def bench_build_portfolio():
+    """Сборка ответа портфеля на 500 позиций"""
+    portfolio = make_portfolio(500)
+    instruments = {}
+    number = 50
+    elapsed = timeit.timeit(lambda: build_portfolio(portfolio, instruments), number=number)
+    print(f"  {'build_portfolio (500 позиций)':<28} {elapsed / number * 1000:.2f} мс")
+
+
+def allocated(factory) -> int:
+    """Сколько байт памяти выделено под результат factory()"""
+    tracemalloc.start()
+    result = factory()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_models():
+    """Снимок портфеля на 1000 позиций: словари против моделей со __slots__"""
+    portfolio = build_portfolio(make_portfolio(1000), {})
+    dicts = [position.to_dict() for position in portfolio.positions]
+
+    # Значения полей общие, поэтому сравнивается только память контейнеров
+    baseline = allocated(lambda: [position.to_dict() for position in portfolio.positions])
+    candidate = allocated(lambda: [Position.from_dict(data) for data in dicts])
+    print(f"  {'память позиций':<28} словари {baseline / 1024:.0f} КБ, модели {candidate / 1024:.0f} КБ "
+          f"(x{baseline / candidate:.1f} меньше)")
+
+    data = portfolio.to_dict()
+    number = 50
+    baseline = timeit.timeit(lambda: json.dumps(data, ensure_ascii=False), number=number)
+    candidate = timeit.timeit(lambda: json.dumps(portfolio, default=to_json_compatible, ensure_ascii=False), number=number)
+    print(f"  {'JSON снимка':<28} словари {baseline / number * 1000:.2f} мс, модели {candidate / number * 1000:.2f} мс "
+          f"(один раз на снимок)")
+
+
+def bench_serialization():
+    """Сериализация и сжатие снимка портфеля на 1000 позиций"""
+    portfolio = build_portfolio(make_portfolio(1000), {})
+    number = 50
+
+    # Прежний путь: jsonify по словарям через стандартный json
+    data = portfolio.to_dict()
+    baseline = timeit.timeit(lambda: json.dumps(data).encode(), number=number) / number * 1000
+    print(f"  {'json.dumps (словари)':<28} {baseline:.2f} мс")
+
+    for name, serializer in SERIALIZERS.items():
+        elapsed = timeit.timeit(lambda: serializer(portfolio), number=number) / number * 1000
+        print(f"  {name:<28} {elapsed:.2f} мс, x{baseline / elapsed:.1f}")
+
+    body = dumps(portfolio)
+    print(f"  {'без сжатия':<28} {len(body) / 1024:.0f} КБ")
+    for name, compress in COMPRESSORS.items():
+        elapsed = timeit.timeit(lambda: compress(body), number=10) / 10 * 1000
+        print(f"  {name:<28} {len(compress(body)) / 1024:.0f} КБ за {elapsed:.2f} мс")
+
+
+def bench_rebalance():
+    """Ребалансировка в лотах портфеля на 100 позиций без издержек и с издержками"""
+    positions = build_portfolio(make_portfolio(100), {}).positions
+    engine = RebalanceEngine(positions)
+    rng = random.Random(100)
+    weights = np.array([rng.uniform(0.5, 1.5) for _ in positions])
+    weights = weights / weights.sum() * 100
+    selected = np.ones(len(positions), dtype=bool)
+
+    # Лоты куплены дешевле и дороже текущей цены, чтобы налог зависел от порядка FIFO
+    lots = {
+        position.figi: [(position.quantity / 2, position.current_value / 2 * 0.8),
+                        (position.quantity / 2, position.current_value / 2 * 1.1)]
+        for position in positions
+    }
+    half_spreads = {position.figi: rng.uniform(0, 0.005) for position in positions}
+    elapsed = timeit.timeit(lambda: CostModel(engine, 0.003, half_spreads, lots), number=20) / 20 * 1000
+    print(f"  {'модель издержек':<28} {elapsed:.2f} мс")
+    costs = CostModel(engine, 0.003, half_spreads, lots)
+
+    number = 10
+    for mode, budget in (('buy_only', 100_000.0), ('buy_and_sell', 0.0)):
+        for name, model in (('без издержек', None), ('с издержками', costs)):
+            elapsed = timeit.timeit(lambda: engine.solve_lots(weights, selected, mode, budget, model), number=number)
+            print(f"  {mode + ', ' + name:<28} {elapsed / number * 1000:.2f} мс")
+
+
+BENCHMARKS = {
+    'quotation': bench_quotation,
+    'portfolio': bench_build_portfolio,
+    'models': bench_models,
+    'serialization': bench_serialization,
+    'rebalance': bench_rebalance,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        benchmark = BENCHMARKS[name]
+        print(f"{name}: {benchmark.__doc__}")
+        benchmark()
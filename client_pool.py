@@ -0,0 +1,194 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict
+from tinkoff.invest import AsyncClient, Client
+
+
+# Через сколько секунд простоя канал к API закрывается
+GRPC_CHANNEL_IDLE_TIMEOUT = int(os.environ.get('GRPC_CHANNEL_IDLE_TIMEOUT', 300))
+
+# Адрес API (host:port); по умолчанию - боевой сервер, для нагрузочных тестов - fake_api.py
+TINKOFF_API_TARGET = os.environ.get('TINKOFF_API_TARGET', '')
+
+# Параметры создания клиентов API
+API_CLIENT_OPTIONS = {'target': TINKOFF_API_TARGET} if TINKOFF_API_TARGET else {}
+
+# Адрес песочницы: заявки исполняются на виртуальных счетах без реальных сделок
+TINKOFF_SANDBOX_TARGET = os.environ.get('TINKOFF_SANDBOX_TARGET', 'sandbox-invest-public-api.tinkoff.ru:443')
+
+# Параметры создания клиентов песочницы
+SANDBOX_CLIENT_OPTIONS = {'target': TINKOFF_SANDBOX_TARGET}
+
+
+class _PooledClient:
+    """Открытый клиент API вместе со счетчиками использования"""
+
+    __slots__ = ('client', 'services', 'in_use', 'last_used')
+
+    def __init__(self, client, services):
+        self.client = client
+        self.services = services
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class ClientPool:
+    """
+    Пул открытых клиентов Tinkoff Invest API, по одному на токен
+
+    gRPC-канал потокобезопасен, поэтому все потоки воркера используют
+    общий канал на токен, а TLS-рукопожатие выполняется один раз.
+    Простаивающие каналы закрываются фоновым потоком.
+    """
+
+    def __init__(self, idle_timeout: int = GRPC_CHANNEL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._clients: Dict[str, _PooledClient] = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reaper = None
+
+    def _check_fork(self):
+        """После fork каналы родительского процесса использовать нельзя"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._clients = {}
+            self._reaper = threading.Thread(target=self._reap_idle, daemon=True)
+            self._reaper.start()
+
+    @contextmanager
+    def client(self, token: str):
+        """Выдает клиент для токена, открывая канал при необходимости"""
+        with self._lock:
+            self._check_fork()
+            entry = self._clients.get(token)
+            if entry is None:
+                client = Client(token, **API_CLIENT_OPTIONS)
+                entry = _PooledClient(client, client.__enter__())
+                self._clients[token] = entry
+            entry.in_use += 1
+
+        try:
+            yield entry.services
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+
+    def _reap_idle(self):
+        """Фоновый поток: закрывает каналы, простаивающие дольше таймаута"""
+        interval = max(1, min(60, self.idle_timeout // 2))
+        while True:
+            time.sleep(interval)
+            self.close_idle()
+
+    def close_idle(self, idle_timeout: int = None) -> int:
+        """Закрывает неиспользуемые каналы, простаивающие дольше таймаута"""
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                token for token, entry in self._clients.items()
+                if entry.in_use == 0 and now - entry.last_used >= idle_timeout
+            ]
+            entries = [self._clients.pop(token) for token in idle]
+
+        for entry in entries:
+            try:
+                entry.client.__exit__(None, None, None)
+            except Exception as e:
+                print(f"Ошибка при закрытии канала API: {e}")
+
+        return len(entries)
+
+    def close_all(self) -> int:
+        """Закрывает все неиспользуемые каналы"""
+        return self.close_idle(idle_timeout=0)
+
+
+class AsyncClientPool:
+    """
+    Пул открытых асинхронных клиентов API, по одному на токен
+
+    Асинхронный канал привязан к циклу событий, поэтому пул используется
+    только из фонового цикла процесса (см. async_service.BackgroundLoop).
+    """
+
+    def __init__(self, idle_timeout: int = GRPC_CHANNEL_IDLE_TIMEOUT, options: Dict = None):
+        """
+        Args:
+            idle_timeout: Через сколько секунд простоя канал закрывается
+            options: Параметры создания клиентов (по умолчанию - API_CLIENT_OPTIONS)
+        """
+        self.idle_timeout = idle_timeout
+        self.options = API_CLIENT_OPTIONS if options is None else options
+        self._clients: Dict[str, _PooledClient] = {}
+        self._lock = None
+        self._pid = None
+        self._reaper = None
+
+    def _check_fork(self):
+        """После fork каналы и цикл событий родителя использовать нельзя"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._clients = {}
+            self._lock = asyncio.Lock()
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_idle())
+
+    @asynccontextmanager
+    async def client(self, token: str):
+        """Выдает асинхронный клиент для токена, открывая канал при необходимости"""
+        self._check_fork()
+        entry = self._clients.get(token)
+        if entry is None:
+            async with self._lock:
+                entry = self._clients.get(token)
+                if entry is None:
+                    client = AsyncClient(token, **self.options)
+                    entry = _PooledClient(client, await client.__aenter__())
+                    self._clients[token] = entry
+        entry.in_use += 1
+
+        try:
+            yield entry.services
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    async def _reap_idle(self):
+        """Фоновая задача: закрывает каналы, простаивающие дольше таймаута"""
+        interval = max(1, min(60, self.idle_timeout // 2))
+        while True:
+            await asyncio.sleep(interval)
+            await self.close_idle()
+
+    async def close_idle(self, idle_timeout: int = None) -> int:
+        """Закрывает неиспользуемые каналы, простаивающие дольше таймаута"""
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+
+        now = time.monotonic()
+        idle = [
+            token for token, entry in self._clients.items()
+            if entry.in_use == 0 and now - entry.last_used >= idle_timeout
+        ]
+        entries = [self._clients.pop(token) for token in idle]
+
+        for entry in entries:
+            try:
+                await entry.client.__aexit__(None, None, None)
+            except Exception as e:
+                print(f"Ошибка при закрытии канала API: {e}")
+
+        return len(entries)
+
+
+# Пулы клиентов процесса
+client_pool = ClientPool()
+async_client_pool = AsyncClientPool()
+sandbox_async_client_pool = AsyncClientPool(options=SANDBOX_CLIENT_OPTIONS)
@@ -0,0 +1,145 @@
+import os
+from typing import Dict, List, Optional, Tuple, Union
+import numpy as np
+from tinkoff_service import quotation_to_nano
+
+
+# Налог с положительного финансового результата продажи (НДФЛ)
+REBALANCE_TAX_RATE = float(os.environ.get('REBALANCE_TAX_RATE', 0.13))
+
+# Сколько п.п.² суммы квадратов отклонений долей стоят издержки в 1% портфеля
+REBALANCE_COST_AVERSION = float(os.environ.get('REBALANCE_COST_AVERSION', 1.0))
+
+# Комиссия брокера по тарифам (доля суммы сделки) и для неизвестного тарифа
+COMMISSION_RATES = {'investor': 0.003, 'trader': 0.0005, 'premium': 0.0004}
+DEFAULT_COMMISSION_RATE = float(os.environ.get('REBALANCE_COMMISSION_RATE', 0.003))
+
+# Сколько секунд тариф и спреды стакана переиспользуются между расчетами
+COST_MODEL_TTL = int(os.environ.get('COST_MODEL_TTL', 300))
+
+
+def commission_rate(tariff: Optional[str]) -> float:
+    """Комиссия за сделку по тарифу пользователя (users.get_info().tariff)"""
+    return COMMISSION_RATES.get((tariff or '').lower(), DEFAULT_COMMISSION_RATE)
+
+
+def half_spread(order_book) -> Optional[float]:
+    """
+    Половина спреда лучших заявок стакана относительно середины
+
+    Относительная величина не зависит от единиц цены, поэтому подходит
+    и для облигаций, цена которых в стакане - в процентах от номинала.
+    """
+    if not order_book.bids or not order_book.asks:
+        return None
+    bid = quotation_to_nano(order_book.bids[0].price)
+    ask = quotation_to_nano(order_book.asks[0].price)
+    if bid <= 0 or ask < bid:
+        return None
+    return (ask - bid) / (ask + bid)
+
+
+class CostModel:
+    """
+    Издержки сделок по позициям RebalanceEngine: комиссия, спред и налог
+
+    Параметры переводятся в массивы в порядке позиций движка один раз,
+    поэтому при поиске решения издержки шага для всех позиций считаются
+    векторно. Покупка лота стоит buy_cash (по цене продавца с комиссией),
+    продажа приносит sell_cash (по цене покупателя за вычетом комиссии).
+
+    Себестоимость бумаг по FIFO хранится кусочно-линейной функцией C(q) -
+    стоимость первых q бумаг позиции. Функции всех позиций лежат на одной
+    оси со сдвигом offsets, поэтому себестоимость очередного продаваемого
+    лота для всех позиций считается одним вызовом np.interp. Бумаги без
+    истории покупок считаются купленными по текущей цене (без дохода).
+    Налог считается с результата продажи позиции: убыток одних лотов
+    уменьшает доход других, но отрицательным налог не становится.
+    """
+
+    def __init__(self, engine, commission: Union[float, Dict[str, float]] = DEFAULT_COMMISSION_RATE,
+                 half_spreads: Dict[str, float] = None, lots: Dict[str, List[Tuple[float, float]]] = None,
+                 tax_rate: float = REBALANCE_TAX_RATE):
+        """
+        Args:
+            engine: RebalanceEngine, по позициям которого строится модель
+            commission: Комиссия (доля суммы сделки), общая или по FIGI
+            half_spreads: Половина относительного спреда по FIGI
+            lots: Открытые лоты по FIGI от самых старых: (количество бумаг, стоимость)
+            tax_rate: Ставка налога на доход от продажи
+        """
+        half_spreads = half_spreads or {}
+        lots = lots or {}
+        if isinstance(commission, dict):
+            rates = [commission.get(figi, DEFAULT_COMMISSION_RATE) for figi in engine.figis]
+        else:
+            rates = [commission] * len(engine.figis)
+
+        self.tax_rate = tax_rate
+        self.commission = np.array(rates, dtype=np.float64)
+        self.half_spreads = np.array([half_spreads.get(figi) or 0.0 for figi in engine.figis], dtype=np.float64)
+        self.lot_sizes = engine.lot_sizes
+        self.lot_values = engine.prices * engine.lot_sizes
+        self.buy_cash = self.lot_values * (1 + self.half_spreads) * (1 + self.commission)
+        self.sell_cash = self.lot_values * (1 - self.half_spreads) * (1 - self.commission)
+
+        # Точки функций себестоимости; между позициями - зазор, чтобы ось возрастала
+        offsets = np.zeros(len(engine.figis), dtype=np.float64)
+        curve_x, curve_y = [], []
+        offset = 0.0
+        for column, figi in enumerate(engine.figis):
+            holdings = float(engine.holdings[column])
+            offsets[column] = offset
+            curve_x.append(offset)
+            curve_y.append(0.0)
+
+            quantity, cost = 0.0, 0.0
+            for lot_quantity, lot_cost in lots.get(figi, ()):
+                take = min(lot_quantity, holdings - quantity)
+                if take <= 0:
+                    break
+                quantity += take
+                cost += lot_cost * take / lot_quantity
+                curve_x.append(offset + quantity)
+                curve_y.append(cost)
+
+            if quantity < holdings:
+                cost += (holdings - quantity) * float(engine.prices[column])
+                quantity = holdings
+                curve_x.append(offset + quantity)
+                curve_y.append(cost)
+
+            offset += quantity + 1.0
+
+        self.offsets = offsets
+        self.curve_x = np.array(curve_x, dtype=np.float64)
+        self.curve_y = np.array(curve_y, dtype=np.float64)
+
+    def tax(self, sold_lots: np.ndarray) -> np.ndarray:
+        """Налог с продажи sold_lots первых по FIFO лотов каждой позиции (массив любой формы)"""
+        if not self.tax_rate:
+            return np.zeros(np.shape(sold_lots), dtype=np.float64)
+        basis = np.interp(self.offsets + sold_lots * self.lot_sizes, self.curve_x, self.curve_y)
+        return self.tax_rate * np.maximum(sold_lots * self.sell_cash - basis, 0.0)
+
+    def sell_tax(self, sold_lots: np.ndarray) -> np.ndarray:
+        """Прирост налога при продаже следующего лота каждой позиции, если sold_lots лотов уже проданы"""
+        return self.tax(sold_lots + 1) - self.tax(sold_lots)
+
+    def trade_costs(self, lots: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Издержки итоговых сделок по позициям
+
+        Args:
+            lots: Изменение позиций в лотах (покупки > 0, продажи < 0)
+
+        Returns:
+            Dict массивов 'commission', 'spread' и 'tax'
+        """
+        traded = np.abs(lots) * self.lot_values
+        sides = np.where(lots > 0, 1 + self.half_spreads, 1 - self.half_spreads)
+        return {
+            'commission': traded * sides * self.commission,
+            'spread': traded * self.half_spreads,
+            'tax': self.tax(np.maximum(-lots, 0))
+        }
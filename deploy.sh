@@ -73,6 +73,8 @@ create_service() {
     
     CURRENT_USER=$(whoami)
     CURRENT_DIR=$(pwd)
+    # Потоков на воркер gunicorn; от этого числа считается лимит потоков цен (SSE)
+    GUNICORN_THREADS=${GUNICORN_THREADS:-16}
     
     sudo tee /etc/systemd/system/tinkoff-rebalancer.service > /dev/null <<EOF
 [Unit]
@@ -85,9 +87,12 @@ User=$CURRENT_USER
 WorkingDirectory=$CURRENT_DIR
 Environment="PATH=$CURRENT_DIR/venv/bin"
 Environment="PORT=5001"
+Environment="GUNICORN_THREADS=$GUNICORN_THREADS"
 
 ExecStart=$CURRENT_DIR/venv/bin/gunicorn \\
     --workers 2 \\
+    --worker-class gthread \\
+    --threads $GUNICORN_THREADS \\
     --bind 0.0.0.0:5001 \\
     --timeout 120 \\
     --access-logfile $CURRENT_DIR/access.log \\
@@ -90,6 +90,7 @@ def check_imports():
         ('flask', 'Flask'),
         ('tinkoff.invest', 'Tinkoff Invest SDK'),
         ('cryptography', 'Cryptography'),
+        ('numpy', 'NumPy'),
     ]
     
     all_ok = True
@@ -0,0 +1,584 @@
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from models import Position
+from sqlite_pool import DATABASE_PATH, SQLitePool
+
+
+# Порог отклонения доли позиции от целевой по умолчанию (процентные пункты)
+DRIFT_DEFAULT_THRESHOLD = float(os.environ.get('DRIFT_DEFAULT_THRESHOLD', 5))
+
+# Сколько последних пересечений порога хранится по счету
+DRIFT_EVENTS_MAX = int(os.environ.get('DRIFT_EVENTS_MAX', 100))
+
+# Максимальное количество отслеживаемых счетов в памяти процесса
+DRIFT_TRACKERS_MAX = int(os.environ.get('DRIFT_TRACKERS_MAX', 1000))
+
+# Состояния позиции относительно полосы допустимого отклонения
+OVER = 'over'
+WITHIN = 'within'
+UNDER = 'under'
+
+
+class TargetStore:
+    """
+    Целевые доли и порог отклонения по паре (пользователь, счет) в SQLite
+
+    Там же хранятся пересечения порога, поэтому их видят все воркеры
+    и они переживают перезапуск.
+    """
+
+    def __init__(self, db_path: str = None):
+        if db_path is None:
+            db_path = DATABASE_PATH
+
+        self.db_path = db_path
+        self.pool = SQLitePool(db_path)
+        self._init_db()
+
+    def _init_db(self):
+        """Инициализация таблицы целевых долей"""
+        conn = self.pool.connection()
+
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS target_allocations (
+                    session_id TEXT NOT NULL,
+                    account_id TEXT NOT NULL,
+                    target_weights TEXT NOT NULL,
+                    threshold REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (session_id, account_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS drift_events (
+                    session_id TEXT NOT NULL,
+                    account_id TEXT NOT NULL,
+                    figi TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    weight REAL NOT NULL,
+                    target_weight REAL NOT NULL,
+                    drift REAL NOT NULL,
+                    ts REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_drift_events_account
+                ON drift_events (session_id, account_id, ts)
+            ''')
+
+    def get(self, user_id: str, account_id: str) -> Optional[Dict]:
+        """Целевые доли счета: {'target_weights', 'threshold', 'updated_at'} или None"""
+        try:
+            conn = self.pool.connection()
+            row = conn.execute('''
+                SELECT target_weights, threshold, updated_at FROM target_allocations
+                WHERE session_id = ? AND account_id = ?
+            ''', (user_id, account_id)).fetchone()
+        except Exception as e:
+            print(f"Ошибка при чтении целевых долей: {e}")
+            return None
+
+        if row is None:
+            return None
+        return {'target_weights': json.loads(row[0]), 'threshold': row[1], 'updated_at': row[2]}
+
+    def put(self, user_id: str, account_id: str, target_weights: Dict[str, float], threshold: float) -> Dict:
+        """Сохраняет целевые доли счета"""
+        targets = {'target_weights': target_weights, 'threshold': threshold, 'updated_at': time.time()}
+        conn = self.pool.connection()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO target_allocations (session_id, account_id, target_weights, threshold, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, account_id, json.dumps(target_weights), threshold, targets['updated_at']))
+        return targets
+
+    def delete(self, user_id: str, account_id: str):
+        """Удаляет целевые доли и пересечения порога счета"""
+        conn = self.pool.connection()
+        with conn:
+            conn.execute('DELETE FROM target_allocations WHERE session_id = ? AND account_id = ?',
+                         (user_id, account_id))
+            conn.execute('DELETE FROM drift_events WHERE session_id = ? AND account_id = ?',
+                         (user_id, account_id))
+
+    def add_events(self, user_id: str, account_id: str, events: List[Dict]):
+        """
+        Сохраняет пересечения порога счета (не больше DRIFT_EVENTS_MAX последних)
+
+        Одно и то же пересечение могут заметить несколько воркеров, поэтому
+        событие не записывается, если последнее событие позиции имеет то же состояние.
+        """
+        conn = self.pool.connection()
+        with conn:
+            for event in events:
+                conn.execute('''
+                    INSERT INTO drift_events (session_id, account_id, figi, state, weight, target_weight, drift, ts)
+                    SELECT ?, ?, ?, ?, ?, ?, ?, ?
+                    WHERE COALESCE((
+                        SELECT state FROM drift_events
+                        WHERE session_id = ? AND account_id = ? AND figi = ?
+                        ORDER BY ts DESC LIMIT 1
+                    ), ?) != ?
+                ''', (user_id, account_id, event['figi'], event['state'], event['weight'], event['target_weight'],
+                      event['drift'], event['ts'], user_id, account_id, event['figi'], WITHIN, event['state']))
+            conn.execute('''
+                DELETE FROM drift_events WHERE rowid IN (
+                    SELECT rowid FROM drift_events WHERE session_id = ? AND account_id = ?
+                    ORDER BY ts DESC LIMIT -1 OFFSET ?
+                )
+            ''', (user_id, account_id, DRIFT_EVENTS_MAX))
+
+    def events(self, user_id: str, account_id: str, since: float = None) -> List[Dict]:
+        """Пересечения порога счета по времени (since - только после этого Unix-времени)"""
+        try:
+            conn = self.pool.connection()
+            rows = conn.execute('''
+                SELECT figi, state, weight, target_weight, drift, ts FROM drift_events
+                WHERE session_id = ? AND account_id = ? AND ts > ?
+                ORDER BY ts
+            ''', (user_id, account_id, since if since is not None else -math.inf)).fetchall()
+        except Exception as e:
+            print(f"Ошибка при чтении пересечений порога: {e}")
+            return []
+
+        return [
+            {'figi': figi, 'state': state, 'weight': weight, 'target_weight': target_weight, 'drift': drift, 'ts': ts}
+            for figi, state, weight, target_weight, drift, ts in rows
+        ]
+
+    def delete_user(self, user_id: str):
+        """Удаляет целевые доли и пересечения порога всех счетов пользователя"""
+        try:
+            conn = self.pool.connection()
+            with conn:
+                conn.execute('DELETE FROM target_allocations WHERE session_id = ?', (user_id,))
+                conn.execute('DELETE FROM drift_events WHERE session_id = ?', (user_id,))
+        except Exception as e:
+            print(f"Ошибка при удалении целевых долей: {e}")
+
+
+class DriftTracker:
+    """
+    Инкрементальная оценка отклонения портфеля от целевых долей
+
+    Как и в RebalanceCalculator, доли считаются среди позиций с целевыми
+    долями, остальные позиции портфеля не учитываются.
+
+    Позиция i находится в полосе, если |v_i / T - t_i| <= h, где v_i - стоимость
+    позиции, T - суммарная стоимость этих позиций, t_i - целевая доля, h - порог. Это то же,
+    что lo_i <= T <= hi_i, где lo_i = v_i / (t_i + h), hi_i = v_i / (t_i - h)
+    (бесконечность при t_i <= h). Границы позиции зависят только от ее
+    стоимости, поэтому при изменении цены или количества пересчитываются
+    границы только измененных позиций, а позиции, которые пересекла новая
+    стоимость портфеля T, достаются из куч по границам. Работа на обновление -
+    O((k + m) log n), где k - измененные позиции, m - сменившие состояние.
+    Обновления приходят снимками портфеля (update_positions передает в update
+    только изменившиеся позиции) и отдельными ценами из потока рыночных
+    данных (update_prices).
+
+    Не потокобезопасен: вызовы синхронизирует DriftMonitor.
+    """
+
+    def __init__(self, target_weights: Dict[str, float], threshold: float, values: Dict[str, float],
+                 targets_updated_at: float = None, quantities: Dict[str, float] = None):
+        """
+        Args:
+            target_weights: Целевые доли в процентах (FIGI -> %)
+            threshold: Порог отклонения в процентных пунктах
+            values: Текущие стоимости позиций (FIGI -> стоимость)
+            targets_updated_at: Время сохранения целевых долей
+            quantities: Количество бумаг позиций, стоимость которых
+                пересчитывается по цене (FIGI -> количество)
+        """
+        self.target_weights = {figi: float(weight) for figi, weight in target_weights.items()}
+        self.threshold = threshold
+        self.targets_updated_at = targets_updated_at
+
+        self._h = threshold / 100
+        self._values: Dict[str, float] = {}
+        self._held = set()  # позиции с ненулевой стоимостью
+        self._quantities = {figi: quantity for figi, quantity in (quantities or {}).items()
+                            if figi in self.target_weights}
+        self._bounds: Dict[str, tuple] = {}  # figi -> (lo, hi)
+        self._state: Dict[str, str] = {}
+        self._version: Dict[str, int] = {}
+        self._breaches = set()
+        # Кучи границ с ленивым удалением: записи (граница, figi, версия)
+        self._within_low = []  # max-куча lo позиций в полосе (T упадет ниже - перевес)
+        self._within_high = []  # min-куча hi позиций в полосе (T вырастет выше - недовес)
+        self._over = []  # min-куча lo позиций с перевесом
+        self._under = []  # max-куча hi позиций с недовесом
+        self._total = 0.0
+
+        for figi in self.target_weights:
+            self._values[figi] = float(values.get(figi, 0.0))
+            self._total += self._values[figi]
+            if self._values[figi]:
+                self._held.add(figi)
+        for figi in self._values:
+            self._set_bounds(figi)
+            self._classify(figi)
+
+    @property
+    def total(self) -> float:
+        return self._total
+
+    def priced_figis(self) -> List[str]:
+        """Позиции, стоимость которых можно пересчитывать по цене из потока"""
+        return list(self._quantities)
+
+    def _set_bounds(self, figi: str):
+        value = self._values[figi]
+        target = self.target_weights.get(figi, 0.0) / 100
+        lo = value / (target + self._h)
+        hi = value / (target - self._h) if target > self._h else math.inf
+        self._bounds[figi] = (lo, hi)
+        self._version[figi] = self._version.get(figi, 0) + 1
+
+    def _classify(self, figi: str) -> Optional[Dict]:
+        """
+        Определяет состояние позиции и ставит в кучи границы его смены
+
+        Returns:
+            Событие пересечения порога, если состояние изменилось
+        """
+        lo, hi = self._bounds[figi]
+        version = self._version[figi]
+        total = self._total
+
+        if total < lo:
+            state = OVER
+            heapq.heappush(self._over, (lo, figi, version))
+        elif total > hi:
+            state = UNDER
+            heapq.heappush(self._under, (-hi, figi, version))
+        else:
+            state = WITHIN
+            heapq.heappush(self._within_low, (-lo, figi, version))
+            if hi != math.inf:
+                heapq.heappush(self._within_high, (hi, figi, version))
+
+        previous = self._state.get(figi)
+        self._state[figi] = state
+        if state == WITHIN:
+            self._breaches.discard(figi)
+        else:
+            self._breaches.add(figi)
+        if previous is not None and previous != state:
+            return self._event(figi, state)
+        return None
+
+    def _pop_crossed(self, heap: List, crossed) -> List[str]:
+        """Достает из кучи позиции, чью границу пересекла стоимость портфеля"""
+        figis = []
+        while heap:
+            bound, figi, version = heap[0]
+            if self._version.get(figi) != version:
+                heapq.heappop(heap)
+            elif crossed(bound):
+                heapq.heappop(heap)
+                figis.append(figi)
+            else:
+                break
+        return figis
+
+    def _compact(self):
+        """Убирает из куч устаревшие записи, когда их становится слишком много"""
+        limit = 4 * len(self._values) + 64
+        for name in ('_within_low', '_within_high', '_over', '_under'):
+            heap = getattr(self, name)
+            if len(heap) > limit:
+                heap = [entry for entry in heap if self._version.get(entry[1]) == entry[2]]
+                heapq.heapify(heap)
+                setattr(self, name, heap)
+
+    def update(self, values: Dict[str, float]) -> List[Dict]:
+        """
+        Применяет новые стоимости позиций (FIGI -> стоимость)
+
+        Returns:
+            Пересечения порога, вызванные обновлением
+        """
+        changed = {figi for figi, value in values.items() if figi in self._values and self._values[figi] != value}
+        if not changed:
+            return []
+
+        for figi in changed:
+            self._total += values[figi] - self._values.get(figi, 0.0)
+            self._values[figi] = float(values[figi])
+            if self._values[figi]:
+                self._held.add(figi)
+            else:
+                self._held.discard(figi)
+            self._set_bounds(figi)
+        total = self._total
+
+        # Позиции, которые сменили состояние из-за новой стоимости портфеля
+        crossed = set(changed)
+        crossed.update(self._pop_crossed(self._within_low, lambda bound: total < -bound))
+        crossed.update(self._pop_crossed(self._within_high, lambda bound: total > bound))
+        crossed.update(self._pop_crossed(self._over, lambda bound: total >= bound))
+        crossed.update(self._pop_crossed(self._under, lambda bound: total <= -bound))
+
+        events = []
+        for figi in crossed:
+            if figi not in changed:
+                # Остальные записи позиции в кучах больше недействительны
+                self._version[figi] += 1
+            event = self._classify(figi)
+            if event:
+                events.append(event)
+
+        self._compact()
+        return events
+
+    def update_positions(self, positions: List[Position]) -> List[Dict]:
+        """
+        Применяет позиции свежего снимка портфеля
+
+        В update передаются только позиции, чья стоимость изменилась, и
+        проданные позиции (их стоимость обнуляется).
+        """
+        values = {}
+        present = set()
+        for pos in positions:
+            figi = pos.figi
+            if figi not in self._values:
+                continue
+            present.add(figi)
+            if pos.type == 'bond':
+                # Цена облигации в рыночных данных - в процентах от номинала
+                self._quantities.pop(figi, None)
+            else:
+                self._quantities[figi] = pos.quantity
+            if self._values[figi] != pos.current_value:
+                values[figi] = pos.current_value
+        for figi in self._held - present:
+            values[figi] = 0.0
+            self._quantities.pop(figi, None)
+        return self.update(values) if values else []
+
+    def update_prices(self, prices: Dict[str, float]) -> List[Dict]:
+        """Пересчитывает стоимость позиций по новым ценам (FIGI -> цена)"""
+        values = {figi: self._quantities[figi] * price for figi, price in prices.items() if figi in self._quantities}
+        return self.update(values) if values else []
+
+    def _weight(self, figi: str) -> float:
+        return self._values[figi] / self._total * 100 if self._total else 0.0
+
+    def _event(self, figi: str, state: str) -> Dict:
+        weight = self._weight(figi)
+        target = self.target_weights.get(figi, 0.0)
+        return {
+            'figi': figi,
+            'state': state,
+            'weight': round(weight, 4),
+            'target_weight': target,
+            'drift': round(weight - target, 4),
+            'ts': time.time()
+        }
+
+    def breaches(self) -> List[Dict]:
+        """Позиции, вышедшие за порог (O(числа нарушений))"""
+        return sorted((self._event(figi, self._state[figi]) for figi in self._breaches),
+                      key=lambda event: -abs(event['drift']))
+
+    def positions(self) -> List[Dict]:
+        """Текущие и целевые доли всех позиций"""
+        return [
+            {
+                'figi': figi,
+                'weight': round(self._weight(figi), 4),
+                'target_weight': self.target_weights.get(figi, 0.0),
+                'drift': round(self._weight(figi) - self.target_weights.get(figi, 0.0), 4),
+                'state': self._state[figi]
+            }
+            for figi in self._values
+        ]
+
+
+class _TrackerListener:
+    """Получатель цен из потока рыночных данных для трекера счета"""
+
+    __slots__ = ('monitor', 'key', 'token', 'figis')
+
+    def __init__(self, monitor: 'DriftMonitor', key: tuple, token: str):
+        self.monitor = monitor
+        self.key = key
+        self.token = token
+        self.figis = set()
+
+    def put_nowait(self, item):
+        # None - поток токена закрыт (выход пользователя)
+        if item is not None:
+            self.monitor.on_price(self.key, *item)
+
+
+class DriftMonitor:
+    """
+    Отслеживание отклонения портфелей от сохраненных целевых долей
+
+    Трекеры (DriftTracker) держатся в памяти процесса по паре (пользователь,
+    счет) и обновляются свежими снимками портфелей (при загрузке страницы,
+    фоновой предзагрузке и переоценке по ценам хаба), а если передан
+    stream_hub - еще и каждой новой ценой позиций из потока рыночных данных.
+    Целевые доли и пересечения порога хранятся в базе (TargetStore) и общие
+    для всех воркеров.
+    """
+
+    def __init__(self, store: TargetStore, max_size: int = DRIFT_TRACKERS_MAX, stream_hub=None):
+        """
+        Args:
+            stream_hub: Подписка на цены (price_stream.PriceStreamHub); без нее
+                трекеры обновляются только снимками
+        """
+        self.store = store
+        self.max_size = max_size
+        self.stream_hub = stream_hub
+        self._trackers = OrderedDict()  # (user_id, account_id) -> DriftTracker
+        self._listeners: Dict[tuple, _TrackerListener] = {}
+        self._lock = threading.Lock()
+
+    def set_targets(self, user_id: str, account_id: str, target_weights: Dict[str, float],
+                    threshold: float, positions: List[Position], token: str = None) -> DriftTracker:
+        """
+        Сохраняет целевые доли и создает трекер по текущим позициям
+
+        Args:
+            token: Токен пользователя для подписки на цены позиций
+        """
+        targets = self.store.put(user_id, account_id, target_weights, threshold)
+        return self._build(user_id, account_id, targets, positions, token)
+
+    def delete_targets(self, user_id: str, account_id: str):
+        """Удаляет целевые доли, пересечения порога и трекер счета"""
+        self.store.delete(user_id, account_id)
+        with self._lock:
+            self._trackers.pop((user_id, account_id), None)
+            listeners = [self._listeners.pop((user_id, account_id), None)]
+        self._unwatch(listeners)
+
+    def invalidate_user(self, user_id: str):
+        """Удаляет трекеры пользователя из памяти"""
+        with self._lock:
+            keys = [key for key in self._trackers if key[0] == user_id]
+            for key in keys:
+                del self._trackers[key]
+            listeners = [self._listeners.pop(key, None) for key in keys]
+        self._unwatch(listeners)
+
+    def events(self, user_id: str, account_id: str, since: float = None) -> List[Dict]:
+        """Пересечения порога счета, замеченные любым воркером"""
+        return self.store.events(user_id, account_id, since)
+
+    def _build(self, user_id: str, account_id: str, targets: Dict, positions: List[Position],
+               token: str = None) -> DriftTracker:
+        tracker = DriftTracker(targets['target_weights'], targets['threshold'],
+                               {pos.figi: pos.current_value for pos in positions}, targets['updated_at'],
+                               {pos.figi: pos.quantity for pos in positions if pos.type != 'bond'})
+        key = (user_id, account_id)
+        with self._lock:
+            self._trackers[key] = tracker
+            self._trackers.move_to_end(key)
+            evicted = []
+            while len(self._trackers) > self.max_size:
+                evicted.append(self._trackers.popitem(last=False)[0])
+            listeners = [self._listeners.pop(evicted_key, None) for evicted_key in evicted]
+        self._unwatch(listeners)
+        self._watch(key, tracker, token)
+        return tracker
+
+    def _watch(self, key: tuple, tracker: DriftTracker, token: str = None):
+        """Подписывает трекер на цены позиций, которые у него появились"""
+        if self.stream_hub is None:
+            return
+        with self._lock:
+            listener = self._listeners.get(key)
+            if listener is None:
+                if not token or self._trackers.get(key) is not tracker:
+                    return
+                listener = self._listeners[key] = _TrackerListener(self, key, token)
+            added = [figi for figi in tracker.priced_figis() if figi not in listener.figis]
+            listener.figis.update(added)
+        # Вне блокировки: известные цены приходят в on_price сразу при подписке
+        if added:
+            self.stream_hub.subscribe(listener.token, added, listener=listener)
+
+    def _unwatch(self, listeners: List[Optional[_TrackerListener]]):
+        for listener in listeners:
+            if listener is not None and self.stream_hub is not None:
+                self.stream_hub.unsubscribe(listener.token, listener, list(listener.figis))
+
+    def _record(self, key: tuple, events: List[Dict]):
+        """Сохраняет пересечения порога в базе"""
+        if not events:
+            return
+        try:
+            self.store.add_events(key[0], key[1], events)
+        except Exception as e:
+            print(f"Ошибка при сохранении пересечений порога: {e}")
+
+    def tracker(self, user_id: str, account_id: str, positions: List[Position],
+                token: str = None) -> Optional[DriftTracker]:
+        """
+        Трекер счета, обновленный позициями
+
+        Если целевые доли изменил другой воркер, трекер создается заново.
+
+        Args:
+            token: Токен пользователя для подписки на цены позиций
+
+        Returns:
+            None, если для счета не заданы целевые доли
+        """
+        key = (user_id, account_id)
+        targets = self.store.get(user_id, account_id)
+        if targets is None:
+            with self._lock:
+                self._trackers.pop(key, None)
+                listeners = [self._listeners.pop(key, None)]
+            self._unwatch(listeners)
+            return None
+
+        with self._lock:
+            tracker = self._trackers.get(key)
+            if tracker is not None and tracker.targets_updated_at >= targets['updated_at']:
+                self._trackers.move_to_end(key)
+                events = tracker.update_positions(positions)
+            else:
+                tracker = None
+        if tracker is None:
+            return self._build(user_id, account_id, targets, positions, token)
+        self._record(key, events)
+        self._watch(key, tracker, token)
+        return tracker
+
+    def on_snapshot(self, user_id: str, account_id: str, positions: List[Position]) -> List[Dict]:
+        """Обновляет трекер счета свежими позициями, если счет отслеживается"""
+        key = (user_id, account_id)
+        with self._lock:
+            tracker = self._trackers.get(key)
+            if tracker is None:
+                return []
+            events = tracker.update_positions(positions)
+        self._record(key, events)
+        self._watch(key, tracker)
+        return events
+
+    def on_price(self, key: tuple, figi: str, price: float) -> List[Dict]:
+        """Пересчитывает трекер счета по новой цене позиции из потока рыночных данных"""
+        with self._lock:
+            tracker = self._trackers.get(key)
+            if tracker is None:
+                return []
+            events = tracker.update_prices({figi: price})
+        self._record(key, events)
+        return events
@@ -0,0 +1,539 @@
+"""
+Локальная замена Tinkoff Invest API для нагрузочных тестов
+
+gRPC-сервер реализует методы, которые вызывает приложение:
+UsersService.GetAccounts и GetInfo, OperationsService.GetPortfolio,
+InstrumentsService.GetInstrumentBy, MarketDataService.GetOrderBook,
+OrdersService (PostOrder, GetOrderState, CancelOrder) и поток
+OrdersStreamService.OrderStateStream. Данные синтетические и
+детерминированные для каждого токена, задержка ответа настраивается.
+Заявки идемпотентны по order_id: рыночные исполняются сразу, лимитные
+около текущей цены - через FAKE_API_FILL_DELAY, остальные ждут отмены.
+Сервер работает по TLS с самоподписанным сертификатом, поэтому клиенты
+SDK подключаются к нему без изменений. Запуск:
+
+    python fake_api.py --port 50051 --positions 200 --latency 30
+
+и для приложения:
+
+    export TINKOFF_API_TARGET=localhost:50051
+    export GRPC_DEFAULT_SSL_ROOTS_FILE_PATH=<путь к сертификату из вывода>
+
+Нагрузочный тест (loadtest.py) запускает сервер сам.
+"""
+import argparse
+import asyncio
+import datetime
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, deque
+from typing import Dict, List, Tuple
+import grpc
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from tinkoff.invest.grpc import (
+    common_pb2, instruments_pb2, instruments_pb2_grpc, marketdata_pb2, marketdata_pb2_grpc, operations_pb2,
+    operations_pb2_grpc, orders_pb2, orders_pb2_grpc, users_pb2, users_pb2_grpc
+)
+
+
+# Число позиций на счете и счетов на токен
+FAKE_API_POSITIONS = int(os.environ.get('FAKE_API_POSITIONS', 50))
+FAKE_API_ACCOUNTS = int(os.environ.get('FAKE_API_ACCOUNTS', 2))
+
+# Средняя задержка ответа и ее разброс (миллисекунды)
+FAKE_API_LATENCY = float(os.environ.get('FAKE_API_LATENCY', 20))
+FAKE_API_JITTER = float(os.environ.get('FAKE_API_JITTER', 5))
+
+# Лимит запросов в минуту на токен и сервис (0 - без лимита)
+FAKE_API_RATE_LIMIT = int(os.environ.get('FAKE_API_RATE_LIMIT', 0))
+
+# Через сколько миллисекунд исполняется лимитная заявка по встречной цене
+FAKE_API_FILL_DELAY = float(os.environ.get('FAKE_API_FILL_DELAY', 200))
+
+NANO = 1_000_000_000
+
+# Типы инструментов по остатку номера FIGI от деления на 10
+INSTRUMENT_TYPES = ['share'] * 6 + ['etf'] * 3 + ['bond']
+
+# Шаг цены инструментов (спред стакана - два шага)
+PRICE_STEP = 0.01
+
+# Насколько лимитная цена может быть хуже текущей, чтобы заявка исполнилась
+# (цена меняется во времени и успевает сдвинуться после запроса стакана)
+LIMIT_FILL_TOLERANCE = 0.005
+
+FINAL_REPORT_STATUSES = (
+    orders_pb2.EXECUTION_REPORT_STATUS_FILL,
+    orders_pb2.EXECUTION_REPORT_STATUS_REJECTED,
+    orders_pb2.EXECUTION_REPORT_STATUS_CANCELLED,
+)
+
+
+def generate_certificate(directory: str, host: str = 'localhost') -> Tuple[str, str]:
+    """
+    Самоподписанный сертификат для TLS-сервера
+
+    Returns:
+        Пути к сертификату и закрытому ключу
+    """
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(host)]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_path = os.path.join(directory, 'fake_api.crt')
+    key_path = os.path.join(directory, 'fake_api.key')
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ))
+    os.chmod(key_path, 0o600)
+    return cert_path, key_path
+
+
+def _quotation(value: float) -> common_pb2.Quotation:
+    nano = round(value * NANO)
+    units = int(nano / NANO)
+    return common_pb2.Quotation(units=units, nano=nano - units * NANO)
+
+
+def _nano(quotation) -> int:
+    return quotation.units * NANO + quotation.nano
+
+
+def _money(value: float, currency: str = 'rub') -> common_pb2.MoneyValue:
+    quotation = _quotation(value)
+    return common_pb2.MoneyValue(currency=currency, units=quotation.units, nano=quotation.nano)
+
+
+def fake_figi(index: int) -> str:
+    return f'FAKE{index:08d}'
+
+
+class FakeInvestApi:
+    """
+    Состояние фейкового API: данные, задержки, лимиты и счетчики вызовов
+
+    Счетчик calls (метод -> число вызовов) позволяет нагрузочному тесту
+    посчитать, сколько запросов к API вызвал каждый эндпоинт приложения.
+    """
+
+    def __init__(self, positions: int = FAKE_API_POSITIONS, accounts: int = FAKE_API_ACCOUNTS,
+                 latency: float = FAKE_API_LATENCY, jitter: float = FAKE_API_JITTER,
+                 rate_limit: int = FAKE_API_RATE_LIMIT, fill_delay: float = FAKE_API_FILL_DELAY):
+        """
+        Args:
+            latency: Средняя задержка ответа (миллисекунды)
+            jitter: Разброс задержки (миллисекунды)
+            rate_limit: Запросов в минуту на токен и сервис (0 - без лимита)
+            fill_delay: Задержка исполнения лимитной заявки (миллисекунды)
+        """
+        self.positions = positions
+        self.accounts = accounts
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.rate_limit = rate_limit
+        self.fill_delay = fill_delay / 1000
+        self.calls = Counter()
+        self._requests: Dict[tuple, deque] = {}
+        self._quantities: Dict[tuple, List[float]] = {}
+        # Заявки по (токен, order_id клиента) и по (токен, биржевой идентификатор)
+        self._orders: Dict[tuple, Dict] = {}
+        self._orders_by_id: Dict[tuple, Dict] = {}
+        # Подписки потоков состояний заявок: (токен, счета, очередь)
+        self._order_streams: List[tuple] = []
+        self._lock = threading.Lock()
+        self.port = None
+        self._loop = None
+        self._server = None
+
+    def snapshot_calls(self) -> Counter:
+        """Копия счетчиков вызовов"""
+        with self._lock:
+            return Counter(self.calls)
+
+    @staticmethod
+    def _token(context) -> str:
+        for key, value in context.invocation_metadata():
+            if key == 'authorization':
+                return value.split(' ', 1)[-1]
+        return ''
+
+    async def handle(self, method: str, service: str, context) -> str:
+        """Учитывает вызов, проверяет лимит и выдерживает задержку; возвращает токен"""
+        token = self._token(context)
+        if not token:
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, 'token is missing')
+
+        now = time.monotonic()
+        limited = False
+        with self._lock:
+            self.calls[method] += 1
+            if self.rate_limit:
+                window = self._requests.setdefault((token, service), deque())
+                while window and now - window[0] >= 60:
+                    window.popleft()
+                if len(window) >= self.rate_limit:
+                    reset = math.ceil(60 - (now - window[0]))
+                    self.calls['RESOURCE_EXHAUSTED'] += 1
+                    limited = True
+                else:
+                    window.append(now)
+        if limited:
+            context.set_trailing_metadata((('x-ratelimit-reset', str(reset)),))
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'rate limit exceeded')
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return token
+
+    def account_ids(self, token: str) -> List[str]:
+        seed = zlib.crc32(token.encode())
+        return [f'{seed:010d}{index:02d}' for index in range(self.accounts)]
+
+    @staticmethod
+    def price(index: int) -> float:
+        """Цена инструмента, медленно колеблющаяся во времени"""
+        if INSTRUMENT_TYPES[index % 10] == 'bond':
+            return 95 + index % 10
+        base = 10 + (index * 7919) % 5000
+        return round(base * (1 + 0.01 * math.sin(time.time() / 60 + index)), 2)
+
+    def holdings(self, token: str, account_id: str) -> List[Tuple[int, float]]:
+        """Номера инструментов и количества на счете"""
+        key = (token, account_id)
+        quantities = self._quantities.get(key)
+        if quantities is None:
+            rng = random.Random(f'{token}:{account_id}')
+            quantities = [float(rng.randint(1, 100) * (10 if i % 3 else 1)) for i in range(self.positions)]
+            self._quantities[key] = quantities
+        offset = (int(account_id[-2:]) * self.positions) // 2
+        return [(offset + i, quantity) for i, quantity in enumerate(quantities)]
+
+    def instrument(self, index: int) -> instruments_pb2.Instrument:
+        instrument_type = INSTRUMENT_TYPES[index % 10]
+        return instruments_pb2.Instrument(
+            figi=fake_figi(index),
+            ticker=f'T{index}',
+            class_code='FAKE',
+            name=f'Инструмент {index}',
+            instrument_type=instrument_type,
+            lot=1 if instrument_type == 'bond' else (1, 10, 100)[index % 3],
+            currency='rub'
+        )
+
+    def portfolio(self, token: str, account_id: str) -> operations_pb2.PortfolioResponse:
+        positions = []
+        total = cash = 10_000.0
+        for index, quantity in self.holdings(token, account_id):
+            price = self.price(index)
+            total += price * quantity
+            positions.append(operations_pb2.PortfolioPosition(
+                figi=fake_figi(index),
+                instrument_type=INSTRUMENT_TYPES[index % 10],
+                quantity=_quotation(quantity),
+                current_price=_money(price)
+            ))
+        return operations_pb2.PortfolioResponse(
+            account_id=account_id,
+            positions=positions,
+            total_amount_currencies=_money(cash),
+            total_amount_portfolio=_money(total)
+        )
+
+    def order_book(self, index: int) -> marketdata_pb2.GetOrderBookResponse:
+        """Стакан глубины 1 вокруг текущей цены"""
+        price = self.price(index)
+        return marketdata_pb2.GetOrderBookResponse(
+            figi=fake_figi(index),
+            depth=1,
+            bids=[marketdata_pb2.Order(price=_quotation(price - PRICE_STEP), quantity=1000)],
+            asks=[marketdata_pb2.Order(price=_quotation(price + PRICE_STEP), quantity=1000)],
+            last_price=_quotation(price)
+        )
+
+    def post_order(self, token: str, request) -> Dict:
+        """
+        Выставляет заявку или возвращает уже выставленную с тем же order_id
+
+        Рыночная заявка исполняется сразу, лимитная около текущей цены -
+        через fill_delay, остальные лимитные ждут отмены.
+        """
+        key = (token, request.order_id)
+        with self._lock:
+            order = self._orders.get(key) if request.order_id else None
+            if order is not None:
+                self.calls['post_order_duplicate'] += 1
+                return order
+
+        index = int((request.instrument_id or request.figi)[4:])
+        order = {
+            'id': uuid.uuid4().hex,
+            'request_id': request.order_id,
+            'token': token,
+            'account_id': request.account_id,
+            'index': index,
+            'direction': request.direction,
+            'order_type': request.order_type,
+            'lots': request.quantity,
+            'lots_executed': 0,
+            'executed_price': 0.0,
+            'status': orders_pb2.EXECUTION_REPORT_STATUS_NEW
+        }
+        with self._lock:
+            if request.order_id:
+                self._orders[key] = order
+            self._orders_by_id[(token, order['id'])] = order
+
+        if request.order_type == orders_pb2.ORDER_TYPE_MARKET:
+            self._fill(order)
+        else:
+            price = _nano(request.price) / NANO
+            current = self.price(index)
+            if request.direction == orders_pb2.ORDER_DIRECTION_BUY:
+                marketable = price >= current * (1 - LIMIT_FILL_TOLERANCE)
+            else:
+                marketable = price <= current * (1 + LIMIT_FILL_TOLERANCE)
+            if marketable:
+                asyncio.get_running_loop().call_later(self.fill_delay, self._fill, order)
+        return order
+
+    def find_order(self, token: str, order_id: str) -> Dict:
+        with self._lock:
+            return self._orders_by_id.get((token, order_id))
+
+    def _fill(self, order: Dict):
+        """Исполняет заявку по текущей цене и меняет позицию счета"""
+        if order['status'] in FINAL_REPORT_STATUSES:
+            return
+        lot = self.instrument(order['index']).lot
+        sign = 1 if order['direction'] == orders_pb2.ORDER_DIRECTION_BUY else -1
+        quantities = self._quantities.get((order['token'], order['account_id']))
+        if quantities is not None:
+            position = order['index'] - (int(order['account_id'][-2:]) * self.positions) // 2
+            if 0 <= position < len(quantities):
+                quantities[position] = max(quantities[position] + sign * order['lots'] * lot, 0.0)
+
+        order['executed_price'] = self.price(order['index'])
+        order['lots_executed'] = order['lots']
+        order['status'] = orders_pb2.EXECUTION_REPORT_STATUS_FILL
+        self.publish(order)
+
+    def cancel_order(self, order: Dict) -> bool:
+        if order['status'] in FINAL_REPORT_STATUSES:
+            return False
+        order['status'] = orders_pb2.EXECUTION_REPORT_STATUS_CANCELLED
+        self.publish(order)
+        return True
+
+    def publish(self, order: Dict):
+        """Отправляет состояние заявки подписанным потокам ее счета"""
+        response = orders_pb2.OrderStateStreamResponse(order_state=orders_pb2.OrderStateStreamResponse.OrderState(
+            order_id=order['id'],
+            order_request_id=order['request_id'],
+            execution_report_status=order['status'],
+            direction=order['direction'],
+            order_type=order['order_type'],
+            account_id=order['account_id'],
+            executed_order_price=_money(order['executed_price']),
+            lots_requested=order['lots'],
+            lots_executed=order['lots_executed']
+        ))
+        for token, accounts, queue in list(self._order_streams):
+            if token == order['token'] and order['account_id'] in accounts:
+                queue.put_nowait(response)
+
+    @staticmethod
+    def order_state(order: Dict) -> orders_pb2.OrderState:
+        return orders_pb2.OrderState(
+            order_id=order['id'],
+            order_request_id=order['request_id'],
+            execution_report_status=order['status'],
+            lots_requested=order['lots'],
+            lots_executed=order['lots_executed'],
+            executed_order_price=_money(order['executed_price']),
+            figi=fake_figi(order['index']),
+            direction=order['direction'],
+            order_type=order['order_type']
+        )
+
+    def _add_services(self, server):
+        api = self
+
+        class UsersService(users_pb2_grpc.UsersServiceServicer):
+            async def GetAccounts(self, request, context):
+                token = await api.handle('get_accounts', 'users', context)
+                return users_pb2.GetAccountsResponse(accounts=[
+                    users_pb2.Account(id=account_id, type=1, name=f'Счет {index + 1}', status=2, access_level=1)
+                    for index, account_id in enumerate(api.account_ids(token))
+                ])
+
+            async def GetInfo(self, request, context):
+                await api.handle('get_info', 'users', context)
+                return users_pb2.GetInfoResponse(tariff='trader')
+
+        class OperationsService(operations_pb2_grpc.OperationsServiceServicer):
+            async def GetPortfolio(self, request, context):
+                token = await api.handle('get_portfolio', 'operations', context)
+                if request.account_id not in api.account_ids(token):
+                    await context.abort(grpc.StatusCode.NOT_FOUND, 'account not found')
+                return api.portfolio(token, request.account_id)
+
+        class InstrumentsService(instruments_pb2_grpc.InstrumentsServiceServicer):
+            async def GetInstrumentBy(self, request, context):
+                await api.handle('get_instrument_by', 'instruments', context)
+                if not request.id.startswith('FAKE'):
+                    await context.abort(grpc.StatusCode.NOT_FOUND, 'instrument not found')
+                return instruments_pb2.InstrumentResponse(instrument=api.instrument(int(request.id[4:])))
+
+        class MarketDataService(marketdata_pb2_grpc.MarketDataServiceServicer):
+            async def GetOrderBook(self, request, context):
+                await api.handle('get_order_book', 'market_data', context)
+                figi = request.instrument_id or request.figi
+                if not figi.startswith('FAKE'):
+                    await context.abort(grpc.StatusCode.NOT_FOUND, 'instrument not found')
+                return api.order_book(int(figi[4:]))
+
+        class OrdersService(orders_pb2_grpc.OrdersServiceServicer):
+            async def PostOrder(self, request, context):
+                token = await api.handle('post_order', 'orders', context)
+                if request.account_id not in api.account_ids(token):
+                    await context.abort(grpc.StatusCode.NOT_FOUND, 'account not found')
+                if not (request.instrument_id or request.figi).startswith('FAKE'):
+                    await context.abort(grpc.StatusCode.NOT_FOUND, 'instrument not found')
+                order = api.post_order(token, request)
+                return orders_pb2.PostOrderResponse(
+                    order_id=order['id'],
+                    order_request_id=order['request_id'],
+                    execution_report_status=order['status'],
+                    lots_requested=order['lots'],
+                    lots_executed=order['lots_executed'],
+                    executed_order_price=_money(order['executed_price']),
+                    figi=fake_figi(order['index']),
+                    direction=order['direction'],
+                    order_type=order['order_type']
+                )
+
+            async def GetOrderState(self, request, context):
+                token = await api.handle('get_order_state', 'orders', context)
+                order = api.find_order(token, request.order_id)
+                if order is None:
+                    await context.abort(grpc.StatusCode.NOT_FOUND, 'order not found')
+                return api.order_state(order)
+
+            async def CancelOrder(self, request, context):
+                token = await api.handle('cancel_order', 'orders', context)
+                order = api.find_order(token, request.order_id)
+                if order is None:
+                    await context.abort(grpc.StatusCode.NOT_FOUND, 'order not found')
+                if not api.cancel_order(order):
+                    await context.abort(grpc.StatusCode.FAILED_PRECONDITION, 'order is not active')
+                return orders_pb2.CancelOrderResponse()
+
+        class OrdersStreamService(orders_pb2_grpc.OrdersStreamServiceServicer):
+            async def OrderStateStream(self, request, context):
+                token = await api.handle('order_state_stream', 'orders_stream', context)
+                subscription = (token, set(request.accounts), asyncio.Queue())
+                api._order_streams.append(subscription)
+                try:
+                    # Первое сообщение подтверждает подписку
+                    yield orders_pb2.OrderStateStreamResponse(ping=common_pb2.Ping())
+                    while True:
+                        yield await subscription[2].get()
+                finally:
+                    api._order_streams.remove(subscription)
+
+        users_pb2_grpc.add_UsersServiceServicer_to_server(UsersService(), server)
+        operations_pb2_grpc.add_OperationsServiceServicer_to_server(OperationsService(), server)
+        instruments_pb2_grpc.add_InstrumentsServiceServicer_to_server(InstrumentsService(), server)
+        marketdata_pb2_grpc.add_MarketDataServiceServicer_to_server(MarketDataService(), server)
+        orders_pb2_grpc.add_OrdersServiceServicer_to_server(OrdersService(), server)
+        orders_pb2_grpc.add_OrdersStreamServiceServicer_to_server(OrdersStreamService(), server)
+
+    async def serve(self, port: int, cert_path: str, key_path: str, started: threading.Event = None):
+        """Запускает сервер (порт 0 - любой свободный, см. self.port) и работает до его остановки"""
+        with open(cert_path, 'rb') as f:
+            certificate = f.read()
+        with open(key_path, 'rb') as f:
+            key = f.read()
+
+        self._server = grpc.aio.server()
+        self._add_services(self._server)
+        self.port = self._server.add_secure_port(
+            f'localhost:{port}', grpc.ssl_server_credentials([(key, certificate)])
+        )
+        await self._server.start()
+        if started:
+            started.set()
+        await self._server.wait_for_termination()
+
+    def start(self, port: int = 0, cert_dir: str = None) -> Tuple[str, str]:
+        """
+        Запускает сервер в фоновом потоке
+
+        Returns:
+            Адрес сервера (host:port) и путь к сертификату для
+            GRPC_DEFAULT_SSL_ROOTS_FILE_PATH
+        """
+        cert_path, key_path = generate_certificate(cert_dir or tempfile.mkdtemp(prefix='fake_api_'))
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def run():
+            self._loop.run_until_complete(self.serve(port, cert_path, key_path, started))
+
+        threading.Thread(target=run, daemon=True).start()
+        if not started.wait(10):
+            raise RuntimeError('Фейковый API не запустился')
+        return f'localhost:{self.port}', cert_path
+
+    def stop(self):
+        """Останавливает сервер, запущенный start()"""
+        if self._server and self._loop:
+            asyncio.run_coroutine_threadsafe(self._server.stop(None), self._loop).result(5)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная замена Tinkoff Invest API')
+    parser.add_argument('--port', type=int, default=50051)
+    parser.add_argument('--positions', type=int, default=FAKE_API_POSITIONS, help='позиций на счете')
+    parser.add_argument('--accounts', type=int, default=FAKE_API_ACCOUNTS, help='счетов на токен')
+    parser.add_argument('--latency', type=float, default=FAKE_API_LATENCY, help='задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=FAKE_API_JITTER, help='разброс задержки, мс')
+    parser.add_argument('--rate-limit', type=int, default=FAKE_API_RATE_LIMIT, help='запросов в минуту на токен')
+    parser.add_argument('--fill-delay', type=float, default=FAKE_API_FILL_DELAY, help='исполнение лимитной заявки, мс')
+    parser.add_argument('--cert-dir', help='куда записать сертификат (по умолчанию - временный каталог)')
+    args = parser.parse_args()
+
+    fake_api = FakeInvestApi(args.positions, args.accounts, args.latency, args.jitter, args.rate_limit, args.fill_delay)
+    cert_path, key_path = generate_certificate(args.cert_dir or tempfile.mkdtemp(prefix='fake_api_'))
+    print(f"Фейковый API слушает localhost:{args.port}")
+    print(f"export TINKOFF_API_TARGET=localhost:{args.port}")
+    print(f"export GRPC_DEFAULT_SSL_ROOTS_FILE_PATH={cert_path}")
+    try:
+        asyncio.run(fake_api.serve(args.port, cert_path, key_path))
+    except KeyboardInterrupt:
+        pass
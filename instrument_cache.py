@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+from metrics import SQLITE_SECONDS
+from sqlite_pool import DATABASE_PATH, SQLitePool
+
+
+# Время жизни записи об инструменте (по умолчанию 7 дней)
+INSTRUMENT_CACHE_TTL = int(os.environ.get('INSTRUMENT_CACHE_TTL', 7 * 24 * 3600))
+
+# Максимальное количество инструментов в кэше
+INSTRUMENT_CACHE_MAX_SIZE = int(os.environ.get('INSTRUMENT_CACHE_MAX_SIZE', 20000))
+
+
+class InstrumentCache:
+    """
+    Кэш справочной информации об инструментах (FIGI -> название, тикер, тип, лот)
+
+    Записи хранятся в таблице SQLite рядом с пользователями, поэтому кэш
+    общий для всех воркеров gunicorn. Поверх таблицы в каждом процессе
+    держится LRU-словарь, чтобы повторные обращения не ходили в базу.
+    """
+
+    def __init__(self, db_path: str = None, ttl: int = INSTRUMENT_CACHE_TTL, max_size: int = INSTRUMENT_CACHE_MAX_SIZE):
+        if db_path is None:
+            db_path = DATABASE_PATH
+
+        self.db_path = db_path
+        self.pool = SQLitePool(db_path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._memory = OrderedDict()  # figi -> (info, updated_at)
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _init_db(self):
+        """Инициализация таблицы инструментов"""
+        conn = self.pool.connection()
+
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS instruments (
+                    figi TEXT PRIMARY KEY,
+                    name TEXT,
+                    ticker TEXT,
+                    type TEXT,
+                    lot INTEGER,
+                    updated_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_instruments_last_used ON instruments (last_used)')
+
+            # Миграция: размер лота добавлен позже остальных полей
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(instruments)')]
+            if 'lot' not in columns:
+                conn.execute('ALTER TABLE instruments ADD COLUMN lot INTEGER')
+
+    def _remember(self, figi: str, info: Dict, updated_at: float):
+        """Кладет запись в LRU-словарь процесса"""
+        self._memory[figi] = (info, updated_at)
+        self._memory.move_to_end(figi)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, figis: Iterable[str]) -> Dict[str, Dict]:
+        """Возвращает актуальные записи для найденных FIGI"""
+        now = time.time()
+        result = {}
+        missing = []
+
+        with self._lock:
+            for figi in dict.fromkeys(figis):
+                if not figi:
+                    continue
+                entry = self._memory.get(figi)
+                if entry and now - entry[1] < self.ttl:
+                    self._memory.move_to_end(figi)
+                    result[figi] = entry[0]
+                else:
+                    missing.append(figi)
+
+        if not missing:
+            return result
+
+        try:
+            rows = self._load_rows(missing, now)
+        except Exception as e:
+            print(f"Ошибка при чтении кэша инструментов: {e}")
+            return result
+
+        with self._lock:
+            for figi, name, ticker, instrument_type, lot, updated_at in rows:
+                info = {'name': name, 'ticker': ticker, 'type': instrument_type, 'lot': lot}
+                self._remember(figi, info, updated_at)
+                result[figi] = info
+
+        return result
+
+    @SQLITE_SECONDS.time('instruments.get_many')
+    def _load_rows(self, figis: List[str], now: float) -> List[tuple]:
+        """Актуальные записи из базы с отметкой использования"""
+        conn = self.pool.connection()
+
+        placeholders = ','.join('?' * len(figis))
+        # Записи без размера лота (до миграции) считаются отсутствующими
+        rows = conn.execute(f'''
+            SELECT figi, name, ticker, type, lot, updated_at FROM instruments
+            WHERE figi IN ({placeholders}) AND updated_at >= ? AND lot IS NOT NULL
+        ''', (*figis, now - self.ttl)).fetchall()
+
+        if rows:
+            # Отмечаем использование для вытеснения по LRU
+            found = [row[0] for row in rows]
+            with conn:
+                conn.execute(f'''
+                    UPDATE instruments SET last_used = ?
+                    WHERE figi IN ({','.join('?' * len(found))})
+                ''', (now, *found))
+        return rows
+
+    @SQLITE_SECONDS.time('instruments.put_many')
+    def put_many(self, instruments: Dict[str, Dict]) -> bool:
+        """Сохраняет записи об инструментах и вытесняет самые старые"""
+        if not instruments:
+            return True
+
+        now = time.time()
+        with self._lock:
+            for figi, info in instruments.items():
+                self._remember(figi, info, now)
+
+        try:
+            conn = self.pool.connection()
+
+            with conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO instruments (figi, name, ticker, type, lot, updated_at, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (figi, info['name'], info['ticker'], info['type'], info['lot'], now, now)
+                    for figi, info in instruments.items()
+                ])
+
+                overflow = conn.execute('SELECT COUNT(*) FROM instruments').fetchone()[0] - self.max_size
+                if overflow > 0:
+                    conn.execute('''
+                        DELETE FROM instruments WHERE figi IN (
+                            SELECT figi FROM instruments ORDER BY last_used LIMIT ?
+                        )
+                    ''', (overflow,))
+
+            return True
+        except Exception as e:
+            print(f"Ошибка при сохранении кэша инструментов: {e}")
+            return False
+
+    def is_warm(self) -> bool:
+        """Проверяет, есть ли в кэше актуальные записи"""
+        try:
+            conn = self.pool.connection()
+            result = conn.execute(
+                'SELECT 1 FROM instruments WHERE updated_at >= ? LIMIT 1', (time.time() - self.ttl,)
+            ).fetchone()
+            return result is not None
+        except Exception as e:
+            print(f"Ошибка при проверке кэша инструментов: {e}")
+            return False
+
+    def warm(self, client) -> int:
+        """
+        Прогрев кэша списками акций, облигаций, фондов и валют
+
+        Args:
+            client: Клиент Tinkoff Invest API (результат Client.__enter__)
+
+        Returns:
+            Количество сохраненных инструментов
+        """
+        listings = [
+            (client.instruments.shares, 'share'),
+            (client.instruments.bonds, 'bond'),
+            (client.instruments.etfs, 'etf'),
+            (client.instruments.currencies, 'currency'),
+        ]
+
+        instruments = {}
+        for listing, instrument_type in listings:
+            try:
+                for instrument in listing().instruments:
+                    instruments[instrument.figi] = {
+                        'name': instrument.name,
+                        'ticker': instrument.ticker,
+                        'type': instrument_type,
+                        'lot': instrument.lot
+                    }
+            except Exception as e:
+                print(f"Ошибка при загрузке списка инструментов ({instrument_type}): {e}")
+
+        self.put_many(instruments)
+        return len(instruments)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест приложения против локального фейкового API (fake_api.py)
+
+Запуск:
+    python loadtest.py                                  # настройки по умолчанию
+    python loadtest.py --users 50 --concurrency 16 --positions 200 --latency 30
+    python loadtest.py --json results.json              # результаты для сравнения
+
+Тест поднимает фейковый API, временную базу и приложение в одном процессе,
+затем по фазам нагружает эндпоинты из нескольких потоков. Для каждой фазы
+выводятся пропускная способность, задержки p50/p95/p99 и число запросов
+к API по методам. Сеть и настоящий токен не нужны.
+"""
+import argparse
+import json
+import os
+import secrets
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from cryptography.fernet import Fernet
+from fake_api import FakeInvestApi
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Перцентиль отсортированного списка (ближайший ранг)"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+class User:
+    """Пользователь теста: свой токен и свой клиент Flask (своя сессия)"""
+
+    def __init__(self, app, index: int):
+        self.token = f'loadtest-{index}'
+        self.client = app.test_client()
+        self.accounts = []
+        self.figis = []
+
+
+def run_phase(name: str, users: List[User], request: Callable, rounds: int, concurrency: int,
+              fake_api: FakeInvestApi) -> Dict:
+    """
+    Выполняет request(user) rounds раз для каждого пользователя
+
+    Запросы одного пользователя идут последовательно (одна сессия),
+    разные пользователи - параллельно.
+    """
+    calls_before = fake_api.snapshot_calls()
+
+    def user_requests(user: User):
+        latencies, errors = [], 0
+        for _ in range(rounds):
+            start = time.perf_counter()
+            try:
+                failed = request(user).status_code >= 400
+            except Exception:
+                failed = True
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += failed
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(user_requests, users))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for user_latencies, _ in results for latency in user_latencies)
+    calls = fake_api.snapshot_calls()
+    calls.subtract(calls_before)
+    return {
+        'phase': name,
+        'requests': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'upstream': {method: count for method, count in sorted(calls.items()) if count}
+    }
+
+
+def report(result: Dict):
+    upstream = ', '.join(f'{method}={count}' for method, count in result['upstream'].items()) or '-'
+    print(f"  {result['phase']:<34} {result['requests']:>6} {result['errors']:>5} {result['rps']:>9.1f} "
+          f"{result['p50']:>8.1f} {result['p95']:>8.1f} {result['p99']:>8.1f}   {upstream}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест против фейкового API')
+    parser.add_argument('--users', type=int, default=20, help='число пользователей (токенов)')
+    parser.add_argument('--concurrency', type=int, default=16, help='число потоков')
+    parser.add_argument('--rounds', type=int, default=5, help='запросов на пользователя в фазе')
+    parser.add_argument('--positions', type=int, default=50, help='позиций на счете')
+    parser.add_argument('--accounts', type=int, default=2, help='счетов на токен')
+    parser.add_argument('--latency', type=float, default=20, help='задержка ответа API, мс')
+    parser.add_argument('--jitter', type=float, default=5, help='разброс задержки API, мс')
+    parser.add_argument('--rate-limit', type=int, default=0, help='лимит API в минуту на токен (0 - нет)')
+    parser.add_argument('--json', help='записать результаты в файл')
+    args = parser.parse_args()
+
+    fake_api = FakeInvestApi(args.positions, args.accounts, args.latency, args.jitter, args.rate_limit)
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    target, cert_path = fake_api.start(cert_dir=workdir)
+
+    # Настройки читаются при импорте модулей приложения, поэтому задаются до импорта
+    os.environ['TINKOFF_API_TARGET'] = target
+    os.environ['GRPC_DEFAULT_SSL_ROOTS_FILE_PATH'] = cert_path
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'users.db')
+    os.environ.setdefault('SECRET_KEY', secrets.token_hex(32))
+    os.environ.setdefault('ENCRYPTION_KEY', Fernet.generate_key().decode())
+    os.environ.setdefault('INSTRUMENT_CACHE_WARMUP', '0')
+    os.environ.setdefault('PREFETCH_ENABLED', '0')
+    from app import app
+
+    users = [User(app, index) for index in range(args.users)]
+
+    def login(user: User):
+        return user.client.post('/api/auth/login', json={'token': user.token, 'username': user.token})
+
+    def accounts(user: User):
+        response = user.client.get('/api/accounts')
+        if response.status_code == 200 and not user.accounts:
+            user.accounts = [acc['id'] for acc in response.get_json()['accounts']]
+        return response
+
+    def portfolio(refresh: bool):
+        def request(user: User):
+            response = user.client.get(f'/api/portfolio/{user.accounts[0]}' + ('?refresh=1' if refresh else ''))
+            if response.status_code == 200 and not user.figis:
+                user.figis = [pos['figi'] for pos in response.get_json()['positions']][:10]
+            return response
+        return request
+
+    def portfolio_all(user: User):
+        return user.client.get('/api/portfolio/all?refresh=1')
+
+    def rebalance(user: User):
+        weights = {figi: 100 / len(user.figis) for figi in user.figis}
+        return user.client.post('/api/rebalance', json={
+            'account_id': user.accounts[0], 'target_weights': weights, 'mode': 'buy_and_sell'
+        })
+
+    phases = [
+        ('POST /api/auth/login', login, 1),
+        ('GET /api/accounts', accounts, args.rounds),
+        ('GET /api/portfolio/<id>?refresh=1', portfolio(True), args.rounds),
+        ('GET /api/portfolio/<id> (кэш)', portfolio(False), args.rounds),
+        ('GET /api/portfolio/all?refresh=1', portfolio_all, args.rounds),
+        ('POST /api/rebalance', rebalance, args.rounds),
+    ]
+
+    print(f"Пользователей {args.users}, потоков {args.concurrency}, позиций {args.positions}, "
+          f"счетов {args.accounts}, задержка API {args.latency:.0f}±{args.jitter:.0f} мс")
+    print(f"  {'фаза':<34} {'запр.':>6} {'ошиб.':>5} {'запр./с':>9} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8}   "
+          f"запросы к API")
+    results = []
+    for name, request, rounds in phases:
+        result = run_phase(name, users, request, rounds, args.concurrency, fake_api)
+        results.append(result)
+        report(result)
+
+    fake_api.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+"""
+Метрики приложения в формате Prometheus
+
+Метрики собираются в памяти процесса без внешних зависимостей: счетчики
+и гистограммы обновляются под блокировкой за единицы микросекунд.
+Замеры функций подключаются декораторами (Histogram.time), поэтому код
+сервисов и базы не меняется.
+
+Если задан METRICS_DIR, каждый воркер gunicorn периодически сохраняет свои
+метрики в файл этого каталога, и /metrics отдает сумму по всем воркерам.
+
+Профилировщик (SamplingProfiler) периодически снимает стеки всех потоков
+процесса и считает их в формате collapsed stacks (для flamegraph.pl и
+speedscope). По умолчанию выключен.
+"""
+import asyncio
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from typing import Dict, Iterable, List, Tuple
+
+
+# Собирать ли метрики
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+# Каталог для метрик воркеров gunicorn (пусто - только метрики текущего процесса)
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+
+# Как часто воркер сохраняет метрики в METRICS_DIR (секунды)
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+# Токен для доступа к /metrics (пусто - без проверки)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Профилировщик: включен ли при запуске и интервал снятия стеков (секунды)
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '0') == '1'
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.01))
+
+# Максимум различных стеков в профиле
+PROFILER_MAX_STACKS = int(os.environ.get('PROFILER_MAX_STACKS', 10000))
+
+# Границы гистограмм длительности (секунды)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Метрика с набором меток: значения хранятся по кортежу значений меток"""
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def state(self) -> List:
+        """Значения для сохранения и суммирования между процессами"""
+        with self._lock:
+            return [[list(labels), value if not isinstance(value, list) else list(value)]
+                    for labels, value in self._values.items()]
+
+    @staticmethod
+    def merge(states: Iterable[List]) -> Dict[tuple, object]:
+        """Сумма значений нескольких процессов"""
+        merged = {}
+        for state in states:
+            for labels, value in state:
+                labels = tuple(labels)
+                current = merged.get(labels)
+                if current is None:
+                    merged[labels] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    merged[labels] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[labels] = current + value
+        return merged
+
+    def render(self, values: Dict[tuple, object]) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    type = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self, values: Dict[tuple, object]) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {value}' for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    """Гистограмма: счетчики по границам, сумма и число наблюдений"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str):
+        if not METRICS_ENABLED:
+            return
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            # Счетчики без накопления по границам, последние два элемента - сумма и число
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 3)
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def time(self, *labels: str):
+        """Декоратор: длительность вызова функции (обычной или корутинной)"""
+        def decorator(func):
+            if not METRICS_ENABLED:
+                return func
+
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, *labels)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+            return wrapper
+        return decorator
+
+    def render(self, values: Dict[tuple, object]) -> List[str]:
+        lines = []
+        for labels, entry in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {entry[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {entry[-1]}')
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self._flusher = None
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def state(self) -> Dict[str, List]:
+        return {name: metric.state() for name, metric in self.metrics.items()}
+
+    def _flush_path(self, pid: int) -> str:
+        return os.path.join(METRICS_DIR, f'metrics_{pid}.json')
+
+    def flush(self):
+        """Сохраняет метрики процесса в METRICS_DIR (атомарно)"""
+        path = self._flush_path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.state(), f)
+        os.replace(path + '.tmp', path)
+
+    def start_flusher(self):
+        """Запускает периодическое сохранение метрик (лениво и заново после fork)"""
+        if not METRICS_DIR or not METRICS_ENABLED or self._flusher == os.getpid():
+            return
+        self._flusher = os.getpid()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+
+        def run():
+            while True:
+                time.sleep(METRICS_FLUSH_INTERVAL)
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"Ошибка при сохранении метрик: {e}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _states(self) -> List[Dict[str, List]]:
+        """Метрики текущего процесса и сохраненные метрики остальных воркеров"""
+        states = [self.state()]
+        if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+            return states
+
+        own = os.path.basename(self._flush_path(os.getpid()))
+        for name in os.listdir(METRICS_DIR):
+            if name == own or not name.startswith('metrics_') or not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, name)) as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return states
+
+    def render(self) -> str:
+        """Метрики всех процессов в текстовом формате Prometheus"""
+        states = self._states()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            lines.extend(metric.render(Metric.merge(state.get(name, []) for state in states)))
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профилировщик процесса
+
+    Фоновый поток раз в interval секунд снимает стеки всех остальных
+    потоков (sys._current_frames) и считает одинаковые стеки. Накладные
+    расходы не зависят от числа вызовов функций, поэтому профилировщик
+    можно ненадолго включать на рабочем сервере.
+    """
+
+    def __init__(self, interval: float = PROFILER_INTERVAL, max_stacks: int = PROFILER_MAX_STACKS):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.samples = StackCounter()
+        self._lock = threading.Lock()
+        self._control_lock = threading.Lock()  # start/stop из разных запросов
+        self._running = False
+        self._pid = None
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._running and self._pid == os.getpid()
+
+    def start(self):
+        with self._control_lock:
+            if self.running:
+                return
+            # Поток после stop() мог еще не выйти из sleep - иначе семплеров станет два
+            thread = self._thread
+            if thread is not None and thread.is_alive() and self._pid == os.getpid():
+                thread.join()
+            self._running = True
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._control_lock:
+            self._running = False
+
+    def reset(self):
+        with self._lock:
+            self.samples = StackCounter()
+
+    @staticmethod
+    def _stack(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self):
+        own = threading.get_ident()
+        while self._running and self._pid == os.getpid():
+            stacks = [self._stack(frame) for ident, frame in sys._current_frames().items() if ident != own]
+            with self._lock:
+                for stack in stacks:
+                    if stack in self.samples or len(self.samples) < self.max_stacks:
+                        self.samples[stack] += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        """Профиль в формате collapsed stacks: 'стек число' по строке"""
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    'http_request_duration_seconds', 'Длительность обработки HTTP-запроса', ('endpoint', 'method', 'status')
+))
+APP_ERRORS = registry.register(Counter(
+    'app_errors_total', 'Исключения, превращенные в ответ с ошибкой', ('endpoint', 'type')
+))
+UPSTREAM_REQUESTS = registry.register(Counter(
+    'upstream_requests_total', 'Запросы к Tinkoff Invest API', ('method', 'code')
+))
+UPSTREAM_SECONDS = registry.register(Histogram(
+    'upstream_request_duration_seconds', 'Длительность запроса к Tinkoff Invest API', ('method',)
+))
+SERVICE_SECONDS = registry.register(Histogram(
+    'service_call_duration_seconds', 'Длительность вызова метода сервиса API (с кэшами и объединением)', ('call',)
+))
+CACHE_REQUESTS = registry.register(Counter(
+    'cache_requests_total', 'Обращения к кэшам', ('cache', 'result')
+))
+SQLITE_SECONDS = registry.register(Histogram(
+    'sqlite_query_duration_seconds', 'Длительность запросов к SQLite', ('query',)
+))
+DECRYPT_SECONDS = registry.register(Histogram(
+    'token_decrypt_duration_seconds', 'Длительность расшифровки токена (Fernet)'
+))
+ORDERS = registry.register(Counter(
+    'rebalance_orders_total', 'Заявки исполнения ребалансировки по итоговому состоянию', ('direction', 'status')
+))
+
+profiler = SamplingProfiler()
+if PROFILER_ENABLED:
+    profiler.start()
+
+
+async def observe_upstream(method: str, call):
+    """Ожидает запрос к API (корутину или gRPC-вызов) и учитывает его в метриках"""
+    start = time.perf_counter()
+    code = 'OK'
+    try:
+        return await call
+    except Exception as e:
+        code = getattr(getattr(e, 'code', None), 'name', None) or type(e).__name__
+        raise
+    finally:
+        UPSTREAM_REQUESTS.inc(method, code)
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, method)
+
+
+def count_cache(cache: str, hits: int, misses: int):
+    """Учитывает попадания и промахи кэша"""
+    if hits:
+        CACHE_REQUESTS.inc(cache, 'hit', amount=hits)
+    if misses:
+        CACHE_REQUESTS.inc(cache, 'miss', amount=misses)
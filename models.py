@@ -0,0 +1,160 @@
+from typing import Dict, List, Optional
+
+
+class AccountPosition:
+    """Доля позиции сводного портфеля на одном счете"""
+
+    __slots__ = ('account_id', 'account_name', 'quantity', 'current_value')
+
+    def __init__(self, account_id: str, account_name: str, quantity: float, current_value: float):
+        self.account_id = account_id
+        self.account_name = account_name
+        self.quantity = quantity
+        self.current_value = current_value
+
+    def to_dict(self) -> Dict:
+        return {
+            'account_id': self.account_id,
+            'account_name': self.account_name,
+            'quantity': self.quantity,
+            'current_value': self.current_value
+        }
+
+
+class Position:
+    """Позиция портфеля"""
+
+    __slots__ = ('figi', 'name', 'ticker', 'type', 'lot', 'quantity', 'current_price', 'current_value',
+                 'currency', 'accounts')
+
+    def __init__(self, figi: str, name: str, ticker: str, type: str, lot: int, quantity: float,
+                 current_price: float, current_value: float, currency: str,
+                 accounts: Optional[List[AccountPosition]] = None):
+        self.figi = figi
+        self.name = name
+        self.ticker = ticker
+        self.type = type
+        self.lot = lot
+        self.quantity = quantity
+        self.current_price = current_price
+        self.current_value = current_value
+        self.currency = currency
+        # Разбивка по счетам, только у позиций сводного портфеля
+        self.accounts = accounts
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Position':
+        """Позиция из JSON (формат ответа /api/portfolio)"""
+        accounts = data.get('accounts')
+        if accounts is not None:
+            accounts = [
+                AccountPosition(acc['account_id'], acc.get('account_name', acc['account_id']),
+                                acc.get('quantity', 0), acc['current_value'])
+                for acc in accounts
+            ]
+        return cls(
+            data['figi'], data.get('name', data['figi']), data.get('ticker', ''), data.get('type', ''),
+            data.get('lot') or 1, data.get('quantity', 0), data['current_price'], data['current_value'],
+            data.get('currency', 'rub'), accounts
+        )
+
+    def replace(self, **changes) -> 'Position':
+        """Копия позиции с измененными полями"""
+        copy = Position.__new__(Position)
+        for name in Position.__slots__:
+            setattr(copy, name, changes[name] if name in changes else getattr(self, name))
+        return copy
+
+    def to_dict(self) -> Dict:
+        data = {
+            'figi': self.figi,
+            'name': self.name,
+            'ticker': self.ticker,
+            'type': self.type,
+            'lot': self.lot,
+            'quantity': self.quantity,
+            'current_price': self.current_price,
+            'current_value': self.current_value,
+            'currency': self.currency
+        }
+        if self.accounts is not None:
+            data['accounts'] = [acc.to_dict() for acc in self.accounts]
+        return data
+
+
+class Portfolio:
+    """Портфель счета или сводный портфель нескольких счетов"""
+
+    __slots__ = ('positions', 'total_value', 'currency')
+
+    def __init__(self, positions: List[Position], total_value: float, currency: str):
+        self.positions = positions
+        self.total_value = total_value
+        self.currency = currency
+
+    def to_dict(self) -> Dict:
+        return {
+            'positions': [position.to_dict() for position in self.positions],
+            'total_value': self.total_value,
+            'currency': self.currency
+        }
+
+
+class Operation:
+    """Операция ребалансировки по одной позиции"""
+
+    __slots__ = ('figi', 'name', 'ticker', 'action', 'quantity', 'value', 'current_value', 'target_value',
+                 'current_weight', 'target_weight', 'price', 'lots', 'lot', 'cost', 'accounts')
+
+    def __init__(self, figi: str, name: str, ticker: str, action: str, quantity: float, value: float,
+                 current_value: float, target_value: float, current_weight: float, target_weight: float,
+                 price: float, lots: Optional[int] = None, lot: Optional[int] = None):
+        self.figi = figi
+        self.name = name
+        self.ticker = ticker
+        self.action = action
+        self.quantity = quantity
+        self.value = value
+        self.current_value = current_value
+        self.target_value = target_value
+        self.current_weight = current_weight
+        self.target_weight = target_weight
+        self.price = price
+        # Только для расчета в лотах
+        self.lots = lots
+        self.lot = lot
+        # Только для расчета с учетом издержек: комиссия, спред и налог операции
+        self.cost = None
+        # Разбивка по счетам, только для сводного портфеля
+        self.accounts = None
+
+    def to_dict(self) -> Dict:
+        data = {
+            'figi': self.figi,
+            'name': self.name,
+            'ticker': self.ticker,
+            'action': self.action,
+            'quantity': self.quantity,
+            'value': self.value,
+            'current_value': self.current_value,
+            'target_value': self.target_value,
+            'current_weight': self.current_weight,
+            'target_weight': self.target_weight,
+            'price': self.price
+        }
+        if self.lots is not None:
+            data['lots'] = self.lots
+            data['lot'] = self.lot
+        if self.cost is not None:
+            data['cost'] = self.cost
+        if self.accounts is not None:
+            data['accounts'] = self.accounts
+        return data
+
+
+def to_json_compatible(obj):
+    """Преобразование моделей для json.dumps (параметр default)"""
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError(f'Объект типа {type(obj).__name__} не сериализуется в JSON')
+    return to_dict()
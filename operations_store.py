@@ -0,0 +1,436 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+from metrics import SQLITE_SECONDS, count_cache
+from sqlite_pool import DATABASE_PATH, SQLitePool
+from tinkoff_service import nano_to_float
+
+
+# С какой даты загружается история операций при первой синхронизации (ГГГГ-ММ-ДД)
+OPERATIONS_SYNC_START = os.environ.get('OPERATIONS_SYNC_START', '2015-01-01')
+
+# Сколько секунд до последней загруженной операции запрашивается повторно
+# (операции, исполненные с задержкой, не теряются; повторы не дублируются)
+OPERATIONS_SYNC_OVERLAP = int(os.environ.get('OPERATIONS_SYNC_OVERLAP', 7 * 24 * 3600))
+
+# Операций на странице ответа get_operations_by_cursor
+OPERATIONS_PAGE_SIZE = int(os.environ.get('OPERATIONS_PAGE_SIZE', 1000))
+
+# Через сколько секунд после синхронизации чтение истории сначала догружает новые операции
+OPERATIONS_SYNC_MAX_AGE = int(os.environ.get('OPERATIONS_SYNC_MAX_AGE', 300))
+
+# Сколько рассчитанных отчетов о доходности хранится в памяти процесса
+OPERATIONS_PNL_CACHE_SIZE = int(os.environ.get('OPERATIONS_PNL_CACHE_SIZE', 256))
+
+# Типы операций (OperationType) по смыслу для расчета доходности
+BUY_TYPES = ('OPERATION_TYPE_BUY', 'OPERATION_TYPE_BUY_CARD', 'OPERATION_TYPE_BUY_MARGIN',
+             'OPERATION_TYPE_DELIVERY_BUY')
+SELL_TYPES = ('OPERATION_TYPE_SELL', 'OPERATION_TYPE_SELL_CARD', 'OPERATION_TYPE_SELL_MARGIN',
+              'OPERATION_TYPE_DELIVERY_SELL')
+
+# Статьи доходности счета
+CATEGORIES = ('dividends', 'coupons', 'repayments', 'commissions', 'taxes', 'deposits', 'withdrawals', 'other')
+
+
+def operation_category(operation_type: str) -> str:
+    """Статья доходности для типа операции, кроме покупок и продаж"""
+    if 'TAX' in operation_type:
+        return 'taxes'
+    if 'FEE' in operation_type:
+        return 'commissions'
+    if operation_type.startswith('OPERATION_TYPE_DIVIDEND'):
+        return 'dividends'
+    if operation_type == 'OPERATION_TYPE_COUPON':
+        return 'coupons'
+    if operation_type.startswith('OPERATION_TYPE_BOND_REPAYMENT'):
+        return 'repayments'
+    if 'SECURITIES' in operation_type:
+        return 'other'
+    if operation_type.startswith('OPERATION_TYPE_INPUT'):
+        return 'deposits'
+    if operation_type.startswith('OPERATION_TYPE_OUTPUT'):
+        return 'withdrawals'
+    return 'other'
+
+
+def fifo_match(lots: deque, quantity: int) -> tuple:
+    """
+    Списывает quantity бумаг с самых старых лотов [количество, стоимость]
+
+    Returns:
+        (списанное количество, стоимость списанного в нано-единицах)
+    """
+    matched, cost = 0, 0
+    while lots and matched < quantity:
+        lot = lots[0]
+        take = min(lot[0], quantity - matched)
+        part = lot[1] * take // lot[0]
+        lot[0] -= take
+        lot[1] -= part
+        matched += take
+        cost += part
+        if lot[0] == 0:
+            lots.popleft()
+    return matched, cost
+
+
+class OperationsStore:
+    """
+    Локальная история операций счетов
+
+    Операции хранятся в таблице operations с ключом (account_id, id)
+    и индексами по дате и по FIGI, поэтому история и доходность
+    за годы читаются из базы за миллисекунды без запросов к API.
+
+    Для каждого счета в operations_sync хранится состояние синхронизации:
+    окно запроса (sync_from, sync_to), курсор следующей страницы, пока окно
+    не загружено целиком, и отметка самой поздней загруженной операции.
+    Страница операций и курсор записываются одной транзакцией, поэтому
+    прерванная первая загрузка продолжается с того же места, а следующие
+    синхронизации запрашивают только окно от отметки до текущего момента.
+    """
+
+    def __init__(self, db_path: str = None):
+        if db_path is None:
+            db_path = DATABASE_PATH
+
+        self.db_path = db_path
+        self.pool = SQLitePool(db_path)
+        # Рассчитанные отчеты: (метод, account_id, параметры) -> (версия операций счета, результат)
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _init_db(self):
+        """Инициализация таблиц операций и состояния синхронизации"""
+        conn = self.pool.connection()
+
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS operations (
+                    account_id TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    parent_id TEXT,
+                    date REAL NOT NULL,
+                    type TEXT NOT NULL,
+                    figi TEXT,
+                    instrument_type TEXT,
+                    name TEXT,
+                    quantity INTEGER NOT NULL,
+                    payment INTEGER NOT NULL,
+                    price INTEGER NOT NULL,
+                    currency TEXT,
+                    PRIMARY KEY (account_id, id)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_operations_date ON operations (account_id, date)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_operations_figi ON operations (account_id, figi, date)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS operations_sync (
+                    account_id TEXT PRIMARY KEY,
+                    sync_from REAL,
+                    sync_to REAL,
+                    cursor TEXT NOT NULL DEFAULT '',
+                    watermark REAL,
+                    synced_at REAL,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
+    def sync_state(self, account_id: str) -> Optional[Dict]:
+        """Состояние синхронизации счета или None, если счет не синхронизировался"""
+        row = self.pool.connection().execute('''
+            SELECT sync_from, sync_to, cursor, watermark, synced_at FROM operations_sync WHERE account_id = ?
+        ''', (account_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('sync_from', 'sync_to', 'cursor', 'watermark', 'synced_at'), row))
+
+    def sync_window(self, account_id: str, now: float = None) -> Dict:
+        """
+        Что запрашивать при синхронизации счета
+
+        Returns:
+            {'from', 'to'} (datetime UTC) и 'cursor': незавершенное окно
+            продолжается с сохраненного курсора, иначе новое окно начинается
+            от последней загруженной операции (с перекрытием) или
+            с OPERATIONS_SYNC_START
+        """
+        state = self.sync_state(account_id)
+        if state and state['cursor']:
+            sync_from, sync_to, cursor = state['sync_from'], state['sync_to'], state['cursor']
+        else:
+            if state and state['watermark'] is not None:
+                sync_from = state['watermark'] - OPERATIONS_SYNC_OVERLAP
+            else:
+                sync_from = datetime.strptime(OPERATIONS_SYNC_START, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+            sync_to, cursor = time.time() if now is None else now, ''
+
+        return {
+            'from': datetime.fromtimestamp(sync_from, timezone.utc),
+            'to': datetime.fromtimestamp(sync_to, timezone.utc),
+            'cursor': cursor
+        }
+
+    @SQLITE_SECONDS.time('operations.save_page')
+    def save_page(self, account_id: str, operations: List[Dict], window: Dict, next_cursor: str) -> int:
+        """
+        Записывает страницу операций и курсор следующей страницы одной транзакцией
+
+        Args:
+            window: Окно запроса (результат sync_window)
+            next_cursor: Курсор следующей страницы ('' - окно загружено)
+
+        Returns:
+            Число новых операций
+        """
+        conn = self.pool.connection()
+        with conn:
+            before = conn.total_changes
+            conn.executemany('''
+                INSERT OR IGNORE INTO operations
+                    (account_id, id, parent_id, date, type, figi, instrument_type, name,
+                     quantity, payment, price, currency)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (account_id, op['id'], op['parent_id'], op['date'], op['type'], op['figi'], op['instrument_type'],
+                 op['name'], op['quantity'], op['payment'], op['price'], op['currency'])
+                for op in operations
+            ])
+            added = conn.total_changes - before
+
+            conn.execute('''
+                INSERT INTO operations_sync (account_id, sync_from, sync_to, cursor)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(account_id) DO UPDATE SET
+                    sync_from = excluded.sync_from,
+                    sync_to = excluded.sync_to,
+                    cursor = excluded.cursor
+            ''', (account_id, window['from'].timestamp(), window['to'].timestamp(), next_cursor))
+            if added:
+                # Новые операции делают недействительными рассчитанные отчеты во всех воркерах
+                conn.execute('UPDATE operations_sync SET version = version + 1 WHERE account_id = ?', (account_id,))
+
+            if not next_cursor:
+                # Окно загружено целиком: следующая синхронизация начнется от последней операции
+                conn.execute('''
+                    UPDATE operations_sync SET
+                        watermark = COALESCE((SELECT MAX(date) FROM operations WHERE account_id = ?), sync_to),
+                        synced_at = ?
+                    WHERE account_id = ?
+                ''', (account_id, time.time(), account_id))
+        return added
+
+    def reset_cursor(self, account_id: str):
+        """Забывает курсор незавершенного окна (например, если API его больше не принимает)"""
+        conn = self.pool.connection()
+        with conn:
+            conn.execute("UPDATE operations_sync SET cursor = '' WHERE account_id = ?", (account_id,))
+
+    def synced_at(self, account_id: str) -> Optional[float]:
+        """Время последней завершенной синхронизации счета"""
+        state = self.sync_state(account_id)
+        return state['synced_at'] if state else None
+
+    @SQLITE_SECONDS.time('operations.list')
+    def _cached(self, key: tuple, compute):
+        """
+        Результат compute() для неизменившихся операций счета key[1]
+
+        Версия счета увеличивается при записи новых операций, поэтому
+        повторный отчет читает из базы одну строку вместо всей истории.
+        """
+        row = self.pool.connection().execute(
+            'SELECT version FROM operations_sync WHERE account_id = ?', (key[1],)
+        ).fetchone()
+        version = row[0] if row else 0
+
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] == version:
+                self._results.move_to_end(key)
+                count_cache('operations_report', 1, 0)
+                return cached[1]
+
+        count_cache('operations_report', 0, 1)
+        result = compute()
+        with self._lock:
+            self._results[key] = (version, result)
+            self._results.move_to_end(key)
+            while len(self._results) > OPERATIONS_PNL_CACHE_SIZE:
+                self._results.popitem(last=False)
+        return result
+
+    def operations(self, account_id: str, since: float = None, until: float = None, figi: str = None,
+                   types: Iterable[str] = None, limit: int = 1000) -> List[Dict]:
+        """
+        Операции счета за период, начиная с самых новых
+
+        Args:
+            figi: Только операции по инструменту
+            types: Только операции этих типов (OPERATION_TYPE_...)
+        """
+        conditions = ['account_id = ?', 'date >= ?', 'date <= ?']
+        params = [account_id, since or 0, until if until is not None else time.time()]
+        if figi:
+            conditions.append('figi = ?')
+            params.append(figi)
+        types = list(types or ())
+        if types:
+            conditions.append(f"type IN ({','.join('?' * len(types))})")
+            params.extend(types)
+
+        rows = self.pool.connection().execute(f'''
+            SELECT id, parent_id, date, type, figi, instrument_type, name, quantity, payment, price, currency
+            FROM operations WHERE {' AND '.join(conditions)}
+            ORDER BY date DESC LIMIT ?
+        ''', (*params, limit)).fetchall()
+
+        return [
+            {
+                'id': op_id, 'parent_id': parent_id, 'date': date, 'type': op_type, 'figi': op_figi,
+                'instrument_type': instrument_type, 'name': name, 'quantity': quantity,
+                'payment': nano_to_float(payment), 'price': nano_to_float(price), 'currency': currency
+            }
+            for op_id, parent_id, date, op_type, op_figi, instrument_type, name, quantity, payment, price, currency
+            in rows
+        ]
+
+    def _trades(self, account_id: str, until: float) -> List[tuple]:
+        return self.pool.connection().execute(f'''
+            SELECT figi, date, type, quantity, payment, currency FROM operations
+            WHERE account_id = ? AND date <= ? AND type IN ({','.join('?' * len(BUY_TYPES + SELL_TYPES))})
+            ORDER BY date, id
+        ''', (account_id, until, *BUY_TYPES, *SELL_TYPES)).fetchall()
+
+    def open_lots(self, account_id: str, until: float = None) -> Dict[str, List[Dict]]:
+        """
+        Незакрытые лоты покупок по FIFO
+
+        Returns:
+            Dict figi -> [{'date', 'quantity', 'cost'}] от самых старых лотов,
+            стоимость - в валюте покупки с учетом цены сделки
+        """
+        return self._cached(('open_lots', account_id, until), lambda: self._open_lots(account_id, until))
+
+    def _open_lots(self, account_id: str, until: Optional[float]) -> Dict[str, List[Dict]]:
+        lots = self._fifo(account_id, None, time.time() if until is None else until)[1]
+        return {
+            figi: [{'date': date, 'quantity': quantity, 'cost': nano_to_float(cost)} for quantity, cost, date in queue]
+            for figi, queue in lots.items() if queue
+        }
+
+    @SQLITE_SECONDS.time('operations.fifo')
+    def _fifo(self, account_id: str, since: Optional[float], until: float) -> tuple:
+        """
+        Проход по сделкам счета до until с сопоставлением продаж покупкам по FIFO
+
+        Returns:
+            (realized, lots, currencies, unmatched): реализованный результат продаж
+            начиная с since по FIFO (figi -> нано-единицы), открытые лоты
+            (figi -> deque [количество, стоимость, дата]), валюта сделок
+            по FIGI и количество проданных бумаг без найденной покупки
+        """
+        realized, lots, currencies, unmatched = {}, {}, {}, {}
+        for figi, date, op_type, quantity, payment, currency in self._trades(account_id, until):
+            if quantity <= 0:
+                continue
+            currencies[figi] = currency
+            queue = lots.setdefault(figi, deque())
+            if op_type in BUY_TYPES:
+                queue.append([quantity, abs(payment), date])
+                continue
+
+            matched, cost = fifo_match(queue, quantity)
+            if since is None or date >= since:
+                # Выручка делится пропорционально, если покупок нашлось меньше проданного
+                proceeds = abs(payment) * matched // quantity
+                realized[figi] = realized.get(figi, 0) + proceeds - cost
+                if matched < quantity:
+                    unmatched[figi] = unmatched.get(figi, 0) + quantity - matched
+        return realized, lots, currencies, unmatched
+
+    def pnl(self, account_id: str, since: float = None, until: float = None) -> Dict:
+        """
+        Доходность счета за период по локальной истории операций
+
+        Реализованный результат считается по FIFO: каждая продажа списывает
+        самые старые покупки, а сделки до since учитываются только для
+        себестоимости. Дивиденды, купоны, комиссии, налоги, пополнения
+        и выводы суммируются по операциям периода.
+
+        Returns:
+            Dict с ключами 'positions' (по FIGI: открытое количество,
+            себестоимость, реализованный результат и статьи доходности)
+            и 'totals' (статьи по валютам, net - реализованный результат
+            с дивидендами, купонами, комиссиями и налогами)
+        """
+        return self._cached(('pnl', account_id, since, until), lambda: self._pnl(account_id, since, until))
+
+    @SQLITE_SECONDS.time('operations.pnl')
+    def _pnl(self, account_id: str, since: Optional[float], until: Optional[float]) -> Dict:
+        until = time.time() if until is None else until
+        realized, lots, currencies, unmatched = self._fifo(account_id, since, until)
+
+        # Остальные операции периода суммируются в базе
+        rows = self.pool.connection().execute(f'''
+            SELECT figi, type, currency, SUM(payment) FROM operations
+            WHERE account_id = ? AND date >= ? AND date <= ?
+                AND type NOT IN ({','.join('?' * len(BUY_TYPES + SELL_TYPES))})
+            GROUP BY figi, type, currency
+        ''', (account_id, since or 0, until, *BUY_TYPES, *SELL_TYPES)).fetchall()
+
+        names = dict(self.pool.connection().execute('''
+            SELECT figi, name FROM operations WHERE account_id = ? AND figi != '' GROUP BY figi
+        ''', (account_id,)).fetchall())
+
+        positions = {}
+
+        def position(figi: str, currency: str) -> Dict:
+            item = positions.get(figi)
+            if item is None:
+                item = positions[figi] = {
+                    'figi': figi, 'name': names.get(figi, figi), 'currency': currency,
+                    'quantity': 0, 'cost_basis': 0, 'realized': 0, **{name: 0 for name in CATEGORIES}
+                }
+            return item
+
+        totals = {}
+
+        def total(currency: str) -> Dict:
+            return totals.setdefault(currency, {'realized': 0, **{name: 0 for name in CATEGORIES}})
+
+        for figi, queue in lots.items():
+            if queue or figi in realized:
+                item = position(figi, currencies[figi])
+                item['quantity'] = sum(lot[0] for lot in queue)
+                item['cost_basis'] = sum(lot[1] for lot in queue)
+        for figi, value in realized.items():
+            position(figi, currencies[figi])['realized'] = value
+            total(currencies[figi])['realized'] += value
+        for figi, op_type, currency, amount in rows:
+            category = operation_category(op_type)
+            if figi:
+                position(figi, currency)[category] += amount
+            total(currency)[category] += amount
+
+        result = []
+        for item in positions.values():
+            quantity = item['quantity']
+            result.append(dict(
+                item,
+                unmatched_quantity=unmatched.get(item['figi'], 0),
+                average_price=nano_to_float(item['cost_basis'] // quantity) if quantity else 0.0,
+                **{name: nano_to_float(item[name]) for name in ('cost_basis', 'realized') + CATEGORIES}
+            ))
+        result.sort(key=lambda item: item['figi'])
+
+        for currency, values in totals.items():
+            net = sum(values[name] for name in ('realized', 'dividends', 'coupons', 'commissions', 'taxes'))
+            totals[currency] = dict({name: nano_to_float(value) for name, value in values.items()},
+                                    net=nano_to_float(net))
+
+        return {'positions': result, 'totals': totals}
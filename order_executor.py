@@ -0,0 +1,501 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+from tinkoff.invest import OrderDirection, OrderExecutionReportStatus, OrderType
+from async_service import background_loop
+from metrics import ORDERS
+from tinkoff_service import nano_to_float, quotation_to_nano
+
+
+# Сколько заявок исполнения выставляется одновременно
+ORDER_EXECUTION_WORKERS = int(os.environ.get('ORDER_EXECUTION_WORKERS', 8))
+
+# Тип заявок по умолчанию: limit (по лучшей встречной цене стакана) или market
+ORDER_DEFAULT_TYPE = os.environ.get('ORDER_DEFAULT_TYPE', 'limit')
+
+# Сколько секунд ждать исполнения заявок каждого этапа (продаж, затем покупок)
+ORDER_FILL_TIMEOUT = int(os.environ.get('ORDER_FILL_TIMEOUT', 300))
+
+# Сколько секунд после таймаута ждать подтверждения отмены невыполненных заявок
+ORDER_CANCEL_TIMEOUT = float(os.environ.get('ORDER_CANCEL_TIMEOUT', 30))
+
+# Сколько секунд ждать подписки на поток состояний заявок перед выставлением
+ORDER_STREAM_READY_TIMEOUT = float(os.environ.get('ORDER_STREAM_READY_TIMEOUT', 5))
+
+# Пауза между опросами состояний, если поток состояний недоступен (секунды)
+ORDER_STATE_POLL_INTERVAL = float(os.environ.get('ORDER_STATE_POLL_INTERVAL', 2))
+
+# Сколько последних исполнений хранит воркер
+ORDER_EXECUTIONS_MAX = int(os.environ.get('ORDER_EXECUTIONS_MAX', 1000))
+
+ORDER_DIRECTIONS = {'buy': OrderDirection.ORDER_DIRECTION_BUY, 'sell': OrderDirection.ORDER_DIRECTION_SELL}
+ORDER_TYPES = {'limit': OrderType.ORDER_TYPE_LIMIT, 'market': OrderType.ORDER_TYPE_MARKET}
+
+# Состояния заявок по статусам исполнения API
+REPORT_STATUSES = {
+    OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_NEW: 'new',
+    OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_PARTIALLYFILL: 'partially_filled',
+    OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_FILL: 'filled',
+    OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_REJECTED: 'rejected',
+    OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_CANCELLED: 'cancelled',
+}
+
+# Порядок состояний: устаревшее состояние не заменяет более позднее
+ORDER_STATUS_RANK = {'planned': 0, 'new': 1, 'partially_filled': 2}
+FINAL_ORDER_STATUSES = ('filled', 'rejected', 'cancelled', 'failed', 'skipped')
+
+
+def order_request_id(execution_id: str, account_id: str, figi: str, direction: str) -> str:
+    """Ключ идемпотентности заявки: одинаков для повторов одного исполнения"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'rebalance:{execution_id}:{account_id}:{figi}:{direction}'))
+
+
+def plan_orders(execution_id: str, operations, account_id: str) -> List[Dict]:
+    """
+    Заявки по операциям расчета ребалансировки в лотах
+
+    Операция сводного портфеля ('all') делится на заявки по счетам
+    согласно разбивке в поле accounts.
+    """
+    orders = []
+    for operation in operations:
+        if operation.action not in ORDER_DIRECTIONS or not operation.lots:
+            continue
+
+        if operation.accounts:
+            parts = [(acc['account_id'], round(acc['quantity'] / operation.lot)) for acc in operation.accounts]
+        else:
+            parts = [(account_id, operation.lots)]
+
+        for order_account_id, lots in parts:
+            if lots <= 0:
+                continue
+            orders.append({
+                'order_id': order_request_id(execution_id, order_account_id, operation.figi, operation.action),
+                'account_id': order_account_id,
+                'figi': operation.figi,
+                'ticker': operation.ticker,
+                'direction': operation.action,
+                'lots': lots,
+                'lots_planned': lots,
+                # Оценка стоимости лота по расчету: по ней покупки ограничиваются выручкой продаж
+                'lot_value': (operation.price or 0.0) * (operation.lot or 1),
+                'price': None,
+                'status': 'planned',
+                'lots_executed': 0,
+                'executed_price': None,
+                'exchange_order_id': None,
+                'error': None
+            })
+    return orders
+
+
+def money_to_float(money) -> Optional[float]:
+    """Цена из MoneyValue/Quotation (None для пустого значения)"""
+    if money is None:
+        return None
+    value = quotation_to_nano(money)
+    return nano_to_float(value) if value else None
+
+
+class OrderExecution:
+    """
+    Исполнение одного расчета ребалансировки: заявки и их состояния
+
+    Состояние меняется в фоновом цикле событий, а читается потоками
+    Flask, поэтому изменения и снимок выполняются под блокировкой.
+    """
+
+    def __init__(self, execution_id: str, owner, account_id: str, mode: str, order_type: str,
+                 orders: List[Dict], sandbox: bool = False):
+        """
+        Args:
+            owner: Владелец исполнения (пользователь), только он видит исполнение
+            order_type: 'limit' или 'market'
+            orders: Заявки (результат plan_orders)
+            sandbox: Заявки выставляются в песочнице
+        """
+        self.id = execution_id
+        self.owner = owner
+        self.account_id = account_id
+        self.mode = mode
+        self.order_type = order_type
+        self.orders = orders
+        self.sandbox = sandbox
+        self.status = 'running'
+        self.tracking = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_requested = False
+        self._by_id = {order['order_id']: order for order in orders}
+        self._lock = threading.Lock()
+        self._changed = None
+
+    def stages(self) -> List[List[Dict]]:
+        """Этапы выставления: сначала продажи, освобождающие средства, затем покупки"""
+        sells = [order for order in self.orders if order['direction'] == 'sell']
+        buys = [order for order in self.orders if order['direction'] == 'buy']
+        return [stage for stage in (sells, buys) if stage]
+
+    def limit_buys(self, sells: List[Dict]):
+        """
+        Ограничивает покупки средствами, фактически полученными от продаж
+
+        Покупки рассчитаны на выручку всех продаж и свободные средства
+        счета. Если продажи исполнены не полностью (отклонены, отменены,
+        исполнены частично), покупки счета пропорционально уменьшаются на
+        оценку недополученной выручки, чтобы не уходить в маржу. Уменьшенные
+        и пропущенные покупки сохраняют в lots_planned исходное число лотов
+        и получают пояснение в error.
+        """
+        with self._lock:
+            missing = defaultdict(float)
+            for sell in sells:
+                order = self._by_id[sell['order_id']]
+                missing[order['account_id']] += (order['lots'] - order['lots_executed']) * order['lot_value']
+
+            for account_id, shortfall in missing.items():
+                if shortfall <= 0:
+                    continue
+                buys = [order for order in self.orders if order['direction'] == 'buy' and
+                        order['account_id'] == account_id and order['status'] == 'planned']
+                planned = sum(order['lots'] * order['lot_value'] for order in buys)
+                ratio = max(planned - shortfall, 0.0) / planned if planned > 0 else 0.0
+                for order in buys:
+                    lots = int(order['lots'] * ratio)
+                    if lots <= 0:
+                        order['status'] = 'skipped'
+                        order['error'] = 'Не выставлена: продажи исполнены не полностью, средства не освобождены'
+                    elif lots < order['lots']:
+                        order['error'] = (f"Уменьшена с {order['lots']} лотов: "
+                                          'продажи исполнены не полностью')
+                        order['lots'] = lots
+
+        if self._changed is not None:
+            self._changed.set()
+
+    def live_orders(self) -> List[Dict]:
+        """Выставленные заявки, исполнение которых не завершено"""
+        with self._lock:
+            return [dict(order) for order in self.orders
+                    if order['exchange_order_id'] and order['status'] not in FINAL_ORDER_STATUSES]
+
+    def update(self, order_id: str, status: str = None, error: str = None, **fields) -> bool:
+        """
+        Обновляет заявку по ключу идемпотентности
+
+        Состояние не откатывается назад (ответ на выставление может прийти
+        позже события потока), а завершенная заявка меняется только
+        состоянием из API поверх собственной ошибки выставления.
+        """
+        with self._lock:
+            order = self._by_id.get(order_id)
+            if order is None:
+                return False
+
+            current = order['status']
+            if current in FINAL_ORDER_STATUSES and not (current == 'failed' and fields.get('exchange_order_id')):
+                return False
+            if status and (status in FINAL_ORDER_STATUSES or
+                           ORDER_STATUS_RANK[status] >= ORDER_STATUS_RANK.get(current, 0)):
+                order['status'] = status
+                if error is not None:
+                    order['error'] = error
+            for key, value in fields.items():
+                if value is None:
+                    continue
+                if key == 'lots_executed':
+                    value = max(value, order['lots_executed'])
+                order[key] = value
+
+        if self._changed is not None:
+            self._changed.set()
+        return True
+
+    def apply_state(self, order_id: str, state) -> bool:
+        """Обновляет заявку по ответу API (PostOrderResponse, OrderState или событие потока)"""
+        status = REPORT_STATUSES.get(state.execution_report_status)
+        if status is None:
+            return False
+        return self.update(
+            order_id, status,
+            exchange_order_id=state.order_id or None,
+            lots_executed=state.lots_executed,
+            executed_price=money_to_float(state.executed_order_price)
+        )
+
+    async def wait(self, orders: List[Dict], timeout: float) -> bool:
+        """Ждет завершения заявок; False, если истек таймаут"""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        deadline = time.monotonic() + timeout
+        while True:
+            self._changed.clear()
+            with self._lock:
+                if all(self._by_id[order['order_id']]['status'] in FINAL_ORDER_STATUSES for order in orders):
+                    return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+
+    def finish(self, error: str = None, timed_out: bool = False):
+        """
+        Завершает исполнение: невыставленные заявки пропускаются
+
+        Args:
+            error: Ошибка, прервавшая исполнение
+            timed_out: Заявки этапа не исполнились за ORDER_FILL_TIMEOUT
+        """
+        with self._lock:
+            for order in self.orders:
+                if order['status'] == 'planned':
+                    order['status'] = 'skipped'
+                    if timed_out:
+                        order['error'] = 'Не выставлена: заявки предыдущего этапа не исполнены'
+                if order['status'] in FINAL_ORDER_STATUSES:
+                    ORDERS.inc(order['direction'], order['status'])
+
+            if error:
+                self.status, self.error = 'failed', error
+            elif self.cancel_requested:
+                self.status = 'cancelled'
+            elif timed_out:
+                self.status = 'timeout'
+                self.error = (f'Заявки не исполнены за {ORDER_FILL_TIMEOUT} с: невыполненные отменены, '
+                              'следующие этапы не выставлены')
+            elif all(order['status'] in FINAL_ORDER_STATUSES for order in self.orders):
+                self.status = 'completed'
+            else:
+                self.status = 'timeout'
+            self.finished_at = time.time()
+
+        if self._changed is not None:
+            self._changed.set()
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'execution_id': self.id,
+                'account_id': self.account_id,
+                'mode': self.mode,
+                'order_type': self.order_type,
+                'sandbox': self.sandbox,
+                'status': self.status,
+                'tracking': self.tracking,
+                'error': self.error,
+                'created_at': self.created_at,
+                'finished_at': self.finished_at,
+                'orders': [dict(order) for order in self.orders]
+            }
+
+
+class OrderExecutor:
+    """
+    Исполнение расчетов ребалансировки заявками
+
+    Заявки этапа выставляются параллельно (не больше ORDER_EXECUTION_WORKERS
+    одновременно) через лимитер токена. Ключ идемпотентности каждой заявки
+    (order_id) выводится из идентификатора исполнения, поэтому повтор
+    запроса - после ошибки сети, ответа по лимиту или повторного вызова
+    с тем же execution_id - не создает вторую заявку. Продажи выставляются
+    раньше покупок, и покупки ждут их завершения, чтобы использовать
+    освободившиеся средства; если продажи исполнены не полностью, покупки
+    уменьшаются на недополученную выручку (OrderExecution.limit_buys).
+
+    Исполнение отслеживается потоком состояний заявок, подписка на который
+    открывается до выставления. Опрос состояний включается, только если
+    поток недоступен (например, в песочнице без поддержки потоков).
+    """
+
+    def __init__(self, max_executions: int = ORDER_EXECUTIONS_MAX):
+        self.max_executions = max_executions
+        self._executions: Dict[Tuple, OrderExecution] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, owner, execution_id: str) -> Optional[OrderExecution]:
+        """Исполнение пользователя по идентификатору"""
+        with self._lock:
+            return self._executions.get((owner, execution_id))
+
+    def start(self, service, execution: OrderExecution) -> Tuple[OrderExecution, bool]:
+        """
+        Регистрирует исполнение и запускает его в фоновом цикле
+
+        Args:
+            service: AsyncTinkoffInvestService токена (для песочницы - с ее пулом клиентов)
+
+        Returns:
+            Исполнение и признак запуска; если исполнение с таким
+            идентификатором уже есть, возвращается оно без повторного запуска
+        """
+        key = (execution.owner, execution.id)
+        with self._lock:
+            existing = self._executions.get(key)
+            if existing is not None:
+                return existing, False
+            self._executions[key] = execution
+            while len(self._executions) > self.max_executions:
+                self._executions.popitem(last=False)
+
+        background_loop.submit(self._run(service, execution))
+        return execution, True
+
+    def cancel(self, service, execution: OrderExecution):
+        """Отменяет невыставленные и активные заявки исполнения"""
+        execution.cancel_requested = True
+        # После завершения исполнения состояния не отслеживаются, и отмена отмечается сразу
+        background_loop.run(self._cancel(service, execution, mark=execution.finished_at is not None))
+
+    async def _cancel(self, service, execution: OrderExecution, mark: bool = True):
+        await asyncio.gather(*(
+            self._cancel_order(service, execution, order, mark) for order in execution.live_orders()
+        ))
+
+    @staticmethod
+    async def _cancel_order(service, execution: OrderExecution, order: Dict, mark: bool = True):
+        """
+        Отменяет заявку
+
+        Args:
+            mark: Отметить заявку отмененной по ответу на запрос; иначе
+                итоговое состояние (с исполненными до отмены лотами) приходит
+                из потока состояний или опроса
+        """
+        try:
+            await service.cancel_order(order['account_id'], order['exchange_order_id'])
+        except Exception as e:
+            # Заявка могла исполниться до отмены - это покажет отслеживание
+            print(f"Ошибка при отмене заявки: {e}")
+            return
+        if mark:
+            execution.update(order['order_id'], 'cancelled')
+
+    async def _cancel_unfilled(self, service, execution: OrderExecution):
+        """
+        Отменяет невыполненные заявки прерванного исполнения
+
+        Отслеживание продолжает работать, пока отмены не подтверждены,
+        поэтому заявки не остаются в стакане без наблюдения. Заявки без
+        подтверждения за ORDER_CANCEL_TIMEOUT отмечаются по ответу на отмену.
+        """
+        live = execution.live_orders()
+        if not live:
+            return
+        await self._cancel(service, execution, mark=False)
+        if not await execution.wait(live, ORDER_CANCEL_TIMEOUT):
+            await self._cancel(service, execution)
+
+    async def _run(self, service, execution: OrderExecution):
+        ready = asyncio.Event()
+        tracker = asyncio.create_task(self._track(service, execution, ready))
+        try:
+            try:
+                await asyncio.wait_for(ready.wait(), ORDER_STREAM_READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+
+            timed_out = False
+            for stage in execution.stages():
+                if execution.cancel_requested:
+                    break
+                # Покупки, пропущенные из-за неисполненных продаж, не выставляются
+                stage = [order for order in stage if order['status'] == 'planned']
+                await self._submit(service, execution, stage)
+                if not await execution.wait(stage, ORDER_FILL_TIMEOUT):
+                    timed_out = True
+                    break
+                if stage and stage[0]['direction'] == 'sell':
+                    execution.limit_buys(stage)
+            if timed_out:
+                await self._cancel_unfilled(service, execution)
+            execution.finish(timed_out=timed_out)
+        except Exception as e:
+            print(f"Ошибка при исполнении заявок: {e}")
+            try:
+                await self._cancel_unfilled(service, execution)
+            except Exception as cancel_error:
+                print(f"Ошибка при отмене заявок: {cancel_error}")
+            execution.finish(str(e))
+        finally:
+            tracker.cancel()
+
+    async def _submit(self, service, execution: OrderExecution, orders: List[Dict]):
+        """Выставляет заявки этапа параллельно"""
+        prices = {}
+        if execution.order_type == 'limit':
+            # Лимитная цена - лучшая встречная цена стакана: она уже кратна шагу цены,
+            # а для облигаций, как и цена заявки, указана в процентах от номинала
+            prices = await service.get_best_prices(sorted({order['figi'] for order in orders}))
+        semaphore = asyncio.Semaphore(ORDER_EXECUTION_WORKERS)
+
+        async def submit(order: Dict):
+            price = None
+            if execution.order_type == 'limit':
+                bid, ask = prices.get(order['figi'], (None, None))
+                price = ask if order['direction'] == 'buy' else bid
+                if price is None:
+                    execution.update(order['order_id'], 'failed', 'Нет встречных заявок в стакане')
+                    return
+                execution.update(order['order_id'], price=money_to_float(price))
+
+            async with semaphore:
+                if execution.cancel_requested:
+                    execution.update(order['order_id'], 'skipped')
+                    return
+                try:
+                    response = await service.post_order(
+                        order['account_id'], order['figi'], order['lots'], ORDER_DIRECTIONS[order['direction']],
+                        ORDER_TYPES[execution.order_type], order['order_id'], price
+                    )
+                except Exception as e:
+                    print(f"Ошибка при выставлении заявки: {e}")
+                    execution.update(order['order_id'], 'failed', str(e))
+                    return
+            execution.apply_state(order['order_id'], response)
+            if execution.cancel_requested and response.order_id:
+                # Отмена пришла, пока заявка выставлялась
+                await self._cancel_order(service, execution, dict(order, exchange_order_id=response.order_id))
+
+        await asyncio.gather(*map(submit, orders))
+
+    async def _track(self, service, execution: OrderExecution, ready: asyncio.Event):
+        """Отслеживает состояния заявок потоком, а если он недоступен - опросом"""
+        account_ids = sorted({order['account_id'] for order in execution.orders})
+        if not account_ids:
+            ready.set()
+            return
+
+        try:
+            async for response in service.order_states(account_ids):
+                execution.tracking = 'stream'
+                ready.set()
+                state = getattr(response, 'order_state', None)
+                if state and state.order_request_id:
+                    execution.apply_state(state.order_request_id, state)
+        except Exception as e:
+            print(f"Ошибка потока состояний заявок: {e}")
+
+        execution.tracking = 'polling'
+        ready.set()
+        while True:
+            for order in execution.live_orders():
+                try:
+                    state = await service.get_order_state(order['account_id'], order['exchange_order_id'])
+                except Exception as e:
+                    print(f"Ошибка при получении состояния заявки: {e}")
+                    continue
+                execution.apply_state(order['order_id'], state)
+            await asyncio.sleep(ORDER_STATE_POLL_INTERVAL)
+
+
+# Исполнитель заявок процесса
+order_executor = OrderExecutor()
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from metrics import count_cache
+from serialization import dumps
+
+
+# Сколько секунд снимок портфеля считается свежим
+PORTFOLIO_CACHE_TTL = int(os.environ.get('PORTFOLIO_CACHE_TTL', 30))
+
+# Максимальный возраст снимка, по которому считается ребалансировка
+REBALANCE_SNAPSHOT_MAX_AGE = int(os.environ.get('REBALANCE_SNAPSHOT_MAX_AGE', 3600))
+
+# Максимальное количество снимков в памяти процесса
+PORTFOLIO_CACHE_MAX_SIZE = int(os.environ.get('PORTFOLIO_CACHE_MAX_SIZE', 1000))
+
+
+class PortfolioSnapshot:
+    """Снимок портфеля с метаданными для условных HTTP-ответов"""
+
+    __slots__ = ('data', 'etag', 'fetched_at', 'last_modified', 'engine', 'costs', 'bodies')
+
+    def __init__(self, data, etag: str, fetched_at: float, last_modified: float):
+        self.data = data
+        self.etag = etag
+        self.fetched_at = fetched_at
+        self.last_modified = last_modified
+        # Движок ребалансировки по позициям снимка, создается при первом расчете
+        self.engine = None
+        # Параметры издержек и модели издержек, создаются при первом расчете с издержками
+        self.costs = None
+        # Сжатые тела ответа по алгоритму сжатия, создаются при первом запросе
+        self.bodies = {}
+
+
+class PortfolioCache:
+    """
+    Кэш снимков портфелей по паре (пользователь, счет)
+
+    ETag вычисляется по содержимому, поэтому если после обновления портфель
+    не изменился, браузер по-прежнему получает 304 Not Modified.
+    """
+
+    def __init__(self, ttl: int = PORTFOLIO_CACHE_TTL, max_size: int = PORTFOLIO_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._snapshots = OrderedDict()  # (user_id, account_id) -> PortfolioSnapshot
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compute_etag(data) -> str:
+        """ETag по содержимому портфеля"""
+        return hashlib.sha1(dumps(data)).hexdigest()
+
+    def get(self, user_id: str, account_id: str, max_age: int = None) -> Optional[PortfolioSnapshot]:
+        """Возвращает снимок не старше max_age секунд (по умолчанию - TTL) или None"""
+        if max_age is None:
+            max_age = self.ttl
+
+        key = (user_id, account_id)
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is None or time.time() - snapshot.fetched_at >= max_age:
+                count_cache('snapshot', 0, 1)
+                return None
+            self._snapshots.move_to_end(key)
+        count_cache('snapshot', 1, 0)
+        return snapshot
+
+    def put(self, user_id: str, account_id: str, data) -> PortfolioSnapshot:
+        """Сохраняет новый снимок портфеля (Portfolio или словарь с моделями)"""
+        key = (user_id, account_id)
+        now = time.time()
+        etag = self.compute_etag(data)
+
+        with self._lock:
+            previous = self._snapshots.get(key)
+            # Время изменения сдвигается, только если изменилось содержимое
+            last_modified = previous.last_modified if previous and previous.etag == etag else now
+
+            snapshot = PortfolioSnapshot(data, etag, now, last_modified)
+            self._snapshots[key] = snapshot
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+
+        return snapshot
+
+    def invalidate_user(self, user_id: str):
+        """Удаляет все снимки пользователя"""
+        with self._lock:
+            for key in [key for key in self._snapshots if key[0] == user_id]:
+                del self._snapshots[key]
@@ -0,0 +1,211 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+import numpy as np
+from models import Portfolio
+from sqlite_pool import DATABASE_PATH, SQLitePool
+
+
+# Если состав портфеля не менялся, изменение только цен записывается не чаще раза в столько секунд
+PORTFOLIO_HISTORY_INTERVAL = int(os.environ.get('PORTFOLIO_HISTORY_INTERVAL', 900))
+
+
+def _digest(*parts: bytes) -> str:
+    return hashlib.sha1(b'\0'.join(parts)).hexdigest()[:16]
+
+
+class PortfolioHistory:
+    """
+    История снимков портфелей счетов
+
+    Каждый снимок - одна строка таблицы portfolio_history с ключом
+    (account_id, ts): ссылка на состав (список FIGI в portfolio_figi_sets,
+    общий для всех снимков с одним составом) и столбцы количеств и стоимостей
+    позиций в виде массивов float64. Поэтому выборка за месяцы читает по одной
+    короткой строке на снимок, а расчет по ней векторный.
+
+    Таблица только пополняется. Неизменившийся портфель не записывается,
+    а изменение только цен - не чаще раза в PORTFOLIO_HISTORY_INTERVAL секунд;
+    изменение состава (сделки, пополнения бумагами) записывается сразу.
+    Сравнение с последним снимком идет внутри пишущей транзакции, поэтому
+    воркеры, записывающие один счет, не дублируют снимки друг друга.
+    """
+
+    def __init__(self, db_path: str = None, interval: int = PORTFOLIO_HISTORY_INTERVAL):
+        if db_path is None:
+            db_path = DATABASE_PATH
+
+        self.db_path = db_path
+        self.pool = SQLitePool(db_path)
+        self.interval = interval
+        # Составы портфелей: список FIGI <-> id
+        self._figi_set_ids = {}
+        self._figi_sets = {}
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _init_db(self):
+        """Инициализация таблицы истории"""
+        conn = self.pool.connection()
+
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS portfolio_figi_sets (
+                    id INTEGER PRIMARY KEY,
+                    figis TEXT UNIQUE NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS portfolio_history (
+                    account_id TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    total_value REAL NOT NULL,
+                    currency TEXT,
+                    figi_set INTEGER NOT NULL,
+                    quantities BLOB NOT NULL,
+                    position_values BLOB NOT NULL,
+                    digest TEXT NOT NULL,
+                    holdings TEXT NOT NULL,
+                    PRIMARY KEY (account_id, ts)
+                ) WITHOUT ROWID
+            ''')
+
+    @staticmethod
+    def _last_record(conn, account_id: str) -> Optional[tuple]:
+        """Последний снимок счета: (digest, holdings, ts) или None"""
+        return conn.execute('''
+            SELECT digest, holdings, ts FROM portfolio_history
+            WHERE account_id = ? ORDER BY ts DESC LIMIT 1
+        ''', (account_id,)).fetchone()
+
+    def _figi_set_id(self, conn, figis: str) -> int:
+        """id состава портфеля (создается при первом появлении)"""
+        with self._lock:
+            figi_set = self._figi_set_ids.get(figis)
+        if figi_set is None:
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO portfolio_figi_sets (figis) VALUES (?)', (figis,))
+            figi_set = conn.execute('SELECT id FROM portfolio_figi_sets WHERE figis = ?', (figis,)).fetchone()[0]
+            with self._lock:
+                self._figi_set_ids[figis] = figi_set
+                self._figi_sets[figi_set] = figis.split('\n') if figis else []
+        return figi_set
+
+    def _figis(self, conn, figi_set: int) -> List[str]:
+        """Список FIGI состава портфеля по id"""
+        with self._lock:
+            figis = self._figi_sets.get(figi_set)
+        if figis is None:
+            text = conn.execute('SELECT figis FROM portfolio_figi_sets WHERE id = ?', (figi_set,)).fetchone()[0]
+            figis = text.split('\n') if text else []
+            with self._lock:
+                self._figi_set_ids[text] = figi_set
+                self._figi_sets[figi_set] = figis
+        return figis
+
+    def record(self, account_id: str, portfolio: Portfolio, ts: float = None) -> bool:
+        """
+        Добавляет снимок портфеля счета, если он отличается от последнего
+
+        Returns:
+            True, если снимок записан
+        """
+        ts = time.time() if ts is None else ts
+        # Пустой FIGI неотличим от пустого состава в списке через перевод строки
+        positions = [pos for pos in portfolio.positions if pos.figi]
+        figis = '\n'.join(pos.figi for pos in positions).encode()
+        quantities = np.array([pos.quantity for pos in positions], dtype=np.float64).tobytes()
+        values = np.array([pos.current_value for pos in positions], dtype=np.float64).tobytes()
+        holdings = _digest(figis, quantities)
+        digest = _digest(figis, quantities, values, str(portfolio.total_value).encode())
+
+        try:
+            conn = self.pool.connection()
+            figi_set = self._figi_set_id(conn, figis.decode())
+            with conn:
+                # Блокировка записи до чтения: другой воркер не вставит снимок между проверкой и вставкой
+                conn.execute('BEGIN IMMEDIATE')
+                last = self._last_record(conn, account_id)
+                if last is not None:
+                    last_digest, last_holdings, last_ts = last
+                    if digest == last_digest or ts <= last_ts:
+                        return False
+                    if holdings == last_holdings and ts - last_ts < self.interval:
+                        return False
+
+                conn.execute('''
+                    INSERT OR IGNORE INTO portfolio_history
+                        (account_id, ts, total_value, currency, figi_set, quantities, position_values, digest, holdings)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (account_id, ts, portfolio.total_value, portfolio.currency, figi_set,
+                      quantities, values, digest, holdings))
+            return True
+        except Exception as e:
+            print(f"Ошибка при записи истории портфеля: {e}")
+            return False
+
+    def _rows(self, conn, columns: str, account_id: str, since: float = None, until: float = None) -> List[tuple]:
+        return conn.execute(f'''
+            SELECT {columns} FROM portfolio_history
+            WHERE account_id = ? AND ts >= ? AND ts <= ?
+            ORDER BY ts
+        ''', (account_id, since or 0, until if until is not None else time.time())).fetchall()
+
+    def values(self, account_id: str, since: float = None, until: float = None) -> List[Dict]:
+        """Стоимость портфеля счета во времени"""
+        rows = self._rows(self.pool.connection(), 'ts, total_value, currency', account_id, since, until)
+        return [{'ts': ts, 'total_value': total, 'currency': currency} for ts, total, currency in rows]
+
+    def drift(self, account_id: str, target_weights: Dict[str, float],
+              since: float = None, until: float = None) -> List[Dict]:
+        """
+        Отклонение портфеля от целевых долей во времени
+
+        Args:
+            target_weights: Целевые доли в процентах (FIGI -> %)
+
+        Доли считаются от суммы позиций с целевой долей, а остальные позиции
+        (например, валюта) не учитываются - как в DriftTracker и расчете
+        ребалансировки, поэтому история совпадает с текущим отклонением.
+
+        Returns:
+            Для каждого снимка: максимальное отклонение доли одной позиции
+            (max_drift) и суммарное отклонение (total_drift, половина суммы
+            модулей) в процентных пунктах
+        """
+        conn = self.pool.connection()
+        rows = self._rows(conn, 'ts, total_value, figi_set, position_values', account_id, since, until)
+        result = []
+
+        # Подряд идущие снимки с одинаковым составом считаются одной матрицей
+        start = 0
+        while start < len(rows):
+            figi_set = rows[start][2]
+            end = start
+            while end < len(rows) and rows[end][2] == figi_set:
+                end += 1
+
+            held = self._figis(conn, figi_set)
+            held_set = set(held)
+            columns = [column for column, figi in enumerate(held) if figi in target_weights]
+            targets = np.array([target_weights[held[column]] for column in columns], dtype=np.float64)
+            # Целевые позиции, которых нет в портфеле, отклоняются на всю целевую долю
+            absent = [weight for figi, weight in target_weights.items() if figi not in held_set]
+
+            values = np.frombuffer(b''.join(row[3] for row in rows[start:end]), dtype=np.float64)
+            values = values.reshape(end - start, len(held))[:, columns]
+            totals = values.sum(axis=1, keepdims=True)
+            weights = np.divide(values, totals, out=np.zeros_like(values), where=totals > 0) * 100
+            deviation = np.abs(weights - targets)
+
+            max_drift = deviation.max(axis=1, initial=max(absent, default=0.0))
+            total_drift = (deviation.sum(axis=1) + sum(absent)) / 2
+
+            for row, row_max, row_total in zip(rows[start:end], np.round(max_drift, 4).tolist(),
+                                               np.round(total_drift, 4).tolist()):
+                result.append({'ts': row[0], 'total_value': row[1], 'max_drift': row_max, 'total_drift': row_total})
+            start = end
+
+        return result
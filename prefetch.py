@@ -0,0 +1,243 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+from async_service import run_async
+from portfolio_cache import PORTFOLIO_CACHE_TTL
+from sqlite_pool import DATABASE_PATH, SQLitePool
+
+
+# Включена ли фоновая предзагрузка портфелей
+PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', '1') == '1'
+
+# Пользователь считается активным, если входил или делал запросы за это время (секунды)
+PREFETCH_ACTIVE_WINDOW = int(os.environ.get('PREFETCH_ACTIVE_WINDOW', 1800))
+
+# Период обновления во время торгов (чуть меньше времени свежести снимка) и вне торгов (секунды)
+PREFETCH_INTERVAL_OPEN = int(os.environ.get('PREFETCH_INTERVAL_OPEN', max(PORTFOLIO_CACHE_TTL - 5, 5)))
+PREFETCH_INTERVAL_CLOSED = int(os.environ.get('PREFETCH_INTERVAL_CLOSED', 900))
+
+# Максимум пользователей за один цикл и одновременно загружаемых пользователей
+PREFETCH_MAX_USERS = int(os.environ.get('PREFETCH_MAX_USERS', 200))
+PREFETCH_CONCURRENCY = int(os.environ.get('PREFETCH_CONCURRENCY', 8))
+
+# Сколько секунд ждать загрузку портфелей одного пользователя
+PREFETCH_USER_TIMEOUT = int(os.environ.get('PREFETCH_USER_TIMEOUT', 60))
+
+# Торговое время Московской биржи по будням (часы по Москве)
+MARKET_OPEN_HOUR = int(os.environ.get('MARKET_OPEN_HOUR', 7))
+MARKET_CLOSE_HOUR = int(os.environ.get('MARKET_CLOSE_HOUR', 24))
+
+MOSCOW_TZ = timezone(timedelta(hours=3))
+
+
+def market_is_open(now: datetime = None) -> bool:
+    """Идут ли сейчас торги на Московской бирже (без учета праздников)"""
+    now = (now or datetime.now(timezone.utc)).astimezone(MOSCOW_TZ)
+    return now.weekday() < 5 and MARKET_OPEN_HOUR <= now.hour < MARKET_CLOSE_HOUR
+
+
+def prefetch_interval(now: datetime = None) -> int:
+    """Период обновления портфелей активных пользователей"""
+    return PREFETCH_INTERVAL_OPEN if market_is_open(now) else PREFETCH_INTERVAL_CLOSED
+
+
+def snapshot_max_age() -> Optional[int]:
+    """
+    Допустимый возраст снимка портфеля для обычного запроса страницы
+
+    Во время торгов - время свежести кэша (None). Вне торгов цены не меняются,
+    и снимок, обновленный планировщиком, подходит до следующего цикла
+    (с запасом на один пропущенный цикл).
+    """
+    if not PREFETCH_ENABLED or market_is_open():
+        return None
+    return PREFETCH_INTERVAL_CLOSED * 2
+
+
+# Время запуска процесса: отличает воркер от прежнего процесса с тем же pid
+PROCESS_STARTED = time.time()
+
+
+class PrefetchLeases:
+    """
+    Аренда предзагрузки пользователей воркерами в SQLite
+
+    Каждого активного пользователя в цикле загружает только один воркер -
+    владелец аренды. Владелец продлевает аренду каждый цикл, поэтому
+    пользователь закрепляется за воркером, а если воркер остановился,
+    после истечения аренды пользователя забирает другой.
+    """
+
+    def __init__(self, db_path: str = None):
+        if db_path is None:
+            db_path = DATABASE_PATH
+
+        self.db_path = db_path
+        self.pool = SQLitePool(db_path)
+        self._init_db()
+
+    def _init_db(self):
+        """Инициализация таблицы аренды"""
+        conn = self.pool.connection()
+
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS prefetch_leases (
+                    session_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+
+    @staticmethod
+    def owner() -> str:
+        """Идентификатор текущего процесса (воркера)"""
+        return f'{os.getpid()}:{PROCESS_STARTED}'
+
+    def claim(self, session_ids: List[str], ttl: float) -> List[str]:
+        """
+        Берет или продлевает аренду пользователей на ttl секунд
+
+        Returns:
+            Пользователи, аренда которых принадлежит текущему воркеру
+        """
+        owner = self.owner()
+        now = time.time()
+        claimed = []
+        conn = self.pool.connection()
+        with conn:
+            for session_id in session_ids:
+                cursor = conn.execute('''
+                    INSERT INTO prefetch_leases (session_id, owner, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        owner = excluded.owner,
+                        expires_at = excluded.expires_at
+                    WHERE prefetch_leases.owner = excluded.owner OR prefetch_leases.expires_at < ?
+                ''', (session_id, owner, now + ttl, now))
+                if cursor.rowcount:
+                    claimed.append(session_id)
+            # Аренды ушедших пользователей больше не нужны
+            conn.execute('DELETE FROM prefetch_leases WHERE expires_at < ?', (now - ttl,))
+        return claimed
+
+
+
+class PrefetchScheduler:
+    """
+    Фоновая предзагрузка счетов и портфелей активных пользователей
+
+    Поток планировщика периодически берет из базы пользователей, активных за
+    последние PREFETCH_ACTIVE_WINDOW секунд, и загружает их портфели в фоновом
+    цикле событий. Запросы идут через общий ограничитель (rate_limit.api_limiter),
+    поэтому лимиты токена соблюдаются, а совпавшие по времени запросы страницы
+    объединяются с запросами планировщика. Пользователи, переставшие заходить,
+    выпадают из выборки и больше не обновляются.
+
+    Планировщик работает в каждом воркере, но каждого пользователя в цикле
+    загружает только воркер, владеющий его арендой (PrefetchLeases), поэтому
+    нагрузка на API не умножается на число воркеров. Снимок остается в кэше
+    этого воркера, а запросы пользователя в другой воркер загружают портфель
+    как обычно - не чаще раза за время свежести кэша.
+    """
+
+    def __init__(self, db, load: Callable[[str], Awaitable], store: Callable[[str, object], None],
+                 leases: PrefetchLeases = None):
+        """
+        Args:
+            db: База пользователей (auth.UserDatabase)
+            load: Корутинная функция загрузки данных пользователя по токену
+            store: Функция сохранения загруженных данных (session_id, данные)
+            leases: Аренда пользователей воркерами (по умолчанию - в базе db)
+        """
+        self.db = db
+        self.load = load
+        self.store = store
+        self.leases = leases if leases is not None else PrefetchLeases(getattr(db, 'db_path', None))
+        self._requests = queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Запускает поток планировщика (лениво и заново после fork)"""
+        if not PREFETCH_ENABLED or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._requests = queue.Queue()
+                threading.Thread(target=self._run, daemon=True).start()
+                self._pid = os.getpid()
+
+    def request(self, session_id: str):
+        """Загрузить данные пользователя вне очереди (например, сразу после входа)"""
+        if PREFETCH_ENABLED:
+            self.start()
+            self._requests.put(session_id)
+
+    def _run(self):
+        while True:
+            interval = prefetch_interval()
+            due = time.monotonic() + interval
+            self.prefetch(self.claim(self.db.active_users(PREFETCH_ACTIVE_WINDOW, PREFETCH_MAX_USERS), interval))
+
+            # До следующего цикла обрабатываются только внеочередные запросы
+            while True:
+                timeout = due - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    session_id = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                self.prefetch([session_id])
+
+    def claim(self, session_ids: List[str], interval: float) -> List[str]:
+        """
+        Пользователи цикла, которых загружает этот воркер
+
+        Аренда живет два цикла: владелец успевает ее продлить, а после его
+        остановки пользователя забирает другой воркер. Если база аренды
+        недоступна, воркер загружает всех, как без координации.
+        """
+        if not session_ids:
+            return []
+        try:
+            return self.leases.claim(session_ids, 2 * interval + PREFETCH_USER_TIMEOUT)
+        except Exception as e:
+            print(f"Ошибка аренды предзагрузки: {e}")
+            return session_ids
+
+    def prefetch(self, session_ids):
+        """Загружает и сохраняет данные пользователей"""
+        users = [(session_id, self.db.get_token(session_id)) for session_id in session_ids]
+        users = [(session_id, token) for session_id, token in users if token]
+        if not users:
+            return
+
+        try:
+            results = run_async(self._load_all([token for _, token in users]),
+                                timeout=PREFETCH_USER_TIMEOUT * len(users))
+        except Exception as e:
+            print(f"Ошибка предзагрузки портфелей: {e}")
+            return
+
+        for (session_id, _), result in zip(users, results):
+            if isinstance(result, Exception):
+                print(f"Ошибка предзагрузки портфеля пользователя: {result}")
+                continue
+            try:
+                self.store(session_id, result)
+            except Exception as e:
+                print(f"Ошибка сохранения предзагруженного портфеля: {e}")
+
+    async def _load_all(self, tokens):
+        semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+        async def load(token):
+            async with semaphore:
+                return await asyncio.wait_for(self.load(token), PREFETCH_USER_TIMEOUT)
+
+        return await asyncio.gather(*[load(token) for token in tokens], return_exceptions=True)
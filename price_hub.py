@@ -0,0 +1,264 @@
+"""
+Хаб последних цен, общий для всех воркеров gunicorn
+
+Отдельный процесс держит один поток рыночных данных и последнюю цену
+каждого FIGI, а воркеры спрашивают цены у него через Unix-сокет. Запуск:
+
+    PRICE_HUB_SOCKET=/tmp/price_hub.sock python price_hub.py
+
+С флагом --offline хаб не подключается к API, а цены в него кладутся
+запросом put - так хаб можно проверить без сети. Хаб, подключенный
+к API, запрос put отклоняет, чтобы цены шли только из потока.
+
+Протокол - JSON по строке на запрос и ответ:
+    {"op": "get", "figis": [...]}     -> {"prices": {figi: цена}}
+    {"op": "watch", "figis": [...]}   -> {"ok": true}
+    {"op": "put", "prices": {...}}    -> {"ok": true} (только с --offline)
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+# Путь к Unix-сокету хаба цен (пусто - воркеры не используют хаб)
+PRICE_HUB_SOCKET = os.environ.get('PRICE_HUB_SOCKET', '')
+
+# Сокет по умолчанию для запуска хаба без PRICE_HUB_SOCKET
+DEFAULT_PRICE_HUB_SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_hub.sock')
+
+# Сколько секунд воркер ждет ответа хаба
+PRICE_HUB_TIMEOUT = float(os.environ.get('PRICE_HUB_TIMEOUT', 0.5))
+
+# Цены старше этого возраста хаб не отдает (секунды)
+PRICE_HUB_MAX_AGE = int(os.environ.get('PRICE_HUB_MAX_AGE', 3600))
+
+# FIGI, о которых воркеры не спрашивали дольше этого времени, отписываются (секунды)
+PRICE_HUB_WATCH_TTL = int(os.environ.get('PRICE_HUB_WATCH_TTL', 3600))
+
+
+class PriceHubServer:
+    """
+    Процесс хаба цен
+
+    FIGI, о которых спрашивают воркеры, подписываются в общем потоке
+    рыночных данных (price_stream.PriceStreamHub), а хаб сам служит
+    получателем его обновлений и хранит последнюю цену каждого инструмента.
+    FIGI, о которых не спрашивали дольше PRICE_HUB_WATCH_TTL, отписываются.
+    """
+
+    def __init__(self, socket_path: str, token: str = None, stream_hub=None):
+        self.socket_path = socket_path
+        self.token = token
+        if stream_hub is None and token:
+            from price_stream import PriceStreamHub
+            stream_hub = PriceStreamHub()
+        self.stream_hub = stream_hub
+        # Без потока рыночных данных цены кладутся только запросом put
+        self.offline = stream_hub is None
+        self._prices = {}  # figi -> (цена, время обновления)
+        self._watched = {}  # figi -> время последнего запроса
+
+    def put_nowait(self, item):
+        """Прием обновления из потока рыночных данных"""
+        if item is None:
+            return
+        figi, price = item
+        # Обновление могло прийти уже после отписки инструмента
+        if figi in self._watched:
+            self._prices[figi] = (price, time.time())
+
+    def watch(self, figis: List[str]):
+        """Подписка на цены новых FIGI и продление уже отслеживаемых"""
+        now = time.time()
+        added = [figi for figi in dict.fromkeys(figis) if figi and figi not in self._watched]
+        for figi in figis:
+            if figi:
+                self._watched[figi] = now
+        if added and self.stream_hub:
+            self.stream_hub.subscribe(self.token, added, listener=self)
+
+    def expire(self, now: float = None) -> List[str]:
+        """
+        Отписка от FIGI, о которых не спрашивали дольше PRICE_HUB_WATCH_TTL
+
+        Returns:
+            Список отписанных FIGI
+        """
+        now = time.time() if now is None else now
+        expired = [figi for figi, requested in self._watched.items() if now - requested >= PRICE_HUB_WATCH_TTL]
+        for figi in expired:
+            del self._watched[figi]
+            self._prices.pop(figi, None)
+        if expired and self.stream_hub:
+            self.stream_hub.unsubscribe(self.token, self, expired)
+        return expired
+
+    async def _expire_loop(self):
+        """Периодическая отписка от неиспользуемых FIGI"""
+        while True:
+            await asyncio.sleep(min(PRICE_HUB_WATCH_TTL, 60))
+            self.expire()
+
+    def prices(self, figis: List[str]) -> Dict[str, float]:
+        """Последние известные цены (не старше PRICE_HUB_MAX_AGE)"""
+        now = time.time()
+        result = {}
+        for figi in figis:
+            entry = self._prices.get(figi)
+            if entry and now - entry[1] < PRICE_HUB_MAX_AGE:
+                result[figi] = entry[0]
+        return result
+
+    def handle(self, request: Dict) -> Dict:
+        """Обработка одного запроса"""
+        op = request.get('op')
+        if op == 'get':
+            figis = request.get('figis', [])
+            self.watch(figis)
+            return {'prices': self.prices(figis)}
+        if op == 'watch':
+            self.watch(request.get('figis', []))
+            return {'ok': True}
+        if op == 'put':
+            if not self.offline:
+                return {'error': 'Операция put доступна только в режиме --offline'}
+            now = time.time()
+            for figi, price in request.get('prices', {}).items():
+                self._prices[figi] = (float(price), now)
+            return {'ok': True}
+        return {'error': f'Неизвестная операция: {op}'}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.handle(json.loads(line))
+                except (ValueError, TypeError, AttributeError) as e:
+                    response = {'error': f'Некорректный запрос: {e}'}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Запуск сервера на Unix-сокете"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+
+        expire_task = asyncio.create_task(self._expire_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expire_task.cancel()
+
+
+class PriceHubClient:
+    """
+    Клиент хаба цен для воркеров
+
+    Соединение с сокетом открывается одно на поток и переиспользуется.
+    Если хаб недоступен, запросы возвращают пустой результат, и
+    вызывающий код остается на ценах из снимка портфеля.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = PRICE_HUB_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _connection(self):
+        """Соединение текущего потока (после fork открывается заново)"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            conn = (sock, sock.makefile('rwb'))
+            self._local.conn = conn
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            for closable in reversed(conn):
+                try:
+                    closable.close()
+                except OSError:
+                    pass
+
+    def _request(self, request: Dict) -> Optional[Dict]:
+        # Второй попыткой переподключаемся, если хаб перезапускался
+        for attempt in range(2):
+            try:
+                _, stream = self._connection()
+                stream.write(json.dumps(request).encode() + b'\n')
+                stream.flush()
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError('хаб закрыл соединение')
+                return json.loads(line)
+            except (OSError, ValueError) as e:
+                self._close()
+                if attempt:
+                    print(f"Хаб цен недоступен: {e}")
+        return None
+
+    def get_prices(self, figis: List[str]) -> Dict[str, float]:
+        """Последние цены инструментов (FIGI без цены отсутствуют в ответе)"""
+        if not figis:
+            return {}
+        response = self._request({'op': 'get', 'figis': list(figis)})
+        return response.get('prices', {}) if response else {}
+
+    def watch(self, figis: List[str]):
+        """Просит хаб отслеживать цены инструментов"""
+        if figis:
+            self._request({'op': 'watch', 'figis': list(figis)})
+
+    def put_prices(self, prices: Dict[str, float]):
+        """Кладет цены в хаб (для проверки без подключения к API)"""
+        self._request({'op': 'put', 'prices': prices})
+
+
+# Клиент хаба цен процесса (None, если хаб не настроен)
+price_hub_client = PriceHubClient(PRICE_HUB_SOCKET) if PRICE_HUB_SOCKET else None
+
+
+if __name__ == '__main__':
+    socket_path = PRICE_HUB_SOCKET or DEFAULT_PRICE_HUB_SOCKET
+
+    token = None
+    if '--offline' not in sys.argv:
+        from tinkoff_service import get_token
+        token = get_token()
+
+    print(f"Хаб цен слушает {socket_path}" + (" (без подключения к API)" if token is None else ""))
+    print(f"Для воркеров: export PRICE_HUB_SOCKET={socket_path}")
+    try:
+        asyncio.run(PriceHubServer(socket_path, token).serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,411 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+from tinkoff.invest import AsyncClient, LastPriceInstrument
+from async_service import background_loop
+from client_pool import API_CLIENT_OPTIONS
+from models import Portfolio
+from price_hub import price_hub_client
+from tinkoff_service import nano_to_float, quotation_to_nano
+
+
+# Интервал комментариев keep-alive в потоке событий (секунды)
+PRICE_STREAM_KEEPALIVE = int(os.environ.get('PRICE_STREAM_KEEPALIVE', 15))
+
+# Пауза перед переподключением к потоку рыночных данных после ошибки (секунды)
+PRICE_STREAM_RECONNECT_DELAY = int(os.environ.get('PRICE_STREAM_RECONNECT_DELAY', 5))
+
+# Сколько инструментов подписывается в одном потоке рыночных данных (лимит API - 300)
+PRICE_STREAM_MAX_SUBSCRIPTIONS = int(os.environ.get('PRICE_STREAM_MAX_SUBSCRIPTIONS', 300))
+
+# Число потоков воркера gunicorn (--threads), от которого считается лимит потоков цен
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 16))
+
+# Сколько потоков цен (SSE) воркер обслуживает одновременно: каждый занимает поток gunicorn,
+# поэтому четверть потоков остается остальным запросам
+PRICE_STREAM_MAX_CONNECTIONS = int(os.environ.get('PRICE_STREAM_MAX_CONNECTIONS',
+                                                  max(GUNICORN_THREADS - GUNICORN_THREADS // 4, 1)))
+
+# Как часто воркер спрашивает у хаба цен новые цены открытых потоков (секунды)
+PRICE_STREAM_HUB_INTERVAL = float(os.environ.get('PRICE_STREAM_HUB_INTERVAL', 1))
+
+# Максимальное число неотправленных обновлений на одного слушателя
+PRICE_STREAM_QUEUE_SIZE = int(os.environ.get('PRICE_STREAM_QUEUE_SIZE', 1000))
+
+
+class _StreamShard:
+    """Поток MarketDataStream и назначенные ему FIGI"""
+
+    __slots__ = ('figis', 'stream', 'task')
+
+    def __init__(self):
+        self.figis = set()
+        self.stream = None
+        self.task = None
+
+
+class _TokenStreams:
+    """Слушатели, последние цены и потоки рыночных данных одного токена"""
+
+    __slots__ = ('listeners', 'prices', 'shards')
+
+    def __init__(self):
+        self.listeners = {}  # figi -> set(queue.Queue)
+        self.prices = {}  # figi -> последняя цена
+        self.shards: List[_StreamShard] = []
+
+
+class PriceStreamHub:
+    """
+    Общая подписка процесса на последние цены инструментов
+
+    Используется, если хаб цен не настроен (иначе цены идут из хаба, см.
+    HubPriceFeed). Потоки MarketDataStream открываются на токен пользователя, которому
+    нужны цены, поэтому лимиты токена расходуются только на его инструменты,
+    а когда уходит последний слушатель токена (или пользователь выходит,
+    см. close_token), его потоки закрываются. Каждый FIGI подписан у токена
+    один раз, сколько бы страниц его ни держали, а подписки распределяются
+    по потокам не больше PRICE_STREAM_MAX_SUBSCRIPTIONS в каждом.
+
+    Обновления раскладываются по очередям слушателей (queue.Queue), которые
+    читают потоки Flask. Потоки рыночных данных работают в фоновом цикле
+    событий процесса (см. async_service.BackgroundLoop), и подписки меняются
+    только там: _sync сверяет нужный набор FIGI с подписанным, поэтому
+    порядок выполнения subscribe и unsubscribe не важен.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, _TokenStreams] = {}
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        """После fork подписки родительского процесса недействительны"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._tokens = {}
+
+    def subscribe(self, token: str, figis: List[str], listener=None) -> queue.Queue:
+        """
+        Подписка на цены инструментов
+
+        Args:
+            token: Токен, которым открываются потоки рыночных данных
+            listener: Получатель обновлений с методом put_nowait
+                (по умолчанию создается новая очередь)
+
+        Returns:
+            Очередь, в которую приходят пары (figi, цена), а после
+            close_token - None. Уже известные цены кладутся в нее сразу.
+        """
+        if listener is None:
+            listener = queue.Queue(maxsize=PRICE_STREAM_QUEUE_SIZE)
+
+        with self._lock:
+            self._reset_after_fork()
+            state = self._tokens.setdefault(token, _TokenStreams())
+            for figi in figis:
+                state.listeners.setdefault(figi, set()).add(listener)
+                if figi in state.prices:
+                    listener.put_nowait((figi, state.prices[figi]))
+
+        background_loop.loop.call_soon_threadsafe(self._sync, token)
+        return listener
+
+    def unsubscribe(self, token: str, listener, figis: List[str]):
+        """Отписка слушателя; инструменты без слушателей отписываются от потока"""
+        with self._lock:
+            state = self._tokens.get(token)
+            if state is None:
+                return
+            for figi in figis:
+                listeners = state.listeners.get(figi)
+                if listeners is None:
+                    continue
+                listeners.discard(listener)
+                if not listeners:
+                    del state.listeners[figi]
+                    state.prices.pop(figi, None)
+
+        background_loop.loop.call_soon_threadsafe(self._sync, token)
+
+    def close_token(self, token: str):
+        """Закрывает потоки токена (выход пользователя); слушатели получают None"""
+        with self._lock:
+            state = self._tokens.get(token)
+            if state is None:
+                return
+            listeners = {listener for figi_listeners in state.listeners.values() for listener in figi_listeners}
+            state.listeners.clear()
+            state.prices.clear()
+
+        for listener in listeners:
+            try:
+                listener.put_nowait(None)
+            except queue.Full:
+                # Место для признака закрытия важнее непрочитанной цены
+                listener.get_nowait()
+                listener.put_nowait(None)
+
+        background_loop.loop.call_soon_threadsafe(self._sync, token)
+
+    def _sync(self, token: str):
+        """Приводит подписки потоков токена к набору FIGI слушателей (выполняется в фоновом цикле)"""
+        with self._lock:
+            state = self._tokens.get(token)
+            if state is None:
+                return
+            wanted = set(state.listeners)
+
+        subscribed = set()
+        for shard in state.shards:
+            removed = shard.figis - wanted
+            if removed:
+                shard.figis -= removed
+                if shard.stream is not None and shard.figis:
+                    shard.stream.last_price.unsubscribe([LastPriceInstrument(figi=figi) for figi in removed])
+            subscribed |= shard.figis
+
+        # Новые FIGI дописываются в потоки со свободным местом, а при нехватке - в новые
+        added = {}
+        for figi in sorted(wanted - subscribed):
+            shard = next((shard for shard in state.shards if len(shard.figis) < PRICE_STREAM_MAX_SUBSCRIPTIONS), None)
+            if shard is None:
+                shard = _StreamShard()
+                state.shards.append(shard)
+            shard.figis.add(figi)
+            added.setdefault(shard, []).append(figi)
+
+        for shard in list(state.shards):
+            if not shard.figis:
+                # Поток без FIGI завершается: _run проверяет набор перед каждым подключением
+                if shard.stream is not None:
+                    shard.stream.stop()
+                state.shards.remove(shard)
+            elif shard.task is None or shard.task.done():
+                shard.task = asyncio.get_running_loop().create_task(self._run(token, shard))
+            elif shard in added and shard.stream is not None:
+                shard.stream.last_price.subscribe([LastPriceInstrument(figi=figi) for figi in added[shard]])
+
+        with self._lock:
+            if not state.shards and not state.listeners and self._tokens.get(token) is state:
+                del self._tokens[token]
+
+    def _publish(self, token: str, figi: str, price: float):
+        """Рассылает новую цену слушателям инструмента"""
+        with self._lock:
+            state = self._tokens.get(token)
+            if state is None or figi not in state.listeners:
+                return
+            state.prices[figi] = price
+            listeners = list(state.listeners[figi])
+
+        for listener in listeners:
+            try:
+                listener.put_nowait((figi, price))
+            except queue.Full:
+                # Медленный клиент пропускает обновления, важна только последняя цена
+                pass
+
+    async def _run(self, token: str, shard: _StreamShard):
+        """Поток рыночных данных группы FIGI; переподключается, пока у нее есть FIGI"""
+        while shard.figis:
+            try:
+                async with AsyncClient(token, **API_CLIENT_OPTIONS) as client:
+                    if not shard.figis:
+                        break
+                    stream = client.create_market_data_stream()
+                    # Набор FIGI читается без await перед публикацией потока,
+                    # поэтому изменения из _sync не теряются
+                    stream.last_price.subscribe([LastPriceInstrument(figi=figi) for figi in shard.figis])
+                    shard.stream = stream
+
+                    async for response in stream:
+                        if response.last_price and response.last_price.price:
+                            last_price = response.last_price
+                            self._publish(token, last_price.figi, nano_to_float(quotation_to_nano(last_price.price)))
+            except Exception as e:
+                print(f"Ошибка потока рыночных данных: {e}")
+                await asyncio.sleep(PRICE_STREAM_RECONNECT_DELAY)
+            finally:
+                shard.stream = None
+
+
+class HubPriceFeed:
+    """
+    Цены из общего хаба цен (price_hub.py) с интерфейсом PriceStreamHub
+
+    Хаб держит одну подписку на каждый FIGI для всех пользователей и
+    воркеров. Воркер опрашивает его одним запросом за все FIGI открытых
+    потоков раз в PRICE_STREAM_HUB_INTERVAL и раскладывает изменившиеся
+    цены по очередям слушателей. Фоновый поток опроса работает, пока есть
+    слушатели.
+    """
+
+    def __init__(self, client, interval: float = PRICE_STREAM_HUB_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._listeners = {}  # слушатель -> (токен, set(figi))
+        self._prices = {}  # figi -> последняя разосланная цена
+        self._thread = None
+        self._pid = os.getpid()
+
+    def subscribe(self, token: str, figis: List[str], listener=None) -> queue.Queue:
+        """Подписка на цены инструментов (см. PriceStreamHub.subscribe)"""
+        if listener is None:
+            listener = queue.Queue(maxsize=PRICE_STREAM_QUEUE_SIZE)
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # После fork поток опроса родителя не работает
+                self._pid = os.getpid()
+                self._listeners, self._prices, self._thread = {}, {}, None
+            _, listener_figis = self._listeners.setdefault(listener, (token, set()))
+            listener_figis.update(figis)
+            known = [(figi, self._prices[figi]) for figi in figis if figi in self._prices]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+        for item in known:
+            listener.put_nowait(item)
+        return listener
+
+    def unsubscribe(self, token: str, listener, figis: List[str]):
+        """Отписка слушателя от инструментов"""
+        with self._lock:
+            entry = self._listeners.get(listener)
+            if entry is None:
+                return
+            entry[1].difference_update(figis)
+            if not entry[1]:
+                del self._listeners[listener]
+
+    def close_token(self, token: str):
+        """Отписывает слушателей токена (выход пользователя); они получают None"""
+        with self._lock:
+            listeners = [listener for listener, (owner, _) in self._listeners.items() if owner == token]
+            for listener in listeners:
+                del self._listeners[listener]
+
+        for listener in listeners:
+            try:
+                listener.put_nowait(None)
+            except queue.Full:
+                listener.get_nowait()
+                listener.put_nowait(None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._listeners:
+                    # Новый subscribe запустит поток заново
+                    self._thread = None
+                    self._prices = {}
+                    return
+                wanted = set().union(*(figis for _, figis in self._listeners.values()))
+
+            prices = self.client.get_prices(sorted(wanted))
+            with self._lock:
+                self._prices = {figi: price for figi, price in self._prices.items() if figi in wanted}
+                changed = {figi: price for figi, price in prices.items() if self._prices.get(figi) != price}
+                self._prices.update(changed)
+                deliveries = [(listener, [(figi, changed[figi]) for figi in figis if figi in changed])
+                              for listener, (_, figis) in self._listeners.items()]
+
+            for listener, items in deliveries:
+                for item in items:
+                    try:
+                        listener.put_nowait(item)
+                    except queue.Full:
+                        # Медленный клиент пропускает обновления, важна только последняя цена
+                        pass
+
+
+class ConnectionLimiter:
+    """Ограничение числа одновременно открытых потоков цен воркера"""
+
+    def __init__(self, limit: int = PRICE_STREAM_MAX_CONNECTIONS):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Optional[Callable[[], None]]:
+        """Занимает место; возвращает функцию его освобождения или None, если мест нет"""
+        with self._lock:
+            if self.active >= self.limit:
+                return None
+            self.active += 1
+
+        released = False
+
+        def release():
+            nonlocal released
+            with self._lock:
+                if not released:
+                    released = True
+                    self.active -= 1
+
+        return release
+
+
+# Подписка на цены и ограничение потоков цен процесса: с хабом цен подписка общая
+# для всех пользователей и воркеров, без него - потоки на токен пользователя
+price_stream_hub = PriceStreamHub()
+price_feed = HubPriceFeed(price_hub_client) if price_hub_client else price_stream_hub
+price_stream_connections = ConnectionLimiter()
+
+
+def portfolio_price_events(portfolio: Portfolio, token: str, hub=None) -> Iterator[str]:
+    """
+    Server-Sent Events с изменениями цен и стоимости позиций портфеля
+
+    Каждое событие содержит figi, новую цену, стоимость позиции и общую
+    стоимость портфеля. Облигации не транслируются: их последняя цена
+    задается в процентах от номинала, а не в валюте.
+
+    Args:
+        portfolio: Портфель, открытый на странице
+        token: Токен пользователя, которым открываются потоки рыночных данных
+        hub: Подписка на цены (по умолчанию - price_feed процесса)
+    """
+    hub = hub or price_feed
+    positions = {pos.figi: pos for pos in portfolio.positions if pos.type != 'bond'}
+    prices = {figi: pos.current_price for figi, pos in positions.items()}
+    values = {figi: pos.current_value for figi, pos in positions.items()}
+    total_value = portfolio.total_value
+
+    listener = hub.subscribe(token, list(positions))
+    try:
+        yield f'retry: {PRICE_STREAM_RECONNECT_DELAY * 1000}\n\n'
+        while True:
+            try:
+                item = listener.get(timeout=PRICE_STREAM_KEEPALIVE)
+            except queue.Empty:
+                # Комментарий не дает прокси закрыть соединение и выявляет отключение клиента
+                yield ': keep-alive\n\n'
+                continue
+
+            if item is None:
+                # Пользователь вышел: потоки его токена закрыты
+                return
+            figi, price = item
+
+            if price == prices[figi]:
+                continue
+
+            value = positions[figi].quantity * price
+            total_value += value - values[figi]
+            prices[figi] = price
+            values[figi] = value
+
+            event = {'figi': figi, 'current_price': price, 'current_value': value, 'total_value': total_value}
+            yield f'data: {json.dumps(event)}\n\n'
+    finally:
+        hub.unsubscribe(token, listener, list(positions))
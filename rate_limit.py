@@ -0,0 +1,203 @@
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable
+from grpc import StatusCode
+from tinkoff.invest import RequestError
+from metrics import count_cache
+
+
+# Лимиты запросов к API в минуту на токен по группам методов
+API_RATE_LIMITS = {
+    'users': int(os.environ.get('API_RATE_LIMIT_USERS', 100)),
+    'operations': int(os.environ.get('API_RATE_LIMIT_OPERATIONS', 200)),
+    'instruments': int(os.environ.get('API_RATE_LIMIT_INSTRUMENTS', 200)),
+    'market_data': int(os.environ.get('API_RATE_LIMIT_MARKET_DATA', 300)),
+    'orders': int(os.environ.get('API_RATE_LIMIT_ORDERS', 300)),
+}
+
+# Между сколькими воркерами делится лимит токена
+API_RATE_LIMIT_WORKERS = int(os.environ.get('API_RATE_LIMIT_WORKERS', 2))
+
+# Сколько ведер токенов держать; сверх этого удаляются полные ведра давно не обращавшихся токенов
+API_RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('API_RATE_LIMIT_MAX_BUCKETS', 1000))
+
+# Сколько раз повторять запрос, отклоненный по лимиту или недоступности API
+API_RETRY_ATTEMPTS = int(os.environ.get('API_RETRY_ATTEMPTS', 3))
+
+# Начальная и максимальная пауза перед повтором (секунды)
+API_RETRY_BASE_DELAY = float(os.environ.get('API_RETRY_BASE_DELAY', 0.5))
+API_RETRY_MAX_DELAY = float(os.environ.get('API_RETRY_MAX_DELAY', 30))
+
+# Коды ответа, после которых запрос имеет смысл повторить
+RETRYABLE_CODES = (StatusCode.RESOURCE_EXHAUSTED, StatusCode.UNAVAILABLE)
+
+
+class TokenBucket:
+    """
+    Ведро токенов: не больше per_minute запросов в минуту с допустимым всплеском
+
+    Используется только из фонового цикла событий, поэтому без блокировок.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = max(per_minute, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self) -> bool:
+        """Ведро восстановилось полностью - оно неотличимо от нового"""
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+    def pause(self, seconds: float):
+        """Запрещает запросы на время (после ответа RESOURCE_EXHAUSTED)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """Ждет, пока в ведре появится токен, и забирает его"""
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self.blocked_until - now
+            if wait <= 0:
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Пауза перед повтором: время до сброса лимита из метаданных ответа,
+    а без него - экспоненциальная задержка; в обоих случаях со случайной
+    добавкой, чтобы повторы разных запросов не совпадали
+    """
+    backoff = min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2 ** attempt)
+    reset = getattr(getattr(error, 'metadata', None), 'ratelimit_reset', None)
+    if reset:
+        return min(API_RETRY_MAX_DELAY, float(reset)) + random.uniform(0, API_RETRY_BASE_DELAY)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class ApiLimiter:
+    """
+    Ограничение и объединение запросов к Tinkoff Invest API
+
+    - для каждой пары (токен, группа методов) держится TokenBucket;
+      сверх max_buckets удаляются давно не использованные полные ведра;
+    - одинаковые запросы, которые уже выполняются, не отправляются
+      повторно: все вызывающие получают результат одного запроса;
+    - отказы по лимиту повторяются с паузой из ratelimit_reset.
+
+    Используется только из фонового цикла процесса (см. async_service.BackgroundLoop).
+    """
+
+    def __init__(self, limits: Dict[str, int] = None, workers: int = API_RATE_LIMIT_WORKERS,
+                 max_buckets: int = API_RATE_LIMIT_MAX_BUCKETS):
+        self.limits = limits or API_RATE_LIMITS
+        self.workers = max(workers, 1)
+        self.max_buckets = max_buckets
+        # Порядок - от давно не использованных к недавним
+        self._buckets: Dict[tuple, TokenBucket] = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._pid = None
+
+    def _check_fork(self):
+        """После fork задачи и цикл событий родителя недействительны"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._buckets = OrderedDict()
+            self._in_flight = {}
+
+    def bucket(self, token: str, group: str) -> TokenBucket:
+        """Ведро токенов для группы методов"""
+        self._check_fork()
+        key = (token, group)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.limits[group] / self.workers)
+            self._buckets[key] = bucket
+            self._evict_idle(keep=key)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict_idle(self, keep: tuple):
+        """
+        Удаляет полные ведра, начиная с давно не использованных, пока их
+        больше max_buckets. Неполные ведра хранят состояние лимита и остаются,
+        как и только что созданное ведро keep.
+        """
+        excess = len(self._buckets) - self.max_buckets
+        if excess <= 0:
+            return
+        idle = []
+        for key, bucket in self._buckets.items():
+            if len(idle) == excess:
+                break
+            if key != keep and bucket.full():
+                idle.append(key)
+        for key in idle:
+            del self._buckets[key]
+
+    async def call(self, token: str, group: str, request: Callable[[], Awaitable]):
+        """
+        Выполняет запрос с учетом лимита группы и повторами
+
+        Args:
+            request: Функция без аргументов, возвращающая корутину запроса
+        """
+        bucket = self.bucket(token, group)
+        for attempt in range(API_RETRY_ATTEMPTS + 1):
+            await bucket.acquire()
+            try:
+                return await request()
+            except RequestError as e:
+                if e.code not in RETRYABLE_CODES or attempt == API_RETRY_ATTEMPTS:
+                    raise
+                delay = retry_delay(e, attempt)
+                if e.code == StatusCode.RESOURCE_EXHAUSTED:
+                    # Остальные запросы этой группы тоже ждут сброса лимита
+                    bucket.pause(delay)
+                print(f"API ответило {e.code.name}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+
+    async def single_flight(self, key: Hashable, request: Callable[[], Awaitable]):
+        """
+        Объединяет одинаковые одновременные запросы
+
+        Пока выполняется запрос с ключом key, остальные вызовы с тем же
+        ключом ждут его результат. Отмена одного из ожидающих не отменяет
+        общий запрос.
+        """
+        self._check_fork()
+        task = self._in_flight.get(key)
+        # Попадание - запрос присоединился к уже выполняющемуся
+        count_cache('single_flight', task is not None, task is None)
+        if task is None:
+            task = asyncio.ensure_future(request())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+
+# Ограничитель запросов процесса
+api_limiter = ApiLimiter()
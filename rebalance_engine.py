@@ -0,0 +1,373 @@
+from typing import Dict, List, Tuple
+import numpy as np
+from models import Position
+
+
+# Ограничение числа шагов локального поиска на одну позицию
+LOT_SEARCH_STEPS_PER_POSITION = 20
+
+
+class RebalanceEngine:
+    """
+    Векторизованный расчет ребалансировки на NumPy
+
+    Позиции переводятся в массивы один раз, после чего любое количество
+    наборов целевых долей (сценариев) считается матричными операциями:
+    строки матриц - сценарии, столбцы - позиции.
+    """
+
+    def __init__(self, positions: List[Position]):
+        # При повторе FIGI используется последняя позиция, как и в словаре позиций
+        by_figi = {pos.figi: pos for pos in positions}
+
+        self.positions = list(by_figi.values())
+        self.figis = list(by_figi)
+        self.index = {figi: column for column, figi in enumerate(self.figis)}
+        self.values = np.array([pos.current_value for pos in self.positions], dtype=np.float64)
+        self.prices = np.array([pos.current_price for pos in self.positions], dtype=np.float64)
+        self.lot_sizes = np.array([pos.lot or 1 for pos in self.positions], dtype=np.int64)
+        self.holdings = np.array([pos.quantity for pos in self.positions], dtype=np.float64)
+
+    def weights_matrix(self, scenarios: List[Dict[str, float]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Матрица целевых долей по сценариям
+
+        Returns:
+            (weights, selected): доли в процентах и маска выбранных позиций,
+            обе размера (сценарии x позиции). Позиция выбрана, если ее FIGI
+            есть в сценарии, даже с нулевой долей.
+        """
+        weights = np.zeros((len(scenarios), len(self.figis)), dtype=np.float64)
+        selected = np.zeros((len(scenarios), len(self.figis)), dtype=bool)
+
+        for row, target_weights in enumerate(scenarios):
+            for figi, weight in target_weights.items():
+                column = self.index.get(figi)
+                if column is not None:
+                    weights[row, column] = weight
+                    selected[row, column] = True
+
+        return weights, selected
+
+    def solve(self, weights: np.ndarray, selected: np.ndarray, mode: str = 'buy_only') -> Dict[str, np.ndarray]:
+        """
+        Расчет ребалансировки для всех сценариев сразу
+
+        Args:
+            weights: Целевые доли в процентах (сценарии x позиции)
+            selected: Маска выбранных позиций (сценарии x позиции)
+            mode: Режим ребалансировки ('buy_only' или 'buy_and_sell')
+
+        Returns:
+            Dict массивов: current_total и new_total (по сценариям),
+            current_weights, target_values, diff_values и quantities
+            (сценарии x позиции)
+        """
+        values = np.where(selected, self.values, 0.0)
+        fractions = weights / 100
+        current_total = values.sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            current_weights = np.where(current_total[:, None] > 0, values / current_total[:, None] * 100, 0.0)
+
+            if mode == 'buy_only':
+                # Общая сумма, при которой ни одну позицию не нужно продавать:
+                # максимум по позициям из current_value / target_weight
+                required_totals = np.where(selected & (fractions > 0), values / fractions, 0.0)
+                new_total = required_totals.max(axis=1, initial=0.0)
+            else:
+                new_total = current_total
+
+            target_values = new_total[:, None] * fractions
+            diff_values = target_values - values
+            quantities = np.where(self.prices > 0, diff_values / self.prices, 0.0)
+
+        return {
+            'current_total': current_total,
+            'new_total': new_total,
+            'current_weights': current_weights,
+            'target_values': target_values,
+            'diff_values': diff_values,
+            'quantities': quantities
+        }
+
+    def solve_lots(self, weights: np.ndarray, selected: np.ndarray, mode: str = 'buy_only', budget: float = 0.0,
+                   costs=None, cost_aversion: float = 1.0) -> Dict:
+        """
+        Целочисленная ребалансировка в лотах для одного сценария
+
+        Минимизируется сумма квадратов отклонений стоимости позиций от
+        целевых (target_total * доля) при условии, что покупки за вычетом
+        продаж не превышают budget. Начальное решение - оптимум по каждой
+        позиции отдельно при цене бюджета, подобранной бисекцией, затем жадный
+        локальный поиск применяет лучший шаг из "купить лоты", "продать лот" и
+        "продать лот одной позиции и купить лот другой", пока целевая функция
+        уменьшается. Когда таких шагов нет, пробуется обмен "продать k лотов
+        одной позиции и купить m лотов другой" с k/m по отношению стоимостей
+        лотов - без него поиск застревает, если лоты позиций сильно различаются
+        по стоимости. Каждый шаг считается векторно, поэтому 100+ инструментов
+        решаются за миллисекунды.
+
+        С моделью издержек (CostModel) к целевой функции добавляются
+        комиссия, спред и налог шага, умноженные на cost_aversion * target_total / 100:
+        издержки в 1% портфеля равноценны cost_aversion п.п.² суммы квадратов
+        отклонений долей. Бюджет тогда учитывает цену сделки с комиссией.
+
+        Args:
+            weights: Целевые доли в процентах (позиции)
+            selected: Маска выбранных позиций
+            mode: 'buy_only' (только покупки) или 'buy_and_sell'
+            budget: Доступные денежные средства
+            costs: Модель издержек по позициям движка (CostModel) или None
+            cost_aversion: Вес издержек относительно отклонения долей
+
+        Returns:
+            Dict: lots (изменение в лотах по позициям), cash_used, traded_value
+            (сделки по текущим ценам), target_total, tracking_error
+        """
+        values = np.where(selected, self.values, 0.0)
+        fractions = np.where(selected, weights / 100, 0.0)
+        lot_values = self.prices * self.lot_sizes
+        tradable = selected & (lot_values > 0)
+
+        target_total = values.sum() + budget
+        targets = fractions * target_total
+
+        # Нижняя граница: в режиме покупки не продаем, иначе - не больше, чем есть
+        if mode == 'buy_only':
+            min_lots = np.zeros(len(values), dtype=np.int64)
+        else:
+            min_lots = -np.floor(self.holdings / self.lot_sizes).astype(np.int64)
+            min_lots = np.minimum(min_lots, 0)
+
+        # Деньги и издержки одного лота; без модели издержек сделки идут по текущей цене
+        if costs is None:
+            buy_cash = sell_cash = lot_values
+            buy_cost = sell_cost = np.zeros(len(values), dtype=np.float64)
+            cost_weight = 0.0
+        else:
+            buy_cash, sell_cash = costs.buy_cash, costs.sell_cash
+            buy_cost = buy_cash - lot_values
+            sell_cost = lot_values - sell_cash
+            cost_weight = cost_aversion * target_total / 100
+
+        def steps(lots: np.ndarray) -> Tuple[np.ndarray, ...]:
+            """Изменение денег и издержек при покупке (up) и продаже (down) одного лота"""
+            buying, selling = lots > 0, lots < 0
+            up_cash = np.where(selling, sell_cash, buy_cash)
+            down_cash = np.where(buying, -buy_cash, -sell_cash)
+            if costs is None:
+                return up_cash, buy_cost, down_cash, sell_cost
+            # Покупка при открытой продаже отменяет ее последний лот, продажа - следующий по FIFO
+            sold = np.maximum(-lots, 0)
+            up_cost = np.where(selling, -(sell_cost + costs.sell_tax(np.maximum(sold - 1, 0))), buy_cost)
+            down_cost = np.where(buying, -buy_cost, sell_cost + costs.sell_tax(sold))
+            return up_cash, up_cost, down_cash, down_cost
+
+        # Начальное решение: при цене бюджета μ задача распадается по позициям,
+        # и непрерывный оптимум (x_i - d_i)² + w·издержки + μ·деньги по стоимости
+        # сделки x_i - покупка x_i = d_i - (w·c_buy + μ·p_buy) / 2 или продажа
+        # x_i = d_i + (w·c_sell - μ·p_sell) / 2, иначе 0. Квадратичная функция одной
+        # переменной минимальна в ближайшем к оптимуму целом числе лотов, а μ
+        # подбирается бисекцией. Налог нелинеен, поэтому продажа считается для
+        # нескольких ставок и выбирается лучший по точной целевой функции вариант
+        with np.errstate(divide='ignore', invalid='ignore'):
+            unit = np.where(tradable, 1 / lot_values, 0.0)
+        diffs = np.where(tradable, targets - values, 0.0)
+        columns = np.arange(len(values))
+        sell_rates = [sell_cost * unit]
+        if costs is not None and costs.tax_rate:
+            # Ставки налога первого лота и продажи позиции целиком
+            all_lots = np.maximum(-min_lots, 1)
+            sell_rates += [(sell_cost + costs.sell_tax(np.zeros(len(values)))) * unit,
+                           (sell_cost + costs.tax(all_lots) / all_lots) * unit]
+
+        def position_terms(position_lots: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            """Деньги и издержки сделок при изменении позиций на position_lots (последняя ось - позиции)"""
+            selling = position_lots < 0
+            cash = np.where(selling, position_lots * sell_cash, position_lots * buy_cash)
+            if costs is None:
+                return cash, np.zeros(np.shape(position_lots), dtype=np.float64)
+            cost = np.where(selling, -position_lots * sell_cost + costs.tax(np.maximum(-position_lots, 0)),
+                            position_lots * buy_cost)
+            return cash, cost
+
+        def exchange(lots: np.ndarray, errors: np.ndarray, cash: float) -> Tuple[float, int, int, int, int, float]:
+            """
+            Лучший обмен: продажа k лотов позиции i и покупка m лотов позиции j
+
+            Для каждой пары k и m берутся около оптимального переноса стоимости
+            (e_i - e_j) / 2 и дополняются до доступного бюджета. Матрицы
+            кандидатов - строки j (покупка), столбцы i (продажа).
+
+            Returns:
+                (изменение целевой функции, i, j, k, m, изменение денег)
+            """
+            slack = budget + eps - cash
+            current_cash, current_cost = position_terms(lots)
+            sell_errors, buy_errors = errors[None, :], errors[:, None]
+            sell_values, buy_values = lot_values[None, :], lot_values[:, None]
+            max_sold = (lots - min_lots)[None, :]
+            allowed = tradable[None, :] & tradable[:, None] & off_diagonal & (max_sold >= 1)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                shift = (sell_errors - buy_errors) / 2
+                k_near = np.clip(np.nan_to_num(np.round(shift / sell_values)), 1, np.maximum(max_sold, 1))
+                m_fill = np.nan_to_num(np.floor((k_near * sell_values + slack) / buy_values))
+                m_near = np.maximum(np.nan_to_num(np.round(shift / buy_values)), 1)
+                k_fill = np.clip(np.nan_to_num(np.ceil((m_near * buy_values - slack) / sell_values)),
+                                 1, np.maximum(max_sold, 1))
+                m_ratio = np.nan_to_num(np.round(k_near * sell_values / buy_values))
+            candidates = [(k_near, m_fill), (k_near, m_fill - 1), (k_near, m_ratio), (k_fill, m_near),
+                          (k_fill + 1, m_near)]
+
+            best = (np.inf, 0, 0, 0, 0, 0.0)
+            for sold, bought in candidates:
+                valid = allowed & (sold <= max_sold) & (bought >= 1) & (bought < 2 ** 52)
+                sold = np.where(valid, sold, 1).astype(np.int64)
+                bought = np.where(valid, bought, 1).astype(np.int64)
+                seller_cash, seller_cost = position_terms(lots[None, :] - sold)
+                buyer_cash, buyer_cost = position_terms(lots[None, :] + bought.T)
+                delta_cash = seller_cash - current_cash[None, :] + buyer_cash.T - current_cash[:, None]
+                delta_cost = seller_cost - current_cost[None, :] + buyer_cost.T - current_cost[:, None]
+                gain = ((sell_errors - sold * sell_values) ** 2 - sell_errors ** 2 +
+                        (buy_errors + bought * buy_values) ** 2 - buy_errors ** 2 + cost_weight * delta_cost)
+                gain = np.where(valid & (delta_cash <= slack), gain, np.inf)
+                index = int(np.argmin(gain))
+                if gain.flat[index] < best[0]:
+                    buy, sell = divmod(index, len(values))
+                    best = (gain.flat[index], sell, buy, int(sold.flat[index]), int(bought.flat[index]),
+                            float(delta_cash.flat[index]))
+            return best
+
+        def objective(candidates: np.ndarray, mu: float) -> np.ndarray:
+            selling = candidates < 0
+            trade_cash = np.where(selling, candidates * sell_cash, candidates * buy_cash)
+            cost = np.where(selling, -candidates * sell_cost + costs.tax(np.maximum(-candidates, 0)),
+                            candidates * buy_cost)
+            return (diffs - candidates * lot_values) ** 2 + cost_weight * cost + mu * trade_cash
+
+        def rounded(mu: float) -> Tuple[np.ndarray, float]:
+            buy = np.maximum(diffs - (cost_weight * buy_cost * unit + mu * buy_cash * unit) / 2, 0.0)
+            sells = [np.minimum(diffs + (cost_weight * rate - mu * sell_cash * unit) / 2, 0.0) for rate in sell_rates]
+            if costs is None:
+                lots = np.round((buy + sells[0]) * unit)
+            else:
+                candidates = np.round(np.array([buy] + sells) * unit)
+                candidates = np.vstack([np.maximum(candidates, min_lots), np.zeros(len(values))])
+                lots = candidates[np.argmin(objective(candidates, mu), axis=0), columns]
+                # Уточнение продажи по приросту налога у выбранного числа лотов
+                rate = (sell_cost + costs.sell_tax(np.maximum(-lots, 0))) * unit
+                sell = np.minimum(diffs + (cost_weight * rate - mu * sell_cash * unit) / 2, 0.0)
+                candidates = np.vstack([lots, np.maximum(np.round(sell * unit), min_lots)])
+                lots = candidates[np.argmin(objective(candidates, mu), axis=0), columns]
+            lots = np.where(tradable, np.maximum(lots, min_lots), 0).astype(np.int64)
+            return lots, float(np.where(lots > 0, lots * buy_cash, lots * sell_cash).sum())
+
+        lots, lots_cash = rounded(0.0)
+        if lots_cash > budget:
+            low, high = 0.0, 1.0
+            while rounded(high)[1] > budget and high < 1e300:
+                low, high = high, high * 2
+            for _ in range(60):
+                middle = (low + high) / 2
+                if rounded(middle)[1] > budget:
+                    low = middle
+                else:
+                    high = middle
+            lots, _ = rounded(high)
+
+        errors = values + lots * lot_values - targets
+        cash = float(np.where(lots > 0, lots * buy_cash, lots * sell_cash).sum())
+        eps = 1e-9 * max(target_total, 1.0)
+
+        # Если округление вышло за бюджет, убираем лоты с наименьшим ухудшением
+        while cash > budget + eps:
+            can_remove = tradable & (lots > min_lots)
+            if not can_remove.any():
+                break
+            _, _, down_cash, down_cost = steps(lots)
+            cost = np.where(can_remove, lot_values * (lot_values - 2 * errors) + cost_weight * down_cost, np.inf)
+            i = int(np.argmin(cost))
+            lots[i] -= 1
+            errors[i] -= lot_values[i]
+            cash += down_cash[i]
+
+        # Локальный поиск: лучший из одиночных и парных шагов
+        off_diagonal = ~np.eye(len(values), dtype=bool)
+        for _ in range(LOT_SEARCH_STEPS_PER_POSITION * len(values) + 1):
+            # Изменение целевой функции при покупке и продаже одного лота
+            up_cash, up_cost, down_cash, down_cost = steps(lots)
+            up_gain = np.where(tradable, lot_values * (lot_values + 2 * errors) + cost_weight * up_cost, np.inf)
+            down_gain = np.where(
+                tradable & (lots > min_lots), lot_values * (lot_values - 2 * errors) + cost_weight * down_cost, np.inf
+            )
+
+            # Одиночная покупка берет сразу выгоднейшее число лотов, пока издержки лота постоянны
+            with np.errstate(divide='ignore', invalid='ignore'):
+                counts = np.nan_to_num(np.minimum(
+                    np.round(-(2 * lot_values * errors + cost_weight * up_cost) / (2 * lot_values ** 2)),
+                    np.floor((budget + eps - cash) / up_cash)
+                ))
+            counts = np.where(lots >= 0, np.maximum(counts, 1), 1).astype(np.int64)
+            up = np.where(
+                cash + counts * up_cash <= budget + eps,
+                counts * lot_values * (counts * lot_values + 2 * errors) + cost_weight * counts * up_cost, np.inf
+            )
+            up = np.where(tradable, up, np.inf)
+
+            best_up = int(np.argmin(up))
+            best_down = int(np.argmin(down_gain))
+            # Лучшая пара - лучшие продажа и покупка, если они разные и укладываются
+            # в бюджет; иначе перебираем все пары
+            best_buy = int(np.argmin(up_gain))
+            if best_down != best_buy and cash + down_cash[best_down] + up_cash[best_buy] <= budget + eps:
+                pair = (down_gain[best_down] + up_gain[best_buy], (best_down, best_buy))
+            else:
+                pairs = down_gain[:, None] + up_gain[None, :]
+                pairs = np.where(
+                    off_diagonal & (cash + down_cash[:, None] + up_cash[None, :] <= budget + eps),
+                    pairs, np.inf
+                )
+                best_pair = int(np.argmin(pairs))
+                pair = (pairs.flat[best_pair], divmod(best_pair, len(values)))
+            moves = [
+                (up[best_up], (None, best_up)),
+                (down_gain[best_down], (best_down, None)),
+                pair
+            ]
+            gain, (sell, buy) = min(moves, key=lambda move: move[0])
+            if not gain < -eps:
+                gain, sell, buy, sold, bought, delta_cash = exchange(lots, errors, cash)
+                if not gain < -eps:
+                    break
+                lots[sell] -= sold
+                errors[sell] -= sold * lot_values[sell]
+                lots[buy] += bought
+                errors[buy] += bought * lot_values[buy]
+                cash += delta_cash
+                continue
+
+            if sell is not None:
+                lots[sell] -= 1
+                errors[sell] -= lot_values[sell]
+                cash += down_cash[sell]
+            if buy is not None:
+                count = counts[buy] if sell is None else 1
+                lots[buy] += count
+                errors[buy] += count * lot_values[buy]
+                cash += count * up_cash[buy]
+
+        new_values = values + lots * lot_values
+        new_total = new_values.sum()
+        tracking_error = 0.0
+        if new_total > 0:
+            tracking_error = float(np.sqrt(np.sum(np.where(selected, new_values / new_total - fractions, 0.0) ** 2)) * 100)
+
+        return {
+            'lots': lots,
+            'cash_used': cash,
+            'traded_value': float(lots @ lot_values),
+            'target_total': float(target_total),
+            'tracking_error': tracking_error
+        }
@@ -0,0 +1,99 @@
+import gzip
+import json
+import os
+from typing import Callable, Dict, Optional
+from flask import Response, request
+from models import to_json_compatible
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Библиотека сериализации JSON: auto (orjson, если установлен), orjson или json
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+# Ответы меньше этого размера (байт) не сжимаются
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', 1024))
+
+# Уровни сжатия gzip и brotli
+RESPONSE_GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', 6))
+RESPONSE_BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', 5))
+
+
+def _json_dumps(data) -> bytes:
+    return json.dumps(data, default=to_json_compatible, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _orjson_dumps(data) -> bytes:
+    return orjson.dumps(data, default=to_json_compatible, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+# Доступные сериализаторы: имя -> функция (данные -> bytes)
+SERIALIZERS: Dict[str, Callable] = {'json': _json_dumps}
+if orjson is not None:
+    SERIALIZERS['orjson'] = _orjson_dumps
+
+# Доступные алгоритмы сжатия в порядке предпочтения
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+COMPRESSORS['gzip'] = lambda body: gzip.compress(body, RESPONSE_GZIP_LEVEL)
+
+
+def get_serializer(name: str = JSON_BACKEND) -> Callable:
+    """Сериализатор по имени; при недоступной библиотеке - стандартный json"""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in SERIALIZERS:
+        print(f"Сериализатор {name} недоступен, используется json")
+        name = 'json'
+    return SERIALIZERS[name]
+
+
+# Сериализатор процесса
+dumps = get_serializer()
+
+
+def accepted_encoding() -> Optional[str]:
+    """Предпочтительный алгоритм сжатия, который принимает клиент текущего запроса"""
+    for encoding in COMPRESSORS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def json_response(data, status: int = 200, etag: str = None, bodies: Dict[str, bytes] = None) -> Response:
+    """
+    JSON-ответ со сжатием gzip/br по заголовку Accept-Encoding
+
+    Args:
+        etag: ETag содержимого; для сжатого ответа к нему добавляется алгоритм
+        bodies: Кэш сжатых тел ответа (алгоритм -> bytes) для неизменяемых данных,
+            например снимка портфеля: сериализация и сжатие выполняются один раз
+    """
+    encoding = accepted_encoding()
+    body = bodies.get(encoding) if bodies and encoding else None
+
+    if body is None:
+        body = dumps(data)
+        if encoding and len(body) >= RESPONSE_COMPRESSION_MIN_SIZE:
+            body = COMPRESSORS[encoding](body)
+            if bodies is not None:
+                bodies[encoding] = body
+        else:
+            encoding = None
+
+    response = Response(body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(f'{etag}-{encoding}' if encoding else etag)
+    return response
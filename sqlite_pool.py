@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import threading
+
+
+# Путь к базе пользователей, кэша инструментов и истории портфелей
+DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db'))
+
+# Сколько миллисекунд ждать освобождения блокировки базы
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+
+
+class SQLitePool:
+    """
+    Соединения с SQLite, по одному на поток
+
+    Соединение открывается один раз на поток и переиспользуется, поэтому
+    подготовленные выражения остаются в кэше соединения между запросами.
+    База работает в режиме WAL: читатели не блокируют писателя, и
+    параллельные входы из разных воркеров не получают "database is locked".
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT / 1000, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (после fork открывается заново)"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
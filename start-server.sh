@@ -14,6 +14,8 @@ fi
 # Получаем имя пользователя и путь
 CURRENT_USER=$(whoami)
 CURRENT_DIR=$(pwd)
+# Потоков на воркер gunicorn; от этого числа считается лимит потоков цен (SSE)
+GUNICORN_THREADS=${GUNICORN_THREADS:-16}
 
 echo "📁 Директория: $CURRENT_DIR"
 echo "👤 Пользователь: $CURRENT_USER"
@@ -40,9 +42,12 @@ User=$CURRENT_USER
 WorkingDirectory=$CURRENT_DIR
 Environment="PATH=$CURRENT_DIR/venv/bin"
 Environment="PORT=5001"
+Environment="GUNICORN_THREADS=$GUNICORN_THREADS"
 
 ExecStart=$CURRENT_DIR/venv/bin/gunicorn \\
     --workers 2 \\
+    --worker-class gthread \\
+    --threads $GUNICORN_THREADS \\
     --bind 0.0.0.0:5001 \\
     --timeout 120 \\
     --access-logfile $CURRENT_DIR/access.log \\
@@ -0,0 +1,82 @@
+"""
+Проверка расчета в лотах (RebalanceEngine.solve_lots) полным перебором
+
+Запуск: python -m unittest test_rebalance_engine
+"""
+import random
+import unittest
+import numpy as np
+from models import Position
+from rebalance_engine import RebalanceEngine
+
+
+def make_engine(lot_sizes, prices, held_lots):
+    positions = [
+        Position(f'F{i}', f'F{i}', f'F{i}', 'share', lot, lot * count, price, lot * count * price, 'rub')
+        for i, (lot, price, count) in enumerate(zip(lot_sizes, prices, held_lots))
+    ]
+    return RebalanceEngine(positions)
+
+
+def squared_error(engine, weights, lots, budget):
+    targets = weights / 100 * (engine.values.sum() + budget)
+    return float(np.sum((engine.values + lots * engine.prices * engine.lot_sizes - targets) ** 2))
+
+
+def brute_force(engine, weights, mode, budget):
+    """Минимальная сумма квадратов отклонений среди всех допустимых решений"""
+    lot_values = engine.prices * engine.lot_sizes
+    if mode == 'buy_only':
+        min_lots = np.zeros(len(lot_values), dtype=np.int64)
+    else:
+        min_lots = -np.floor(engine.holdings / engine.lot_sizes).astype(np.int64)
+    # Больше, чем на все деньги от продажи всего остального, не купить
+    cash = budget - float(min_lots @ lot_values)
+    grids = np.meshgrid(*[np.arange(low, int(cash // value) + 2) for low, value in zip(min_lots, lot_values)],
+                        indexing='ij')
+    candidates = np.stack([grid.ravel() for grid in grids], axis=1)
+    candidates = candidates[candidates @ lot_values <= budget + 1e-6]
+    targets = weights / 100 * (engine.values.sum() + budget)
+    return float(np.min(np.sum((engine.values + candidates * lot_values - targets) ** 2, axis=1)))
+
+
+class SolveLotsTest(unittest.TestCase):
+
+    def check(self, lot_sizes, prices, held_lots, weights, mode, budget):
+        engine = make_engine(lot_sizes, prices, held_lots)
+        matrix, selected = engine.weights_matrix([{f'F{i}': weight for i, weight in enumerate(weights)}])
+        result = engine.solve_lots(matrix[0], selected[0], mode, budget)
+
+        self.assertLessEqual(result['cash_used'], budget + 1e-6)
+        got = squared_error(engine, matrix[0], result['lots'], budget)
+        best = brute_force(engine, matrix[0], mode, budget)
+        return got, best
+
+    def test_lots_of_different_value(self):
+        # Лоты в 10 и 550 рублей: выгодный обмен - несколько лотов одной позиции на лот другой
+        rng = random.Random(0)
+        for _ in range(200):
+            held = [rng.randint(0, 200), rng.randint(0, 40)]
+            if not any(held):
+                continue
+            first = rng.uniform(1, 99)
+            got, best = self.check([10, 100], [1, 5.5], held, [first, 100 - first], 'buy_and_sell', 0.0)
+            self.assertLessEqual(got, best * (1 + 1e-9) + 1e-6, held)
+
+    def test_two_positions_match_brute_force(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            lot_sizes = [rng.choice([1, 10, 100]) for _ in range(2)]
+            prices = [round(rng.uniform(0.5, 60), 1) for _ in range(2)]
+            held = [rng.randint(0, 30) for _ in range(2)]
+            if not any(held):
+                continue
+            first = rng.uniform(1, 99)
+            mode = rng.choice(['buy_only', 'buy_and_sell'])
+            budget = rng.choice([0.0, rng.uniform(0, 2000)])
+            got, best = self.check(lot_sizes, prices, held, [first, 100 - first], mode, budget)
+            self.assertLessEqual(got, best * (1 + 1e-9) + 1e-6, (lot_sizes, prices, held, mode, budget))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,54 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 from typing import List, Dict, Optional
-from tinkoff.invest import Client, InstrumentIdType
+from tinkoff.invest import InstrumentIdType
 from tinkoff.invest.schemas import MoneyValue, Quotation
+from client_pool import client_pool as default_client_pool
+from metrics import SERVICE_SECONDS, count_cache
+from models import AccountPosition, Operation, Portfolio, Position
+from rebalance_engine import RebalanceEngine
+
+
+# Число нано-единиц в единице: Quotation и MoneyValue хранят дробную часть в nano
+NANO = 1_000_000_000
+
+# Максимальное число параллельных запросов информации об инструментах
+INSTRUMENT_LOOKUP_WORKERS = int(os.environ.get('INSTRUMENT_LOOKUP_WORKERS', 8))
+
+
+def quotation_to_nano(quotation) -> int:
+    """
+    Quotation или MoneyValue в целое число нано-единиц (фиксированная точка)
+    
+    units и nano в API имеют одинаковый знак, поэтому значение точное
+    и для отрицательных чисел. Арифметика над такими числами точная,
+    а во float они переводятся только при формировании ответа.
+    """
+    return quotation.units * NANO + quotation.nano
+
+
+def nano_mul(a: int, b: int) -> int:
+    """Произведение двух чисел в нано-единицах с округлением до нано"""
+    product = a * b
+    if product >= 0:
+        return (product + NANO // 2) // NANO
+    return -((-product + NANO // 2) // NANO)
+
+
+def nano_to_float(value: int) -> float:
+    """Число в нано-единицах во float для JSON-ответа"""
+    return value / NANO
 
 
 def quotation_to_decimal(quotation: Quotation) -> Decimal:
     """Преобразование Quotation в Decimal"""
-    return Decimal(quotation.units) + Decimal(quotation.nano) / Decimal(1_000_000_000)
+    return Decimal(quotation_to_nano(quotation)).scaleb(-9)
 
 
 def money_value_to_decimal(money: MoneyValue) -> Decimal:
     """Преобразование MoneyValue в Decimal"""
-    return Decimal(money.units) + Decimal(money.nano) / Decimal(1_000_000_000)
+    return Decimal(quotation_to_nano(money)).scaleb(-9)
 
 
 def get_token() -> str:
@@ -33,74 +69,336 @@ def get_token() -> str:
     raise ValueError("Токен не найден! Укажите TINKOFF_TOKEN в переменной окружения или создайте файл token.txt")
 
 
+def instrument_info(instrument) -> Dict:
+    """Справочная информация об инструменте, которая нужна приложению"""
+    return {
+        'name': instrument.name,
+        'ticker': instrument.ticker,
+        'type': instrument.instrument_type,
+        'lot': instrument.lot
+    }
+
+
+def build_accounts(accounts) -> List[Dict]:
+    """Преобразование ответа get_accounts в формат API приложения"""
+    return [
+        {
+            'id': acc.id,
+            'name': acc.name,
+            'type': acc.type,
+            'status': acc.status
+        }
+        for acc in accounts.accounts
+    ]
+
+
+def build_portfolio(portfolio, instruments: Dict[str, Dict]) -> Portfolio:
+    """
+    Преобразование ответа get_portfolio в формат API приложения
+    
+    Args:
+        portfolio: Ответ operations.get_portfolio
+        instruments: Информация об инструментах (figi -> {'name', 'ticker', 'type', 'lot'})
+    """
+    positions = []
+    for position in portfolio.positions:
+        instrument = instruments.get(position.figi)
+        
+        # Расчет текущей стоимости позиции в нано-единицах
+        quantity = quotation_to_nano(position.quantity)
+        current_price = quotation_to_nano(position.current_price) if position.current_price else 0
+        current_value = nano_mul(quantity, current_price)
+        
+        positions.append(Position(
+            position.figi,
+            instrument['name'] if instrument else position.figi,
+            instrument['ticker'] if instrument else '',
+            instrument['type'] if instrument else '',
+            instrument['lot'] if instrument else 1,
+            nano_to_float(quantity),
+            nano_to_float(current_price),
+            nano_to_float(current_value),
+            position.current_price.currency if position.current_price else 'RUB'
+        ))
+    
+    total_value = quotation_to_nano(portfolio.total_amount_portfolio)
+    
+    return Portfolio(positions, nano_to_float(total_value), portfolio.total_amount_portfolio.currency)
+
+
+def build_operations(items) -> List[Dict]:
+    """
+    Преобразование операций из ответа get_operations_by_cursor для локального хранилища
+
+    Суммы остаются в нано-единицах; количество - исполненное количество
+    бумаг (для операций без бумаг - 0).
+    """
+    return [
+        {
+            'id': item.id,
+            'parent_id': item.parent_operation_id,
+            'date': item.date.timestamp(),
+            'type': item.type.name,
+            'figi': item.figi,
+            'instrument_type': item.instrument_type,
+            'name': item.name,
+            'quantity': item.quantity_done or item.quantity,
+            'payment': quotation_to_nano(item.payment),
+            'price': quotation_to_nano(item.price) if item.price else 0,
+            'currency': item.payment.currency
+        }
+        for item in items
+    ]
+
+
+def reprice_positions(positions: List[Position], prices: Dict[str, float]) -> List[Position]:
+    """
+    Копии позиций с новыми ценами
+    
+    Облигации и позиции без новой цены не меняются: цена облигации
+    в рыночных данных задается в процентах от номинала.
+    """
+    repriced = []
+    for pos in positions:
+        price = prices.get(pos.figi)
+        if price is None or pos.type == 'bond':
+            repriced.append(pos)
+        else:
+            repriced.append(pos.replace(current_price=price, current_value=pos.quantity * price))
+    return repriced
+
+
+def aggregate_portfolios(accounts: List[Dict], portfolios: Dict[str, Portfolio]) -> Portfolio:
+    """
+    Сводный портфель по нескольким счетам
+    
+    Позиции с одинаковым FIGI суммируются, а в поле accounts каждой
+    позиции сохраняется разбивка по счетам.
+    
+    Args:
+        accounts: Список счетов (результат get_accounts)
+        portfolios: Портфели счетов (account_id -> портфель или {'error': ...})
+    """
+    account_names = {acc['id']: acc['name'] for acc in accounts}
+    merged = {}
+    total_value = 0.0
+    currency = 'rub'
+    
+    for account_id, portfolio in portfolios.items():
+        if not isinstance(portfolio, Portfolio):
+            continue
+        
+        total_value += portfolio.total_value
+        currency = portfolio.currency
+        
+        for position in portfolio.positions:
+            item = merged.get(position.figi)
+            if item is None:
+                item = position.replace(quantity=0.0, current_value=0.0, accounts=[])
+                merged[position.figi] = item
+            
+            item.quantity += position.quantity
+            item.current_value += position.current_value
+            item.accounts.append(AccountPosition(
+                account_id,
+                account_names.get(account_id, account_id),
+                position.quantity,
+                position.current_value
+            ))
+    
+    return Portfolio(list(merged.values()), total_value, currency)
+
+
+def fetch_instruments(client, figis: List[str]) -> Dict[str, Dict]:
+    """
+    Получение информации об инструментах по списку FIGI
+
+    Запросы выполняются параллельно поверх одного канала клиента,
+    поэтому время ответа определяется самым медленным запросом,
+    а не суммой всех запросов.
+
+    Returns:
+        Dict figi -> {'name', 'ticker', 'type', 'lot'} для найденных инструментов
+    """
+    figis = list(dict.fromkeys(figi for figi in figis if figi))
+    if not figis:
+        return {}
+
+    def fetch(figi: str):
+        try:
+            instrument = client.instruments.get_instrument_by(
+                id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI,
+                id=figi
+            ).instrument
+        except Exception:
+            return figi, None
+        return figi, instrument_info(instrument)
+
+    workers = max(1, min(INSTRUMENT_LOOKUP_WORKERS, len(figis)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(fetch, figis)
+        return {figi: info for figi, info in results if info is not None}
+
+
 class TinkoffInvestService:
     """Сервис для работы с Tinkoff Invest API"""
     
-    def __init__(self, token: str):
+    def __init__(self, token: str, instrument_cache=None, client_pool=None):
         self.token = token
+        self.instrument_cache = instrument_cache
+        self.client_pool = client_pool or default_client_pool
+    
+    def _resolve_instruments(self, client, figis: List[str]) -> Dict[str, Dict]:
+        """Информация об инструментах: сначала из кэша, недостающее - из API"""
+        instruments = self.instrument_cache.get_many(figis) if self.instrument_cache else {}
+        
+        missing = [figi for figi in figis if figi and figi not in instruments]
+        count_cache('instruments', len(instruments), len(missing))
+        if missing:
+            fetched = fetch_instruments(client, missing)
+            if self.instrument_cache:
+                self.instrument_cache.put_many(fetched)
+            instruments.update(fetched)
+        
+        return instruments
+    
+    def warm_instrument_cache(self) -> int:
+        """Прогрев кэша инструментов полными списками инструментов"""
+        if not self.instrument_cache:
+            return 0
+        with self.client_pool.client(self.token) as client:
+            return self.instrument_cache.warm(client)
     
+    @SERVICE_SECONDS.time('sync_get_accounts')
     def get_accounts(self) -> List[Dict]:
         """Получить список счетов"""
-        with Client(self.token) as client:
-            accounts = client.users.get_accounts()
-            return [
-                {
-                    'id': acc.id,
-                    'name': acc.name,
-                    'type': acc.type,
-                    'status': acc.status
-                }
-                for acc in accounts.accounts
-            ]
+        with self.client_pool.client(self.token) as client:
+            return build_accounts(client.users.get_accounts())
     
-    def get_portfolio(self, account_id: str) -> Dict:
+    @SERVICE_SECONDS.time('sync_get_portfolio')
+    def get_portfolio(self, account_id: str) -> Portfolio:
         """Получить портфель по счету"""
-        with Client(self.token) as client:
+        with self.client_pool.client(self.token) as client:
             portfolio = client.operations.get_portfolio(account_id=account_id)
             
-            positions = []
-            for position in portfolio.positions:
-                # Получаем информацию об инструменте
-                instrument = None
-                try:
-                    if position.figi:
-                        instrument = client.instruments.get_instrument_by(
-                            id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI,
-                            id=position.figi
-                        ).instrument
-                except:
-                    pass
-                
-                # Расчет текущей стоимости позиции
-                quantity = quotation_to_decimal(position.quantity)
-                current_price = money_value_to_decimal(position.current_price) if position.current_price else Decimal(0)
-                current_value = quantity * current_price
-                
-                positions.append({
-                    'figi': position.figi,
-                    'name': instrument.name if instrument else position.figi,
-                    'ticker': instrument.ticker if instrument else '',
-                    'type': instrument.instrument_type if instrument else '',
-                    'quantity': float(quantity),
-                    'current_price': float(current_price),
-                    'current_value': float(current_value),
-                    'currency': position.current_price.currency if position.current_price else 'RUB'
-                })
-            
-            total_value = money_value_to_decimal(portfolio.total_amount_portfolio)
+            # Информацию обо всех инструментах получаем одним пакетом
+            instruments = self._resolve_instruments(client, [position.figi for position in portfolio.positions])
             
-            return {
-                'positions': positions,
-                'total_value': float(total_value),
-                'currency': portfolio.total_amount_portfolio.currency
-            }
+            return build_portfolio(portfolio, instruments)
 
 
 class RebalanceCalculator:
     """Калькулятор ребалансировки портфеля"""
     
     @staticmethod
-    def calculate_rebalance(positions: List[Dict], target_weights: Dict[str, float], mode: str = 'buy_only') -> Dict:
+    def _split_by_account(operations: List[Operation], selected_positions: Dict[str, Position]):
+        """
+        Распределение операций по счетам для сводного портфеля
+        
+        Если позиция собрана из нескольких счетов (поле accounts), объем
+        операции делится между счетами пропорционально текущей стоимости
+        позиции на каждом счете. Продажа при этом не превышает остаток на счете.
+        Операции в лотах делятся на целое число лотов.
+        """
+        for operation in operations:
+            accounts = selected_positions[operation.figi].accounts
+            if not accounts:
+                continue
+            
+            total_value = sum(acc.current_value for acc in accounts)
+            shares = [
+                acc.current_value / total_value if total_value > 0 else 1 / len(accounts)
+                for acc in accounts
+            ]
+            
+            if operation.lots is not None:
+                # Целые лоты делим методом наибольшего остатка
+                exact = [operation.lots * share for share in shares]
+                lots = [int(value) for value in exact]
+                by_remainder = sorted(range(len(accounts)), key=lambda i: exact[i] - lots[i], reverse=True)
+                for i in by_remainder[:operation.lots - sum(lots)]:
+                    lots[i] += 1
+                shares = [account_lots / operation.lots if operation.lots else 0 for account_lots in lots]
+            
+            split = []
+            for acc, share in zip(accounts, shares):
+                split.append({
+                    'account_id': acc.account_id,
+                    'account_name': acc.account_name,
+                    'quantity': operation.quantity * share,
+                    'value': operation.value * share
+                })
+            operation.accounts = split
+    
+    @staticmethod
+    def _lots_result(engine: RebalanceEngine, weights, selected, target_weights: Dict[str, float], mode: str,
+                     budget: float, current_total: float, current_weights: List[float],
+                     positions_by_figi: Dict[str, Position], costs=None, cost_aversion: float = 1.0) -> Dict:
+        """Результат целочисленной ребалансировки в лотах для одного сценария"""
+        solution = engine.solve_lots(weights, selected, mode, budget, costs, cost_aversion)
+        target_total = solution['target_total']
+        lot_changes = solution['lots'].tolist()
+        trade_costs = costs.trade_costs(solution['lots']) if costs is not None else None
+        operation_costs = sum(trade_costs.values()).tolist() if trade_costs else None
+        
+        operations = []
+        for column, pos in enumerate(engine.positions):
+            if not selected[column]:
+                continue
+            
+            lot = int(engine.lot_sizes[column])
+            lot_change = lot_changes[column]
+            target_value = target_total * target_weights[pos.figi] / 100
+            current_value = pos.current_value
+            
+            if lot_change > 0:
+                action = 'buy'
+            elif lot_change < 0:
+                action = 'sell'
+            elif mode == 'buy_only' and target_value - current_value < -0.01:
+                action = 'skip'
+            else:
+                continue
+            
+            operation = Operation(
+                pos.figi, pos.name, pos.ticker, action,
+                quantity=abs(lot_change) * lot,
+                value=abs(lot_change) * lot * pos.current_price,
+                current_value=current_value,
+                target_value=target_value,
+                current_weight=current_weights[column],
+                target_weight=target_weights[pos.figi],
+                price=pos.current_price,
+                lots=abs(lot_change),
+                lot=lot
+            )
+            if operation_costs is not None:
+                operation.cost = operation_costs[column]
+            operations.append(operation)
+        
+        RebalanceCalculator._split_by_account(operations, positions_by_figi)
+        
+        cash_used = solution['cash_used']
+        result = {
+            'operations': operations,
+            'current_total': current_total,
+            'new_total': current_total + solution['traded_value'],
+            'additional_investment': cash_used,
+            'budget': budget,
+            'tracking_error': solution['tracking_error'],
+            'lots': True,
+            'mode': mode
+        }
+        if trade_costs is not None:
+            result['costs'] = {name: float(values.sum()) for name, values in trade_costs.items()}
+            result['costs']['total'] = sum(result['costs'].values())
+        return result
+    
+    @staticmethod
+    def calculate_rebalance(positions: List[Position], target_weights: Dict[str, float], mode: str = 'buy_only',
+                            lots: bool = False, budget: Optional[float] = None,
+                            engine: Optional[RebalanceEngine] = None, costs=None,
+                            cost_aversion: float = 1.0) -> Dict:
         """
         Расчет ребалансировки портфеля
         
@@ -108,115 +406,131 @@ class RebalanceCalculator:
             positions: Список позиций с текущими значениями
             target_weights: Целевые доли для каждого актива (figi -> вес в процентах)
             mode: Режим ребалансировки ('buy_only' или 'buy_and_sell')
+            lots: Считать операции в целых лотах
+            budget: Доступные средства для режима лотов (по умолчанию - дополнительное
+                вложение непрерывного решения для 'buy_only' и 0 для 'buy_and_sell')
+            engine: Готовый RebalanceEngine по этим позициям (переиспользуется между расчетами)
+            costs: Модель издержек (CostModel) по позициям engine; только для режима лотов
+            cost_aversion: Вес издержек относительно отклонения долей
         
         Returns:
             Dict с информацией о необходимых операциях
         """
+        return RebalanceCalculator.calculate_rebalance_batch(
+            positions, [target_weights], mode, lots, budget, engine, costs, cost_aversion
+        )[0]
+    
+    @staticmethod
+    def calculate_rebalance_batch(positions: List[Position], scenarios: List[Dict[str, float]], mode: str = 'buy_only',
+                                  lots: bool = False, budget: Optional[float] = None,
+                                  engine: Optional[RebalanceEngine] = None, costs=None,
+                                  cost_aversion: float = 1.0) -> List[Dict]:
+        """
+        Расчет ребалансировки сразу для нескольких наборов целевых долей
+        
+        Позиции переводятся в массивы один раз, а все сценарии считаются
+        векторно (см. RebalanceEngine), поэтому сотни вариантов распределения
+        обрабатываются за один вызов.
+        
+        Args:
+            positions: Список позиций с текущими значениями
+            scenarios: Наборы целевых долей (figi -> вес в процентах)
+            mode: Режим ребалансировки ('buy_only' или 'buy_and_sell')
+            lots: Считать операции в целых лотах
+            budget: Доступные средства для режима лотов
+            engine: Готовый RebalanceEngine по этим позициям (переиспользуется между расчетами)
+            costs: Модель издержек (CostModel) по позициям engine; только для режима лотов
+            cost_aversion: Вес издержек относительно отклонения долей
+        
+        Returns:
+            Список результатов в формате calculate_rebalance, по одному на сценарий
+        """
+        results = [None] * len(scenarios)
+        
         # Проверка что сумма весов = 100%
-        total_weight = sum(target_weights.values())
-        if abs(total_weight - 100) > 0.01:
-            return {'error': f'Сумма долей должна быть 100%, а не {total_weight}%'}
-        
-        # Фильтруем только выбранные позиции
-        selected_positions = {
-            pos['figi']: pos 
-            for pos in positions 
-            if pos['figi'] in target_weights
-        }
+        valid = []
+        for index, target_weights in enumerate(scenarios):
+            total_weight = sum(target_weights.values())
+            if abs(total_weight - 100) > 0.01:
+                results[index] = {'error': f'Сумма долей должна быть 100%, а не {total_weight}%'}
+            else:
+                valid.append(index)
         
-        # Текущая общая стоимость выбранных активов
-        current_total = sum(pos['current_value'] for pos in selected_positions.values())
+        if not valid:
+            return results
         
-        if current_total == 0:
-            return {'error': 'Общая стоимость выбранных активов равна 0'}
+        if engine is None:
+            # Учитываем только позиции, выбранные хотя бы в одном сценарии
+            figis = set()
+            for index in valid:
+                figis.update(scenarios[index])
+            engine = RebalanceEngine([pos for pos in positions if pos.figi in figis])
         
-        # Расчет текущих и целевых долей
-        current_weights = {
-            figi: (pos['current_value'] / current_total * 100) if current_total > 0 else 0
-            for figi, pos in selected_positions.items()
-        }
+        weights, selected = engine.weights_matrix([scenarios[index] for index in valid])
+        solution = engine.solve(weights, selected, mode)
         
-        # Расчет целевых стоимостей
-        operations = []
+        current_totals = solution['current_total'].tolist()
+        new_totals = solution['new_total'].tolist()
+        current_weights = solution['current_weights'].tolist()
+        target_values = solution['target_values'].tolist()
+        diff_values = solution['diff_values'].tolist()
+        quantities = solution['quantities'].tolist()
+        values = engine.values.tolist()
+        selected_mask = selected
+        selected = selected.tolist()
+        positions_by_figi = {pos.figi: pos for pos in engine.positions}
         
-        if mode == 'buy_only':
-            # Режим только покупки: не продаем, только докупаем
-            # Находим актив с наибольшим отклонением (который должен быть меньше целевого)
-            max_scale_factor = 0
+        for row, index in enumerate(valid):
+            current_total = current_totals[row]
+            if current_total == 0:
+                results[index] = {'error': 'Общая стоимость выбранных активов равна 0'}
+                continue
             
-            for figi, pos in selected_positions.items():
-                current_value = pos['current_value']
-                target_weight = target_weights[figi] / 100
-                
-                if target_weight > 0:
-                    # Какой должна быть общая сумма, чтобы текущая стоимость составляла целевую долю
-                    required_total = current_value / target_weight
-                    scale_factor = required_total / current_total
-                    max_scale_factor = max(max_scale_factor, scale_factor)
-            
-            # Новая общая сумма портфеля
-            new_total = current_total * max_scale_factor
-            additional_investment = new_total - current_total
+            if lots:
+                if budget is not None:
+                    lots_budget = budget
+                else:
+                    lots_budget = new_totals[row] - current_total if mode == 'buy_only' else 0.0
+                results[index] = RebalanceCalculator._lots_result(
+                    engine, weights[row], selected_mask[row], scenarios[index], mode, lots_budget,
+                    current_total, current_weights[row], positions_by_figi, costs, cost_aversion
+                )
+                continue
             
-            for figi, pos in selected_positions.items():
-                target_value = new_total * (target_weights[figi] / 100)
-                current_value = pos['current_value']
-                diff_value = target_value - current_value
+            operations = []
+            for column, pos in enumerate(engine.positions):
+                diff_value = diff_values[row][column]
+                
+                # Игнорируем очень маленькие различия
+                if not selected[row][column] or abs(diff_value) <= 0.01:
+                    continue
                 
-                if abs(diff_value) > 0.01:  # Игнорируем очень маленькие различия
-                    diff_quantity = diff_value / pos['current_price'] if pos['current_price'] > 0 else 0
-                    
-                    operations.append({
-                        'figi': figi,
-                        'name': pos['name'],
-                        'ticker': pos['ticker'],
-                        'action': 'buy' if diff_value > 0 else 'skip',
-                        'quantity': abs(diff_quantity),
-                        'value': abs(diff_value),
-                        'current_value': current_value,
-                        'target_value': target_value,
-                        'current_weight': current_weights[figi],
-                        'target_weight': target_weights[figi],
-                        'price': pos['current_price']
-                    })
+                if diff_value > 0:
+                    action = 'buy'
+                else:
+                    # В режиме только покупки не продаем
+                    action = 'skip' if mode == 'buy_only' else 'sell'
+                
+                operations.append(Operation(
+                    pos.figi, pos.name, pos.ticker, action,
+                    quantity=abs(quantities[row][column]),
+                    value=abs(diff_value),
+                    current_value=values[column],
+                    target_value=target_values[row][column],
+                    current_weight=current_weights[row][column],
+                    target_weight=scenarios[index][pos.figi],
+                    price=pos.current_price
+                ))
+            
+            RebalanceCalculator._split_by_account(operations, positions_by_figi)
             
-            return {
+            new_total = new_totals[row] if mode == 'buy_only' else current_total
+            results[index] = {
                 'operations': operations,
                 'current_total': current_total,
                 'new_total': new_total,
-                'additional_investment': additional_investment,
+                'additional_investment': new_total - current_total if mode == 'buy_only' else 0,
                 'mode': mode
             }
         
-        else:  # buy_and_sell
-            # Режим с продажей: можем и покупать, и продавать
-            for figi, pos in selected_positions.items():
-                target_value = current_total * (target_weights[figi] / 100)
-                current_value = pos['current_value']
-                diff_value = target_value - current_value
-                
-                if abs(diff_value) > 0.01:  # Игнорируем очень маленькие различия
-                    diff_quantity = diff_value / pos['current_price'] if pos['current_price'] > 0 else 0
-                    
-                    operations.append({
-                        'figi': figi,
-                        'name': pos['name'],
-                        'ticker': pos['ticker'],
-                        'action': 'buy' if diff_value > 0 else 'sell',
-                        'quantity': abs(diff_quantity),
-                        'value': abs(diff_value),
-                        'current_value': current_value,
-                        'target_value': target_value,
-                        'current_weight': current_weights[figi],
-                        'target_weight': target_weights[figi],
-                        'price': pos['current_price']
-                    })
-            
-            return {
-                'operations': operations,
-                'current_total': current_total,
-                'new_total': current_total,
-                'additional_investment': 0,
-                'mode': mode
-            }
-
+        return results